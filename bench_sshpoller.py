@@ -0,0 +1,839 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Import standard python modules
+import argparse
+import csv
+import json
+import math
+from multiprocessing import Pipe, Process, Queue
+import os
+import pickle
+import resource
+import shutil
+import tempfile
+import threading
+from time import sleep, time
+import tracemalloc
+import yaml
+
+# TextFSM module : https://github.com/google/textfsm
+import clitable
+
+# InfluxDB module : https://github.com/influxdata/influxdb-python
+from influxdb import InfluxDBClient
+
+# Module we're benchmarking
+import sshpoller
+
+# Local stand-ins for devices and InfluxDB
+from test_sshpoller_mock import AsyncMockFleet, FakeConnection, FakeInfluxDB
+
+# TEXTFSM config settings
+index_file = 'index'
+template_dir = 'templates'
+
+
+def read_fixture(name):
+    """ Returns the content of a mockssh fixture """
+    return open(os.path.join('mockssh', name), 'r').read()
+
+
+def cisco_interfaces(count):
+    """ Returns a 'show interface' output with count interfaces, built from the fixture """
+    block = read_fixture('cisco_show_interface.txt').split('\n\n')[0]
+    return '\n\n'.join(block.replace('Ethernet1/1 ', 'Ethernet%s/%s ' % (i // 48 + 1, i % 48 + 1), 1)
+                        for i in range(count)) + '\n'
+
+
+def rss_kb(pid):
+    """ Returns the resident memory of a process in kB """
+    try:
+        for line in open('/proc/%s/status' % pid):
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    except IOError:
+        pass
+    return 0
+
+
+def tree_pids(pid):
+    """ Returns pid and the pids of all its descendants """
+    pids = [pid]
+    for pid in pids:
+        try:
+            for task in os.listdir('/proc/%s/task' % pid):
+                pids.extend(int(child) for child in open('/proc/%s/task/%s/children' % (pid, task)).read().split())
+        except (IOError, OSError):
+            pass
+    return pids
+
+
+def percentile(values, p):
+    """ Returns the p-th percentile of values (nearest rank) """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+def timeit(func, iterations):
+    """ Returns the average time of func() in microseconds """
+    start = time()
+    for i in range(iterations):
+        func()
+    return (time() - start) / iterations * 1000000
+
+
+def bench_template_cache(args):
+    """ Per-parse cost of a fresh CliTable vs the template registry """
+
+    output = read_fixture('cisco_show_interface.txt')
+    attrs = {'Command': 'show interface', 'Platform': 'cisco_nxos'}
+
+    def uncached():
+        cli_table = clitable.CliTable(index_file, template_dir)
+        cli_table.ParseCmd(output, attrs)
+
+    def cached():
+        sshpoller.template_registry.parse(output, attrs)
+
+    return {
+        'uncached_us': timeit(uncached, args.iterations),
+        'cached_us': timeit(cached, args.iterations),
+    }
+
+
+def bench_influx_writer(args):
+    """ One request per point vs the batched writer, against a local fake InfluxDB """
+
+    data_list = json.loads(read_fixture('cisco_show_interface_tag.json')) * args.iterations
+    influx = FakeInfluxDB()
+    results = {'points': len(data_list)}
+
+    # Previous behaviour: new client, one write_points() per point
+    start = time()
+    client = InfluxDBClient('127.0.0.1', influx.port, 'root', 'root', 'db_name')
+    for data in data_list:
+        json_body = [{'measurement': data['command'], 'tags': data['tag'],
+                      'fields': data['fields'], 'time': data['timestamp']}]
+        client.write_points(json_body, time_precision='s')
+    results['per_point'] = {'requests': influx.requests, 'bytes': influx.bytes, 'wall_s': time() - start}
+
+    for gzip in (False, True):
+        influx.requests = influx.bytes = 0
+        start = time()
+        writer = sshpoller.InfluxWriter('127.0.0.1', influx.port, 'root', 'root', 'db_name', gzip=gzip)
+        writer.write(data_list)
+        writer.flush()
+        results['batched_gzip' if gzip else 'batched'] = {
+            'requests': influx.requests, 'bytes': influx.bytes, 'wall_s': time() - start}
+
+    influx.stop()
+    return results
+
+
+def bench_pool_size(args):
+    """ Memory and poll latency of worker pools of 1 to 64 processes against asyncssh mock devices """
+
+    # netmiko finds an enable prompt right away
+    fleet = AsyncMockFleet(args.devices, prompt='hostname#')
+    influx = FakeInfluxDB(keep_lines=False)
+    sshpoller.SSH_Poller.db_port = influx.port
+    tasks = [{
+        'hostname': '127.0.0.1',
+        'port': port,
+        'username': 'test',
+        'password': 'test',
+        'mode': 'influx',
+        'device_type': 'cisco_nxos',
+        'parser_mode': 'fsm',
+        'commands': ['show version', 'show interface:intf_name'],
+        'precommands': '',
+        'interval': 0
+    } for port in fleet.ports]
+
+    results = {'devices': args.devices, 'pool_sizes': {}}
+    for size in (1, 2, 4, 8, 16, 32, 64):
+        input_queue = Queue()
+        task_chunks = sshpoller.split_tasks(tasks, size)
+        for task_chunk in task_chunks:
+            input_queue.put(task_chunk)
+
+        start = time()
+        points = influx.points
+        workers = [Process(target=sshpoller.worker, args=(input_queue, Queue())) for task_chunk in task_chunks]
+        for p in workers:
+            p.start()
+        peak_rss = 0
+        while any(p.is_alive() for p in workers):
+            peak_rss = max(peak_rss, sum(rss_kb(p.pid) for p in workers))
+            sleep(0.05)
+        wall = time() - start
+
+        # Keyed by string, JSON keys are sorted along with 'devices'
+        results['pool_sizes'][str(size)] = {
+            'workers': len(workers),
+            'points': influx.points - points,
+            'rss_mb': peak_rss / 1024.0,
+            'wall_s': wall,
+            'avg_poll_s': wall * len(workers) / args.devices,
+        }
+
+    fleet.stop()
+    influx.stop()
+    return results
+
+
+def bench_asyncio_engine(args):
+    """ One poll of every device with the asyncio engine against asyncssh mock devices """
+
+    fleet = AsyncMockFleet(args.devices)
+    influx = FakeInfluxDB(keep_lines=False)
+    sshpoller.SSH_Poller.db_port = influx.port
+    tasks = [{
+        'hostname': '127.0.0.1',
+        'port': port,
+        'username': 'test',
+        'password': 'test',
+        'mode': 'influx',
+        'device_type': 'cisco_nxos',
+        'parser_mode': 'fsm',
+        'commands': ['show version', 'show interface:intf_name'],
+        'precommands': '',
+        'interval': 0
+    } for port in fleet.ports]
+
+    start = time()
+    sshpoller.AsyncEngine(tasks).run()
+    wall = time() - start
+
+    fleet.stop()
+    influx.stop()
+    return {
+        'devices': args.devices,
+        'points': influx.points,
+        'wall_s': wall,
+        'polls_per_s': args.devices / wall,
+    }
+
+
+def bench_csv_parse(args):
+    """ Temp file + DictReader vs streaming parse_csv on f5_tmctl_csv.txt scaled to 100k rows """
+
+    lines = read_fixture('f5_tmctl_csv.txt').split('\n')
+    rows = [line for line in lines[1:] if line]
+    output = '\n'.join([lines[0]] + rows * (100000 // len(rows))) + '\n'
+    task = {
+        'hostname': 'localhost',
+        'username': 'test',
+        'password': 'test',
+        'port': 22,
+        'device_type': 'f5_ltm',
+        'parser_mode': 'csv',
+        'precommands': '',
+        'interval': 0,
+        'commands': ['tmctl -c pva_stat'],
+    }
+    command = {'command': 'tmctl -c pva_stat', 'tag': ''}
+
+    # Previous behaviour: copy the lines to a temp file and read it back
+    def tempfile_parse():
+        csvfile = tempfile.TemporaryFile('w+')
+        for line in output.split('\n'):
+            if line != "":
+                csvfile.write("%s\n" % line)
+            else:
+                break
+        csvfile.seek(0)
+        data_list = []
+        for idx, row in enumerate(csv.DictReader(csvfile)):
+            data_list.append({'tag': {'host': 'localhost', 'instance': idx}, 'command': command['command'],
+                              'fields': dict((k, sshpoller.float_if_possible(v)) for (k, v) in row.items())})
+        return data_list
+
+    def streaming_parse():
+        poller = sshpoller.SSH_Poller(task)
+        poller.parse_csv(output, command)
+        return poller.data_list
+
+    iterations = max(1, args.iterations // 100)
+    return {
+        'rows': len(streaming_parse()),
+        'tempfile_s': timeit(tempfile_parse, iterations) / 1000000,
+        'streaming_s': timeit(streaming_parse, iterations) / 1000000,
+    }
+
+
+def bench_field_conversion(args):
+    """ float_if_possible() on every value vs the typed field schema, on cisco_show_interface.txt """
+
+    output = read_fixture('cisco_show_interface.txt')
+    attrs = {'Command': 'show interface', 'Platform': 'cisco_nxos'}
+    header, records = sshpoller.template_registry.parse(output, attrs)
+    schema = sshpoller.template_registry.templates['cisco_show_interface.template']['schema']
+
+    def float_if_possible():
+        for record in records:
+            [sshpoller.float_if_possible(value) for value in record]
+
+    def typed():
+        for record in records:
+            schema.convert(record)
+
+    return {
+        'rows': len(records),
+        'float_if_possible_us': timeit(float_if_possible, args.iterations * 10),
+        'typed_us': timeit(typed, args.iterations * 10),
+    }
+
+
+def bench_result_table(args):
+    """ Row dictionaries vs column-oriented result tables, on a 10k-interface output """
+
+    output = cisco_interfaces(10000)
+    attrs = {'Command': 'show interface', 'Platform': 'cisco_nxos'}
+    header, records = sshpoller.template_registry.parse(output, attrs, typed=True)
+    command = {'command': 'show interface', 'tag': 'intf_name'}
+
+    # Previous representation: one data dictionary per row, plus its tag dictionary
+    def dicts():
+        data_list = []
+        for field in sshpoller.records_to_dict(header, records):
+            data = {}
+            data['tag'] = {'host': 'localhost', 'command': command['tag']}
+            data['command'] = command['command']
+            data['fields'] = field
+            data['tag'][command['tag']] = data['fields'][command['tag']]
+            data['timestamp'] = 0
+            data_list.append(data)
+        return data_list
+
+    def table():
+        return sshpoller.ResultTable(
+            command['command'], [name.lower() for name in header], [tuple(record) for record in records],
+            {'host': 'localhost', 'command': command['tag']}, 0, tag_column=command['tag'])
+
+    results = {'rows': len(records)}
+    for name, build, serialize in (
+            ('dicts', dicts, lambda data_list: [sshpoller.to_line_protocol(data) for data in data_list]),
+            ('table', table, lambda result: result.to_line_protocol())):
+        tracemalloc.start()
+        result = build()
+        size, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del result
+
+        start = time()
+        serialize(build())
+        results[name] = {'memory_kb': size / 1024.0, 'build_and_serialize_s': time() - start}
+
+    return results
+
+
+def bench_parse_cache(args):
+    """ Parse of an unchanged 'show interface' output, without and with the parse cache """
+
+    task = {
+        'hostname': 'localhost',
+        'username': 'test',
+        'password': 'test',
+        'port': 22,
+        'device_type': 'cisco_nxos',
+        'parser_mode': 'fsm',
+        'precommands': '',
+        'interval': 0,
+        'commands': ['show interface:intf_name'],
+    }
+    output = read_fixture('cisco_show_interface.txt')
+    command = {'command': 'show interface', 'tag': 'intf_name'}
+    poller = sshpoller.SSH_Poller(task)
+
+    def parse():
+        poller.batch = []
+        poller.parse(output, command)
+
+    results = {}
+    for name, max_entries in (('uncached', 0), ('cached', 10000)):
+        sshpoller.parse_cache = sshpoller.ParseCache(max_entries)
+        results['%s_us' % name] = timeit(parse, args.iterations)
+    results['cache'] = sshpoller.parse_cache.stats()
+    return results
+
+
+def bench_prometheus(args):
+    """ Update and scrape time of the Prometheus sink with 1M series """
+
+    header = ['intf_name'] + ['counter_%s' % i for i in range(10)]
+    rows = [tuple(['Ethernet%s/%s' % (i // 48 + 1, i % 48 + 1)] + [float(i * j) for j in range(10)])
+            for i in range(1000)]
+    tables = [sshpoller.ResultTable('show interface', header, rows, {'host': 'device%s' % device, 'command': 'intf_name'},
+                                    0, tag_column='intf_name') for device in range(100)]
+    sink = sshpoller.PrometheusSink(port=None)
+
+    results = {'series': 100 * 1000 * 10}
+    start = time()
+    sink.write(tables, now=0)
+    results['first_write_s'] = time() - start
+
+    start = time()
+    size = len(sink.render(now=0))
+    results['first_scrape_s'] = time() - start
+    results['scrape_mb'] = size / 1024.0 / 1024.0
+
+    # Same values, nothing to render again
+    start = time()
+    sink.write(tables, now=1)
+    results['unchanged_write_s'] = time() - start
+    start = time()
+    sink.render(now=1)
+    results['unchanged_scrape_s'] = time() - start
+
+    # New values for 1 metric out of 10
+    changed = [sshpoller.ResultTable(table.command, table.header, [row[:1] + (row[1] + 1,) + row[2:] for row in table.rows],
+                                     table.tags, 1, tag_column='intf_name') for table in tables]
+    start = time()
+    sink.write(changed, now=2)
+    results['changed_write_s'] = time() - start
+    start = time()
+    sink.render(now=2)
+    results['changed_scrape_s'] = time() - start
+
+    return results
+
+
+def bench_prefilter(args):
+    """ Parse throughput (MB/s) of juniper_show_interfaces_extensive.txt scaled to ~2MB, without and with the pre-filter """
+
+    output = read_fixture('juniper_show_interfaces_extensive.txt') * 100
+    attrs = {'Command': 'show interfaces extensive', 'Platform': 'juniper'}
+    registry = sshpoller.TemplateRegistry(index_file, template_dir)
+    size = len(output) / 1024.0 / 1024.0
+    iterations = max(1, args.iterations // 20)
+
+    results = {'size_mb': size}
+    for name, prefilter in (('unfiltered', False), ('prefiltered', True)):
+        registry.prefilter = prefilter
+        results['%s_mb_per_s' % name] = size / (timeit(lambda: registry.parse(output, attrs), iterations) / 1000000)
+        results['%s_records' % name] = len(registry.parse(output, attrs)[1])
+    return results
+
+
+def bench_projection(args):
+    """ CPU and bytes on the wire per poll of cisco_show_platform, all values vs 2 requested fields """
+
+    task = {
+        'hostname': 'localhost',
+        'username': 'test',
+        'password': 'test',
+        'port': 22,
+        'device_type': 'cisco_nxos',
+        'parser_mode': 'fsm',
+        'precommands': '',
+        'interval': 0,
+    }
+    output = read_fixture('cisco_show_platform_software_qd_info_counters.txt') * 20
+    command = 'show platform software qd info counters'
+
+    results = {}
+    for name, commands in (('all_fields', [command + ':intf_name']),
+                           ('projected', [{'command': command, 'tag': 'intf_name', 'fields': ['q2_discard', 'q3_discard']}])):
+        poller = sshpoller.SSH_Poller(dict(task, commands=commands))
+        sshpoller.parse_cache = sshpoller.ParseCache(0)
+
+        def poll():
+            poller.batch = []
+            poller.parse(output, poller.command_list[0])
+            return [line for table in poller.batch for line in table.to_line_protocol()]
+
+        lines = poll()
+        results[name] = {
+            'fields': len(poller.batch[0].header),
+            'bytes': len('\n'.join(lines)),
+            'cpu_us': timeit(poll, args.iterations),
+        }
+    return results
+
+
+def bench_instrumentation(args):
+    """ CPU per poll cycle of 2 commands with instrumentation disabled and enabled """
+
+    task = {
+        'hostname': 'localhost',
+        'username': 'test',
+        'password': 'test',
+        'port': 22,
+        'mode': 'json',
+        'device_type': 'cisco_nxos',
+        'parser_mode': 'fsm',
+        'commands': ['show version', 'show interface:intf_name'],
+        'precommands': '',
+        'interval': 0,
+    }
+    poller = sshpoller.SSH_Poller(task)
+    poller.sock = FakeConnection()
+    sshpoller.parse_cache = sshpoller.ParseCache(0)
+
+    def poll():
+        poller.send_commands()
+        poller.results.get_all()
+
+    results = {}
+    for name, enabled in (('disabled', False), ('enabled', True)):
+        sshpoller.metrics = sshpoller.StageMetrics(enabled)
+        poll()
+        results[name] = {'cpu_us': timeit(poll, args.iterations)}
+    results['overhead_percent'] = (results['enabled']['cpu_us'] / results['disabled']['cpu_us'] - 1) * 100
+    sshpoller.metrics = sshpoller.StageMetrics()
+    return results
+
+
+def bench_slow_lane(args):
+    """ Polls and skipped cycles of DEVICES fast devices sharing a worker with one slow device,
+        with fixed intervals and with adaptive polling
+    """
+
+    def connect(poller):
+        poller.sock = FakeConnection(delay=3.0 if poller.hostname == 'slow' else 0.0)
+        return True
+
+    influx = FakeInfluxDB(keep_lines=False)
+    sshpoller.SSH_Poller.db_port = influx.port
+    tasks = [{
+        'hostname': hostname,
+        'port': 22,
+        'username': 'test',
+        'password': 'test',
+        'mode': 'influx',
+        'device_type': 'cisco_nxos',
+        'parser_mode': 'fsm',
+        'commands': ['show version'],
+        'precommands': '',
+        'interval': 1.0
+    } for hostname in ['slow'] + ['fast%s' % i for i in range(args.devices)]]
+    duration = 20.0
+
+    results = {}
+    ssh_connect = sshpoller.SSH_Poller.connect
+    sshpoller.SSH_Poller.connect = connect
+    try:
+        for name, adaptive in (('fixed', False), ('adaptive', True)):
+            sshpoller.PollScheduler.adaptive = adaptive
+            scheduler = sshpoller.PollScheduler(tasks)
+            threading.Timer(duration, scheduler.stop).start()
+            scheduler.run()
+            sshpoller.poller_influx_writer(sshpoller.SSH_Poller).flush()
+            stats = scheduler.stats()
+            fast = [stats[task['hostname']] for task in tasks[1:]]
+            results[name] = {
+                'fast_polls_per_sec': sum(poll['cycles'] for poll in fast) / duration,
+                'fast_skipped': sum(poll['skipped'] for poll in fast),
+                'fast_max_lateness': max(poll['max_lateness'] for poll in fast),
+                'slow_polls': stats['slow']['cycles'],
+            }
+    finally:
+        sshpoller.SSH_Poller.connect = ssh_connect
+        sshpoller.PollScheduler.adaptive = True
+        influx.stop()
+    return results
+
+
+# Groups of the inventory benchmark
+inventory_groups = {
+    'nxos': {'device_type': 'cisco_nxos', 'parse_mode': 'fsm', 'post_login_commands': ['terminal length 0'],
+             'commands': ['show version', 'show interface:intf_name']},
+    'f5': {'device_type': 'f5_ltm', 'parse_mode': 'csv', 'post_login_commands': ['bash'],
+           'commands': ['tmctl -c pva_stat', 'tmctl -c -d blade tmm/tcp4']},
+    'junos': {'device_type': 'juniper', 'parse_mode': 'fsm', 'post_login_commands': ['set cli screen-length 0'],
+              'commands': ['show interfaces extensive:intf_name']},
+}
+
+
+def write_inventories(directory, count):
+    """ Writes a device list YAML, a groups YAML and a groups YAML with a CSV device list of count devices """
+
+    names = sorted(inventory_groups)
+    devices = [('dev%06d' % i, names[i % len(names)]) for i in range(count)]
+    with open(os.path.join(directory, 'list.yml'), 'w') as f:
+        yaml.safe_dump([dict(inventory_groups[group], device_name=name, port=22) for (name, group) in devices], f)
+    with open(os.path.join(directory, 'groups.yml'), 'w') as f:
+        yaml.safe_dump({'groups': inventory_groups,
+                        'devices': [{'device_name': name, 'group': group} for (name, group) in devices]}, f)
+    with open(os.path.join(directory, 'devices.csv'), 'w') as f:
+        f.write('device_name,group\n')
+        f.writelines('%s,%s\n' % device for device in devices)
+    with open(os.path.join(directory, 'csv.yml'), 'w') as f:
+        yaml.safe_dump({'groups': inventory_groups, 'devices': 'devices.csv'}, f)
+
+
+def legacy_tasks(filename):
+    """ Task list built like main() did before inventories: pure Python loader, a full dictionary per device """
+
+    task_list = []
+    for yaml_task in yaml.load(open(filename).read(), Loader=yaml.SafeLoader):
+        task_list.append({
+            'hostname': yaml_task['device_name'],
+            'username': 'test',
+            'password': 'test',
+            'mode': 'influx',
+            'device_type': yaml_task['device_type'],
+            'parser_mode': yaml_task['parse_mode'],
+            'commands': yaml_task['commands'],
+            'precommands': yaml_task['post_login_commands'],
+            'interval': 60,
+            'max_channels': yaml_task.get('max_channels', 1),
+            'port': yaml_task['port'] or 22,
+        })
+    return task_list
+
+
+def bench_inventory(args):
+    """ Startup time and worker memory of 10k and 100k device inventories
+
+        legacy is a device list loaded like main() used to, the others go
+        through load_tasks(). worker_mb is the memory of the unpickled task
+        list a worker gets, pickle_mb its size on the way.
+    """
+
+    loaders = (
+        ('legacy', 'list.yml', legacy_tasks),
+        ('list', 'list.yml', lambda path: sshpoller.load_tasks(path, 'test', 'test', 'influx', 60)),
+        ('groups', 'groups.yml', lambda path: sshpoller.load_tasks(path, 'test', 'test', 'influx', 60)),
+        ('csv', 'csv.yml', lambda path: sshpoller.load_tasks(path, 'test', 'test', 'influx', 60)),
+    )
+
+    results = {}
+    for count in (10000, 100000):
+        directory = tempfile.mkdtemp()
+        write_inventories(directory, count)
+        results[count] = {}
+        for name, filename, load in loaders:
+            start = time()
+            tasks = load(os.path.join(directory, filename))
+            load_s = time() - start
+            blob = pickle.dumps(tasks)
+            del tasks
+
+            tracemalloc.start()
+            tasks = pickle.loads(blob)
+            worker_mb = tracemalloc.get_traced_memory()[0] / 1048576.0
+            tracemalloc.stop()
+            del tasks
+
+            results[count][name] = {'load_s': load_s, 'pickle_mb': len(blob) / 1048576.0, 'worker_mb': worker_mb}
+        shutil.rmtree(directory)
+    return results
+
+
+def fleet_devices(conn, args):
+    """ Runs the mock devices of the fleet benchmark until told to stop, then sends the # of injected errors """
+
+    fleet = AsyncMockFleet(args.devices, delay=args.latency, scale=args.scale, error_rate=args.error_rate, seed=0)
+    conn.send(fleet.ports)
+    conn.recv()
+    conn.send(fleet.errors)
+    fleet.stop()
+
+
+def fleet_worker(tasks, duration):
+    """ Worker process of the fleet benchmark, polls its tasks for duration seconds """
+
+    scheduler = sshpoller.PollScheduler(tasks)
+    threading.Timer(duration, scheduler.stop).start()
+    scheduler.run()
+    sshpoller.poller_influx_writer(sshpoller.SSH_Poller).flush()
+
+
+def fleet_engine(tasks, duration):
+    """ asyncio engine process of the fleet benchmark, polls every task for duration seconds """
+
+    engine = sshpoller.AsyncEngine(tasks)
+    threading.Timer(duration, engine.stop).start()
+    engine.run()
+    sshpoller.poller_influx_writer(sshpoller.SSH_Poller).flush()
+
+
+def bench_fleet(args):
+    """ Polls/s, cycle latency, CPU and memory of the poller against a fleet of asyncssh mock devices
+
+        The devices run in their own process and InfluxDB is faked in this one,
+        so CPU and memory are those of the poller processes only. Cycle times
+        come from the sshpoller_schedule points the poller writes.
+    """
+
+    conn, device_conn = Pipe()
+    devices = Process(target=fleet_devices, args=(device_conn, args))
+    devices.start()
+    ports = conn.recv()
+
+    influx = FakeInfluxDB(keep_lines='sshpoller_schedule')
+    sshpoller.SSH_Poller.db_port = influx.port
+    tasks = [{
+        'hostname': '127.0.0.1',
+        'port': port,
+        'username': 'test',
+        'password': 'test',
+        'mode': 'influx',
+        'device_type': 'cisco_nxos',
+        'parser_mode': 'fsm',
+        'commands': ['show version', 'show interface:intf_name'],
+        'precommands': '',
+        'interval': args.interval
+    } for port in ports]
+
+    if args.engine == 'asyncio':
+        pollers = [Process(target=fleet_engine, args=(tasks, args.duration))]
+    else:
+        pollers = [Process(target=fleet_worker, args=(task_chunk, args.duration))
+                   for task_chunk in sshpoller.split_tasks(tasks, args.workers)]
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time()
+    for p in pollers:
+        p.start()
+    peak_rss = 0
+    while any(p.is_alive() for p in pollers):
+        peak_rss = max(peak_rss, sum(rss_kb(pid) for p in pollers for pid in tree_pids(p.pid)))
+        sleep(0.1)
+    for p in pollers:
+        p.join()
+    wall = time() - start
+    cpu = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = cpu.ru_utime + cpu.ru_stime - usage.ru_utime - usage.ru_stime
+
+    conn.send('STOP')
+    errors = conn.recv()
+    devices.join()
+    influx.stop()
+
+    durations = []
+    for line in influx.lines:
+        fields = dict(field.split('=', 1) for field in line.split(' ')[1].split(','))
+        # Durations are those of the previous cycle, skip the first one (SSH handshake)
+        if int(fields['cycles'].rstrip('i')) > 2:
+            durations.append(float(fields['duration']))
+
+    return {
+        'engine': args.engine,
+        'devices': args.devices,
+        'workers': len(pollers),
+        'interval_s': args.interval,
+        'latency_s': args.latency,
+        'scale': args.scale,
+        'error_rate': args.error_rate,
+        'injected_errors': errors,
+        'wall_s': wall,
+        'polls': len(influx.lines),
+        'polls_per_s': len(influx.lines) / wall,
+        'points': influx.points,
+        'cycle_p50_s': percentile(durations, 50),
+        'cycle_p99_s': percentile(durations, 99),
+        'cpu_s': cpu,
+        'cpu_percent': cpu / wall * 100,
+        'rss_mb': peak_rss / 1024.0,
+    }
+
+
+BENCHMARKS = {
+    'template_cache': bench_template_cache,
+    'influx_writer': bench_influx_writer,
+    'pool_size': bench_pool_size,
+    'asyncio_engine': bench_asyncio_engine,
+    'csv_parse': bench_csv_parse,
+    'field_conversion': bench_field_conversion,
+    'result_table': bench_result_table,
+    'parse_cache': bench_parse_cache,
+    'prometheus': bench_prometheus,
+    'prefilter': bench_prefilter,
+    'projection': bench_projection,
+    'instrumentation': bench_instrumentation,
+    'inventory': bench_inventory,
+    'fleet': bench_fleet,
+    'slow_lane': bench_slow_lane,
+}
+
+
+def main(args):
+    names = args.benchmarks or sorted(BENCHMARKS)
+    results = {}
+    for name in names:
+        results[name] = BENCHMARKS[name](args)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+
+    # Setup parser
+    parser = argparse.ArgumentParser(description="sshpoller benchmarks")
+    parser.add_argument(
+        "benchmarks",
+        nargs="*",
+        help="Benchmarks to run (default = all): %s" % ', '.join(sorted(BENCHMARKS)),
+    )
+    parser.add_argument(
+        "-n",
+        "--iterations",
+        help="# of iterations",
+        type=int,
+        default=200
+    )
+    parser.add_argument(
+        "-d",
+        "--devices",
+        help="# of mock devices",
+        type=int,
+        default=50
+    )
+    parser.add_argument(
+        "-e",
+        "--engine",
+        help="Poller engine of the fleet benchmark",
+        choices=['process', 'asyncio'],
+        default='process'
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="# of worker processes of the fleet benchmark",
+        type=int,
+        default=4
+    )
+    parser.add_argument(
+        "-i",
+        "--interval",
+        help="Poll interval of the fleet benchmark (sec)",
+        type=float,
+        default=1.0
+    )
+    parser.add_argument(
+        "-t",
+        "--duration",
+        help="Duration of the fleet benchmark (sec)",
+        type=float,
+        default=30.0
+    )
+    parser.add_argument(
+        "--latency",
+        help="Response time of the mock devices per command (sec)",
+        type=float,
+        default=0.0
+    )
+    parser.add_argument(
+        "--scale",
+        help="Size of the mock device outputs, in copies of the fixtures",
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        "--error-rate",
+        help="Probability that a mock device drops the connection on a command",
+        type=float,
+        default=0.0
+    )
+    args = parser.parse_args()
+
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark: %s' % name)
+
+    main(args)
@@ -8,5 +8,9 @@ setup(
     license='',
     author='Simon Lemire',
     author_email='lemire.simon@gmail.com',
-    description='SSH screen scrapper with InfluxDB output support', requires=['netmiko', 'influxdb', 'textfsm']
+    description='SSH screen scrapper with InfluxDB output support', requires=['netmiko', 'influxdb', 'textfsm'],
+    classifiers=[
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
+    ]
 )
@@ -1,33 +1,404 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
 # Import standard python modules
 import argparse
+import asyncio
+from bisect import bisect_left
+from collections import deque, OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from getpass import getpass
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import cProfile
 import csv
+import hashlib
+import heapq
+import io
+from itertools import takewhile
 import json
 import logging
+import os
+from queue import Empty
+import re
+import signal
+from socketserver import ThreadingMixIn
 import sys
-from time import sleep, time
-import tempfile
+import threading
+from time import monotonic, sleep, time
+import zlib
 import yaml
-from multiprocessing import Process, Queue
+from multiprocessing import cpu_count, Process, Queue, Value
 
 # TextFSM module : https://github.com/google/textfsm
 import clitable
+import textfsm
 
 # Netmiko module : https://github.com/ktbyers/netmiko
 from netmiko import ConnectHandler, ssh_exception
+from paramiko import SSHException
 
 # InfluxDB module : https://github.com/influxdata/influxdb-python
 from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+
+# AsyncSSH module : https://github.com/ronf/asyncssh (asyncio engine only)
+try:
+    import asyncssh
+except ImportError:
+    asyncssh = None
+
+# Regex parser, to find the literals of the template rules
+try:
+    import re._parser as sre_parse
+except ImportError:
+    import sre_parse
+
+# Faster JSON encoders for the NDJSON output, if available
+try:
+    import orjson
+
+    def ndjson_dumps(row):
+        return orjson.dumps(row).decode('utf-8')
+except ImportError:
+    try:
+        import ujson
+
+        def ndjson_dumps(row):
+            return ujson.dumps(row, ensure_ascii=False)
+    except ImportError:
+        def ndjson_dumps(row):
+            return json.dumps(row, separators=(',', ':'))
+
+# LibYAML's loader if PyYAML was built with it, for large inventories
+try:
+    YamlLoader = yaml.CSafeLoader
+except AttributeError:
+    YamlLoader = yaml.SafeLoader
+
+# File locks of the spool directories (Unix only)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 CSV_DELIMITER = ','
 
+# Value substitutions ($NAME, ${NAME}) and escaped dollars ($$) in template rules
+TEMPLATE_VARIABLE_RE = re.compile(r'\$\{(\w+)\}|\$(\w+)|\$\$')
+
+# Named groups of the template rules (Values)
+NAMED_GROUP_RE = re.compile(r'\(\?P<\w+>')
+
+# Characters not allowed in Prometheus metric and label names
+PROMETHEUS_INVALID_RE = re.compile(r'[^a-zA-Z0-9_]')
+
+# Errors of a poll cycle meaning the SSH session is lost (netmiko read timeouts are OSErrors)
+SESSION_ERRORS = (OSError, EOFError, SSHException, ssh_exception.NetMikoTimeoutException)
+
+# Max # of items waiting in each queue of the parsing pipeline
+pipeline_queue_size = 10000
+
+# Time (sec) between two checks of the task file for changes (--watch)
+task_file_check_interval = 1.0
+
 # TEXTFSM config settings
 index_file = 'index'
 template_dir = 'templates'
 
+# TextFSM Value regexes that can only match a number, i.e. (\d+) or ([\d.]+)
+NUMERIC_VALUE_RE = re.compile(r'^\((?:\\d|\[(?:\\d|0-9|\\\.|\.|-)+\]|\\\.|[+*?]|\{\d*,?\d*\})+\)$')
+
+
+class FieldSchema:
+    """ Typed conversion of the columns of one template or CSV header
+
+        A column is numeric when its TextFSM Value regex only matches
+        numbers, and text when it's a List. The other columns go through
+        float_if_possible() until they get a number, then they're numeric,
+        or until text_samples values that aren't, then they're text. Numeric
+        columns are converted with float() and text columns are kept as is,
+        instead of trying float() on every value. A numeric column getting a
+        value that isn't a number keeps it as is.
+    """
+
+    text_samples = 20   # Values that aren't numbers (i.e. '-', 'N/A') a column gets before it's text
+
+    def __init__(self, values, names=None):
+        # values is a list of (regex, options), or a column count if unknown
+        if isinstance(values, int):
+            values = [(None, [])] * values
+        self.names = names or ['#%s' % idx for idx in range(len(values))]
+        self.kinds = []
+        for regex, options in values:
+            if 'List' in options:
+                self.kinds.append('text')
+            elif regex and NUMERIC_VALUE_RE.match(regex):
+                self.kinds.append('numeric')
+            else:
+                self.kinds.append(None)
+        self.strings = [0] * len(self.kinds)
+        self.update()
+
+    def update(self):
+        """ Builds the converter tuple from the column kinds """
+
+        self.converters = tuple(
+            numeric_value if kind == 'numeric' else None if kind == 'text' else float_if_possible
+            for kind in self.kinds)
+        self.unknown = [idx for (idx, kind) in enumerate(self.kinds) if kind is None]
+        self.learning = bool(self.unknown)
+
+    def learn(self, values):
+        """ Types the unknown columns from the converted values of a record """
+
+        typed = False
+        for idx in self.unknown:
+            if idx >= len(values):
+                break
+            if isinstance(values[idx], float):
+                self.kinds[idx] = 'numeric'
+                typed = True
+                if self.strings[idx]:
+                    logging.warning('Column %s got a number after %s values that were not, they were written as strings' % (
+                        self.names[idx], self.strings[idx]))
+            elif values[idx]:
+                self.strings[idx] += 1
+                if self.strings[idx] >= self.text_samples:
+                    self.kinds[idx] = 'text'
+                    typed = True
+        if typed:
+            self.update()
+
+    def convert(self, record):
+        """ Returns the converted values of a record """
+
+        values = [convert(value) if convert else value for (convert, value) in zip(self.converters, record)]
+        if self.learning:
+            self.learn(values)
+        return values
+
+
+class TemplateRegistry:
+    """ Per-process cache of compiled TextFSM templates
+
+        The index is read once and each (Platform, Command) pair is resolved
+        to its template only once. Compiled templates are shared by all
+        commands and poll cycles, and are recompiled when their file changes.
+        If every rule of a template requires a literal, lines containing none
+        of them are dropped before parsing as no rule could match them.
+    """
+
+    prefilter = True    # Drop the lines no rule can match before parsing
+
+    def __init__(self, index_file, template_dir):
+        self.index_file = index_file
+        self.template_dir = template_dir
+        self.index = None
+        self.index_mtime = None
+        self.resolved = {}
+        self.templates = {}
+        self.lock = threading.Lock()
+
+    def load_index(self):
+        """ Reads the index file, again only if it changed on disk """
+
+        path = os.path.join(self.template_dir, self.index_file)
+        mtime = os.stat(path).st_mtime
+        if self.index is None or mtime != self.index_mtime:
+            # CliTable provides the command completion used by the index
+            loader = clitable.CliTable()
+            self.index = clitable.IndexTable(loader._PreParse, loader._PreCompile, path)
+            self.index_mtime = mtime
+            self.resolved = {}
+            logging.debug('Template index loaded from %s' % path)
+
+        return self.index
+
+    def resolve(self, attributes):
+        """ Returns the template name(s) matching the (Platform, Command) pair """
+
+        index = self.load_index()
+        key = (attributes['Platform'], attributes['Command'])
+        if key not in self.resolved:
+            row_idx = index.GetRowMatch(attributes)
+            if not row_idx:
+                raise clitable.CliTableError('No template found for attributes: "%s"' % attributes)
+            self.resolved[key] = index.index[row_idx]['Template']
+
+        return self.resolved[key]
+
+    def version(self, attributes):
+        """ Returns the mtimes of the index and of the template(s) matching attributes """
+
+        with self.lock:
+            names = self.resolve(attributes)
+            return (self.index_mtime,) + tuple(
+                os.stat(os.path.join(self.template_dir, name)).st_mtime for name in names.split(':'))
+
+    def get_template(self, name, fields=None):
+        """ Returns the compiled template entry, recompiled if its mtime changed
+            With fields, the template is reduced to these values, see project_template()
+        """
+
+        path = os.path.join(self.template_dir, name)
+        mtime = os.stat(path).st_mtime
+        key = name if fields is None else (name, tuple(fields))
+        entry = self.templates.get(key)
+        if entry is None or entry['mtime'] != mtime:
+            with open(path) as f:
+                template = f.read()
+            if fields is not None:
+                template = project_template(template, fields)
+            fsm = textfsm.TextFSM(io.StringIO(template))
+            schema = FieldSchema([(value.regex, value.OptionNames()) for value in fsm.values],
+                                 [value.name for value in fsm.values])
+            entry = {'fsm': fsm, 'schema': schema, 'prefilter': template_prefilter(fsm),
+                     'mtime': mtime, 'lock': threading.Lock()}
+            self.templates[key] = entry
+            logging.debug('Template %s compiled' % name)
+
+        return entry
+
+    def parse(self, text, attributes, typed=False, fields=None):
+        """ Parses text with the matching template
+            Returns the header and the list of records, with the
+            values converted to their column type if typed is set.
+            fields (lower case value names) limits the values extracted.
+        """
+
+        with self.lock:
+            names = self.resolve(attributes)
+            if ':' in names:
+                entry = None
+            else:
+                entry = self.get_template(names, fields)
+
+        # Several templates for one command need CliTable to merge their tables
+        if entry is None:
+            cli_table = clitable.CliTable(self.index_file, self.template_dir)
+            cli_table.ParseCmd(text, attributes, templates=names)
+            header = list(cli_table.header)
+            columns = range(len(header))
+            if fields is not None:
+                columns = [i for i in columns if header[i].lower() in fields]
+            records = [[row[i] for i in columns] for row in cli_table]
+            if typed:
+                records = [[float_if_possible(value) for value in record] for record in records]
+            return [header[i] for i in columns], records
+
+        if self.prefilter and entry['prefilter'] is not None:
+            matches = entry['prefilter']
+            text = '\n'.join([line for line in text.splitlines() if matches(line)])
+
+        with entry['lock']:
+            fsm = entry['fsm']
+            fsm.Reset()
+            records = fsm.ParseText(text)
+            header = list(fsm.header)
+            if typed:
+                records = [entry['schema'].convert(record) for record in records]
+
+        return header, records
+
+
+def project_template(template, fields):
+    """ Returns the template reduced to the values in fields (lower case names)
+
+        The other values are removed: their regex stays in the rules as a
+        non-capturing group, so rules match the same lines but these values
+        are never extracted. Values with options (i.e. Required, Filldown)
+        are kept as they change which records are made.
+    """
+
+    fsm = textfsm.TextFSM(io.StringIO(template))
+    dropped = dict((value.name, '(?:' + value.regex[1:].replace('$', '$$'))
+                   for value in fsm.values if value.name.lower() not in fields and not value.options)
+
+    def substitute(match):
+        name = match.group(1) or match.group(2)
+        return dropped.get(name, match.group(0))
+
+    lines = []
+    values = True
+    for line in template.splitlines():
+        if values:
+            if not line.strip():
+                values = False
+            elif line.startswith('Value '):
+                tokens = line.split(' ')
+                name = tokens[1] if tokens[2].startswith('(') else tokens[2]
+                if name in dropped:
+                    continue
+        elif line.strip().startswith('^'):
+            line = TEMPLATE_VARIABLE_RE.sub(substitute, line)
+        lines.append(line)
+
+    return '\n'.join(lines) + '\n'
+
+
+def required_literal(regex):
+    """ Returns the longest literal every match of regex contains, None if there's none """
+
+    try:
+        parsed = sre_parse.parse(regex)
+    except Exception:
+        return None
+    if parsed.state.flags & re.IGNORECASE:
+        return None
+
+    runs = []
+
+    def walk(items):
+        run = ''
+        for op, av in items:
+            if op == sre_parse.LITERAL:
+                run += chr(av)
+                continue
+            if op == sre_parse.AT:
+                # Zero-width (^, $, \b...)
+                continue
+            runs.append(run)
+            run = ''
+            if op == sre_parse.SUBPATTERN:
+                # The literals of a (?i:...) group match in any case
+                if not av[1] & re.IGNORECASE:
+                    walk(av[-1])
+            elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[0] >= 1:
+                walk(av[2])
+        runs.append(run)
+
+    walk(parsed)
+    literal = max(runs, key=len)
+    return literal or None
+
+
+def template_prefilter(fsm):
+    """ Returns a function telling if some rule of the template could match a line
+        Looks for the literals the rules require or, if a rule has none, tries
+        all the rules at once with a single regex. None if neither is possible.
+    """
+
+    rules = [rule for state in fsm.states.values() for rule in state]
+    if not rules:
+        return None
+
+    literals = set(required_literal(rule.regex) for rule in rules)
+    if None not in literals:
+        return re.compile('|'.join(re.escape(literal) for literal in sorted(literals))).search
+
+    # Value names are used by several rules, drop them to combine the rules
+    if any('(?P=' in rule.regex for rule in rules):
+        return None
+    try:
+        return re.compile('|'.join('(?:%s)' % NAMED_GROUP_RE.sub('(?:', rule.regex) for rule in rules)).match
+    except re.error:
+        return None
+
+
+# Compiled templates shared by every poller of this process
+template_registry = TemplateRegistry(index_file, template_dir)
+
 
 class SSH_Poller:
     """ SSH Poller class """
@@ -38,9 +409,45 @@ class SSH_Poller:
     db_name = 'db_name'
     db_user = 'root'
     db_password = 'root'
+    db_batch_size = 5000        # Max # of points per write request
+    db_batch_latency = 1.0      # Max time (sec) a point waits before being written
+    db_gzip = False             # Compress write requests
+
+    # Spool settings
+    spool_dir = None                        # Directory of the write-ahead spool (None = write directly)
+    spool_max_bytes = 1024 ** 3             # Disk budget, the oldest points are dropped beyond it
+    spool_segment_size = 16 * 1024 ** 2     # Size of a spool segment file
+    spool_drain_timeout = 30.0              # Max time (sec) a one-shot poll waits for the spool to drain
+
+    # Prometheus exporter settings
+    prometheus_port = 9433          # Port of the /metrics endpoint
+    prometheus_expire = 300.0       # Series not updated for this long (sec) are removed
+
+    # NDJSON output settings
+    ndjson_file = None          # File or pipe the records are written to (None = stdout)
+    ndjson_max_bytes = 0        # Rotate the file beyond this size (0 = never)
+    ndjson_backups = 5          # # of rotated files kept
+
+    # Result buffer settings
+    buffer_max_points = 100000      # Max # of points held before they're written
+    buffer_policy = 'drop_oldest'   # Valid choices: drop_oldest, block
+    buffer_timeout = 5.0            # Max wait (sec) of the block policy before dropping the oldest points
+
+    # Parse cache settings
+    suppress_unchanged = False      # Don't write the points of an output identical to the previous one
+
+    # Session settings
+    reconnect_min_delay = 1.0       # First reconnect backoff (sec)
+    reconnect_max_delay = 300.0     # Max reconnect backoff (sec)
+    max_channels = 1                # Max # of sessions running commands concurrently per device
+
+    # Instrumentation settings
+    profile_dir = None              # Directory of the profiles toggled by SIGUSR2 (None = disabled)
 
     def __init__(self, task):
-        self.data_list = []
+        self.batch = []
+        self._data_list = None
+        self.results = ResultBuffer(self.buffer_max_points, self.buffer_policy, self.buffer_timeout)
         self.hostname = task['hostname']
         self.port = task['port']
         self.username = task['username']
@@ -50,78 +457,232 @@ class SSH_Poller:
         self.command_list = []
         self.precommand_list = task['precommands']
         self.interval = task['interval']
+        self.mode = task.get('mode', 'json')
+        self.max_channels = int(task.get('max_channels') or self.max_channels)
         self.prompt = ''
         self.sock = ConnectHandler
+        self.channels = []
+        self.session_up = False
+        self.down_since = None
+        self.next_reconnect = 0.0
+        self.reconnect_delay = self.reconnect_min_delay
+        self.session_stats = {
+            'handshakes': 0,
+            'handshakes_avoided': 0,
+            'reconnects': 0,
+            'failed_connects': 0,
+            'recovery_time': 0.0,
+        }
 
         for command in task['commands']:
+            # Command with options (YAML mapping)
+            if isinstance(command, dict):
+                options = {
+                    'command': command['command'],
+                    'tag': command.get('tag') or '',
+                    'rates': [name.lower() for name in command.get('rates') or []],
+                    'keep_counters': command.get('keep_counters', True),
+                    'fields': None}
+                if command.get('fields'):
+                    # The tag and the rate counters are always needed
+                    fields = set(name.lower() for name in command['fields']) | set(options['rates'])
+                    if options['tag']:
+                        fields.add(options['tag'].lower())
+                    options['fields'] = sorted(fields)
+                self.command_list.append(options)
             # Command doesn't contain tags attribute
-            if len(command.split(':')) == 1:
+            elif len(command.split(':')) == 1:
                 self.command_list.append({'command': command.split(':')[0], 'tag': ''})
             # Command contains tags attribute
             elif len(command.split(':')) == 2:
                 self.command_list.append({'command': command.split(':')[0], 'tag': command.split(':')[1]})
 
+    def open_channel(self):
+        """ Opens a SSH session to the device and sends the precommands """
+
+        start = monotonic()
+        sock = ConnectHandler(
+            device_type=self.device_type,
+            ip=self.hostname,
+            port=self.port,
+            username=self.username,
+            password=self.password)
+        logging.debug('Connection to %s successful!' % self.hostname)
+        if metrics.enabled:
+            metrics.observe(self.hostname, '', 'connect', monotonic() - start)
+            start = monotonic()
+        self.prompt = sock.find_prompt()
+        if metrics.enabled:
+            metrics.observe(self.hostname, '', 'find_prompt', monotonic() - start)
+
+        if self.prompt:
+            logging.debug('Prompt found: %s' % self.prompt)
+
+            # Send commands after login that won't be parsed
+            if self.precommand_list:
+                for precommand in self.precommand_list:
+                    sock.send_command(precommand)
+        else:
+            logging.debug('No prompt found')
+
+        return sock
+
     def connect(self):
         """ Connects SSH session """
 
         try:
-            self.sock = ConnectHandler(
-                device_type=self.device_type,
-                ip=self.hostname,
-                port=self.port,
-                username=self.username,
-                password=self.password)
-            logging.debug('Connection to %s successful!' % self.hostname)
-            self.prompt = self.sock.find_prompt()
-
-            if self.prompt:
-                logging.debug('Prompt found: %s' % self.prompt)
-
-                # Send commands after login that won't be parsed
-                if self.precommand_list:
-                    for precommand in self.precommand_list:
-                        self.sock.send_command(precommand)
-            else:
-                logging.debug('No prompt found')
+            self.sock = self.open_channel()
 
         except ssh_exception.NetMikoAuthenticationException:
             logging.error('Authentication error, username was %s' % self.username)
             return False
 
-        except:
-            print("Unexpected error:", sys.exc_info()[0])
+        except Exception:
+            # Logged, as stdout may carry the NDJSON records
+            logging.exception('Unexpected error connecting to %s' % self.hostname)
             raise
 
         return True
 
+    def open_channels(self):
+        """ Opens the extra sessions up to max_channels
+            A device refusing a session caps max_channels to the sessions it accepted
+        """
+
+        while 1 + len(self.channels) < min(self.max_channels, len(self.command_list)):
+            try:
+                self.channels.append(self.open_channel())
+            except Exception as e:
+                self.max_channels = 1 + len(self.channels)
+                logging.error('Extra session to %s failed, using %s sessions: %s' % (
+                    self.hostname, self.max_channels, str(e)))
+
+    def close_channels(self):
+        """ Closes the extra sessions """
+
+        for sock in self.channels:
+            try:
+                sock.disconnect()
+            except Exception:
+                pass
+        self.channels = []
+
     def disconnect(self):
         """ Disconnects SSH session """
 
+        self.session_up = False
+        self.close_channels()
         self.sock.disconnect()
         logging.debug('Connection cleaned-up')
 
-    def parse_fsm(self, result, command):
+    def ensure_session(self):
+        """ Makes sure the SSH session is usable before a poll cycle
+            A live session is kept, a dead one is reopened with exponential
+            backoff. Returns False if there's no session for this cycle.
+        """
+
+        if self.session_up:
+            if self.sock.is_alive():
+                self.session_stats['handshakes_avoided'] += 1
+                return True
+            logging.error('Session to %s is dead' % self.hostname)
+            self.session_lost()
+
+        now = monotonic()
+        if now < self.next_reconnect:
+            return False
+
+        self.session_stats['handshakes'] += 1
+        try:
+            connected = self.connect()
+        except Exception as e:
+            logging.error('Connection to %s failed: %s' % (self.hostname, str(e)))
+            connected = False
+
+        if not connected:
+            self.session_stats['failed_connects'] += 1
+            if metrics.enabled:
+                metrics.count(self.hostname, '', 'errors')
+            if self.down_since is None:
+                self.down_since = now
+            self.next_reconnect = now + self.reconnect_delay
+            logging.error('Reconnecting to %s in %s seconds' % (self.hostname, self.reconnect_delay))
+            self.reconnect_delay = min(self.reconnect_delay * 2, self.reconnect_max_delay)
+            return False
+
+        self.session_up = True
+        self.reconnect_delay = self.reconnect_min_delay
+        if self.down_since is not None:
+            self.session_stats['reconnects'] += 1
+            self.session_stats['recovery_time'] = monotonic() - self.down_since
+            logging.info('Session to %s recovered in %.1f seconds' % (self.hostname, self.session_stats['recovery_time']))
+            self.down_since = None
+
+        return True
+
+    def session_lost(self):
+        """ Drops a session that failed, it's reopened on the next cycle """
+
+        self.session_up = False
+        if self.down_since is None:
+            self.down_since = monotonic()
+        if metrics.enabled:
+            metrics.count(self.hostname, '', 'errors')
+        self.close_channels()
+        try:
+            self.sock.disconnect()
+        except Exception:
+            pass
+
+    def session_point(self):
+        """ Returns the session counters as a row for the output """
+
+        return {
+            'command': 'sshpoller_session',
+            'tag': {'host': self.hostname},
+            'fields': dict(self.session_stats),
+            'timestamp': int(time())
+        }
+
+    @property
+    def data_list(self):
+        """ Rows of the current cycle as dictionaries, built on first access """
+
+        if self._data_list is None:
+            self._data_list = [row for item in self.batch for row in item_rows(item)]
+        return self._data_list
+
+    @data_list.setter
+    def data_list(self, rows):
+        self.batch = list(rows)
+        self._data_list = None
+
+    def add_result(self, item):
+        """ Adds a result table (or a single row) to the current cycle """
+
+        self.batch.append(item)
+        self._data_list = None
+
+    def parse_fsm(self, result, command, timestamp=None):
         """ Parses command output through TextFSM """
 
         result = ''.join(result)
-        cli_table = clitable.CliTable(index_file, template_dir)
         attrs = {'Command': command['command'], 'Platform': self.device_type}
 
         try:
-            cli_table.ParseCmd(result, attrs)
+            header, records = template_registry.parse(result, attrs, typed=True, fields=command.get('fields'))
 
             # Timestamp precision is set to 'seconds'
-            timestamp = int(time())
+            if timestamp is None:
+                timestamp = int(time())
 
-            for field in clitable_to_dict(cli_table):
-                data = {}
-                data['tag'] = {'host': self.hostname, 'command': command['tag']}
-                data['command'] = command['command']
-                data['fields'] = dict((k, float_if_possible(v)) for (k, v) in field.items())
-                if command['tag']:
-                    data['tag'][command['tag']] = data['fields'][command['tag']]
-                data['timestamp'] = timestamp
-                self.data_list.append(data)
+            self.add_result(ResultTable(
+                command['command'],
+                [name.lower() for name in header],
+                [tuple(record) for record in records],
+                {'host': self.hostname, 'command': command['tag']},
+                timestamp,
+                tag_column=command['tag'] or None))
 
             return True
 
@@ -129,81 +690,1453 @@ class SSH_Poller:
             logging.error('FSM parsing error: %s' % str(e))
             return False
 
-    def parse_csv(self, result, command):
-        """ Parse command output as csv """
+    def parse_csv(self, result, command, timestamp=None):
+        """ Parse command output as csv
+            Rows are read straight from the output, up to the first empty line
+        """
 
-        # CVS module needs to read from a file, let's create one
-        csvfile = tempfile.TemporaryFile()
+        reader = csv.reader(takewhile(len, iter_lines(result)))
+        header = next(reader, None)
+        if header is None:
+            return True
 
-        result_list = result.split('\n')
+        # Timestamp precision is set to 'seconds'
+        if timestamp is None:
+            timestamp = int(time())
 
-        # Add lines until we find first empty line
-        for line in result_list:
-            if line != "":
-                csvfile.write("%s\n" % line)
-            else:
-                break
+        fields = command.get('fields')
+        if fields is not None:
+            columns = [i for (i, name) in enumerate(header) if name.lower() in fields]
+            header = [header[i] for i in columns]
+            rows = ([row[i] for i in columns] for row in reader)
+        else:
+            rows = reader
+
+        schema = csv_schema(command['command'], header)
+        self.add_result(ResultTable(
+            command['command'],
+            header,
+            [tuple(schema.convert(row)) for row in rows],
+            {'host': self.hostname},
+            timestamp,
+            index_tag='instance'))
 
-        csvfile.seek(0)
+        return True
 
-        reader = csv.DictReader(csvfile)
+    def parse(self, result, command, timestamp=None):
+        """ Parses command output with the parser mode of the task """
 
         # Timestamp precision is set to 'seconds'
-        timestamp = int(time())
+        if timestamp is None:
+            timestamp = int(time())
 
-        for idx, row in enumerate(reader):
-            data = {}
-            data['tag'] = {'host': self.hostname, 'instance': idx}
-            data['command'] = command['command']
-            row = dict((k, float_if_possible(v)) for (k, v) in row.items())
-            data['fields'] = row
-            data['timestamp'] = timestamp
-            self.data_list.append(data)
+        if not metrics.enabled:
+            return self.parse_cached(result, command, timestamp)
+
+        rows = len(self.batch)
+        start = monotonic()
+        parsed = self.parse_cached(result, command, timestamp)
+        metrics.observe(self.hostname, command['command'], 'parse_%s' % self.parser_mode, monotonic() - start)
+        metrics.count(self.hostname, command['command'], 'rows', batch_points(self.batch[rows:]))
+        if not parsed:
+            metrics.count(self.hostname, command['command'], 'errors')
+        return parsed
+
+    def parse_cached(self, result, command, timestamp):
+        """ Parses command output through the parse cache
+            An output identical to the previous one of the command reuses its
+            result tables, or adds nothing if suppress_unchanged is set
+        """
 
-        return True
+        key = (self.hostname, self.port, self.parser_mode, command['command'], command['tag'], repr(command.get('fields')))
+        try:
+            version = None
+            if self.parser_mode == 'fsm':
+                version = template_registry.version({'Command': command['command'], 'Platform': self.device_type})
+            digest = (parse_cache.digest(result), version)
+        except clitable.CliTableError:
+            digest = None
+
+        tables = parse_cache.get(key, digest)
+        if tables is not None:
+            if not self.suppress_unchanged:
+                for table in tables:
+                    self.add_result(table.at(timestamp))
+            return True
 
-    def send_commands(self):
-        """ Send all commands in task
-            Stores all parsed output in self.data_list
+        start = len(self.batch)
+        if self.parser_mode == 'fsm':
+            parsed = self.parse_fsm(result, command, timestamp)
+        elif self.parser_mode == 'csv':
+            parsed = self.parse_csv(result, command, timestamp)
+        else:
+            return None
+
+        if parsed and digest is not None:
+            parse_cache.put(key, digest, self.batch[start:])
+        return parsed
+
+    def run_command(self, sock, command):
+        """ Sends one command, returns its raw output """
+
+        logging.debug('Sending command: %s' % command['command'])
+        start = monotonic()
+        result = sock.send_command(command['command'])
+        if metrics.enabled:
+            metrics.observe(self.hostname, command['command'], 'send_command', monotonic() - start)
+            metrics.count(self.hostname, command['command'], 'bytes', len(result))
+        logging.debug('Output of command: %s' % command['command'])
+        logging.debug(result)
+        return result
+
+    def iter_outputs(self):
+        """ Sends all commands in task
+            Yields each command with its raw output, in the command order
         """
 
+        if self.max_channels > 1 and len(self.command_list) > 1:
+            for item in self.iter_outputs_concurrent():
+                yield item
+            return
+
         for command in self.command_list:
-            logging.debug('Sending command: %s' % command['command'])
-            result = self.sock.send_command(command['command'])
-            logging.debug('Output of command: %s' % command['command'])
-            logging.debug(result)
+            yield command, self.run_command(self.sock, command)
 
-            if self.parser_mode == 'fsm':
-                self.parse_fsm(result, command)
-            elif self.parser_mode == 'csv':
-                self.parse_csv(result, command)
+    def iter_outputs_concurrent(self):
+        """ Sends the commands over up to max_channels sessions at once
+            Outputs are still yielded in the command order
+        """
+
+        self.open_channels()
+        # One thread per session, so a free session is always there for the next command
+        socks = deque([self.sock] + self.channels)
+
+        def run(command):
+            sock = socks.pop()
+            try:
+                return self.run_command(sock, command)
+            finally:
+                socks.append(sock)
+
+        with ThreadPoolExecutor(len(socks)) as executor:
+            for command, result in zip(self.command_list, executor.map(run, self.command_list)):
+                yield command, result
+
+    def send_commands(self, outputs=None, timestamp=None, status=None):
+        """ Send all commands in task
+            Stores the parsed output of this cycle in self.batch
+            and hands it over to the result buffer
+            outputs may be the (command, output) pairs of a cycle already run,
+            and status a function returning rows buffered along with the cycle
+        """
+
+        self.data_list = []
+        for command, result in (self.iter_outputs() if outputs is None else outputs):
+            start = len(self.batch)
+            try:
+                self.parse(result, command, timestamp)
+                if command.get('rates'):
+                    self.data_list = self.batch[:start] + apply_rates(self.batch[start:], self.hostname, command)
+            except Exception as e:
+                # A bad template or tag only loses this command, the session is fine
+                logging.error('Parsing %s from %s failed: %s' % (command['command'], self.hostname, repr(e)))
+                self.data_list = self.batch[:start]
+                if metrics.enabled:
+                    metrics.count(self.hostname, command['command'], 'errors')
+                continue
+            if self.mode == 'ndjson':
+                # Records of each command are written as soon as it's parsed
+                get_sink('ndjson').write(self.batch[start:])
+
+        if self.mode != 'ndjson':
+            self.results.put(self.batch + status() if status is not None else self.batch)
 
     def output_json(self):
         """ Return results in JSON format """
 
         print(json.dumps(self.data_list, indent=2))
+        self.results.get_all()
+
+    def output_sink(self):
+        """ Writes the buffered results to the sink of the output mode """
+
+        sink = get_sink(self.mode)
+        start = monotonic()
+        for batch in self.results.get_all():
+            sink.write(batch)
+            if metrics.enabled:
+                metrics.count(self.hostname, '', 'points', batch_points(batch))
+        if metrics.enabled:
+            metrics.observe(self.hostname, '', 'output_%s' % self.mode, monotonic() - start)
+
+        # Written batches are released
+        self.data_list = []
 
     def output_influxdb(self):
         """ Writes data to the InfluxDB """
 
-        client = InfluxDBClient(self.db_host, self.db_port, self.db_user, self.db_password, self.db_name)
+        writer = poller_influx_writer(self)
+
+        batches = self.results.get_all()
+        if not batches and self.batch:
+            # Rows parsed outside of send_commands()
+            batches = [self.batch]
+        start = monotonic()
+        for batch in batches:
+            writer.write(batch)
+            if metrics.enabled:
+                metrics.count(self.hostname, '', 'points', batch_points(batch))
+        if metrics.enabled:
+            metrics.observe(self.hostname, '', 'output_influxdb', monotonic() - start)
+
+        # Written batches are released
+        self.data_list = []
+
+        # Nothing else will be polled, don't wait for the batch to fill up
+        if not float(self.interval):
+            writer.flush()
+
+
+class ResultTable:
+    """ Parsed output of one command
+
+        The header is held once and the rows are stored as tuples. Row
+        dictionaries are only built on demand (JSON output), while the
+        InfluxDB output serializes the rows straight to line protocol.
+        Each row is tagged with the base tags, plus the value of its
+        tag_column or its position as index_tag if set.
+    """
+
+    __slots__ = ('command', 'header', 'rows', 'tags', 'timestamp', 'tag_column', 'index_tag')
+
+    def __init__(self, command, header, rows, tags, timestamp, tag_column=None, index_tag=None):
+        self.command = command
+        self.header = header
+        self.rows = rows
+        self.tags = tags
+        self.timestamp = timestamp
+        self.tag_column = tag_column
+        self.index_tag = index_tag
+        if tag_column is not None and tag_column not in header:
+            raise KeyError(tag_column)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def at(self, timestamp):
+        """ Returns the same table with another timestamp, the rows are shared """
+
+        return ResultTable(self.command, self.header, self.rows, self.tags, timestamp,
+                           tag_column=self.tag_column, index_tag=self.index_tag)
+
+    def dicts(self):
+        """ Yields the rows in the dictionary format of data_list """
+
+        column = self.header.index(self.tag_column) if self.tag_column is not None else None
+        for idx, row in enumerate(self.rows):
+            data = {}
+            data['tag'] = dict(self.tags)
+            if self.index_tag is not None:
+                data['tag'][self.index_tag] = idx
+            data['command'] = self.command
+            data['fields'] = dict((key, value) for (key, value) in zip(self.header, row) if value is not None)
+            if column is not None:
+                data['tag'][self.tag_column] = row[column]
+            data['timestamp'] = self.timestamp
+            yield data
+
+    def to_line_protocol(self):
+        """ Returns the rows as InfluxDB line protocol strings """
+
+        measurement = escape_lp(self.command)
+        order = sorted(range(len(self.header)), key=self.header.__getitem__)
+        keys = ['%s=' % escape_lp(self.header[i]) for i in order]
+
+        # Tags sorted by key: constant string, column index, or None for the row index
+        tags = dict((key, ',%s=%s' % (escape_lp(key), escape_lp(value)))
+                    for (key, value) in self.tags.items() if value != '')
+        if self.index_tag is not None:
+            tags[self.index_tag] = None
+        if self.tag_column is not None:
+            tags[self.tag_column] = self.header.index(self.tag_column)
+        tags = [(',%s=' % escape_lp(key), tags[key]) for key in sorted(tags)]
+
+        lines = []
+        for idx, row in enumerate(self.rows):
+            tag_str = ''
+            for (prefix, source) in tags:
+                if source is None:
+                    tag_str += '%s%s' % (prefix, idx)
+                elif isinstance(source, int):
+                    if row[source] != '':
+                        tag_str += prefix + escape_lp(row[source])
+                else:
+                    tag_str += source
+            fields = ','.join([key + lp_value(row[i]) for (key, i) in zip(keys, order) if row[i] is not None])
+            if not fields:
+                continue
+            lines.append('%s%s %s %s' % (measurement, tag_str, fields, self.timestamp))
+
+        return lines
+
+
+def item_points(item):
+    """ Returns the number of points of a batch item (result table or row) """
+    return len(item) if isinstance(item, ResultTable) else 1
+
+
+def batch_points(batch):
+    """ Returns the number of points of a batch """
+    return sum(item_points(item) for item in batch)
+
+
+def truncate_batch(batch, max_points):
+    """ Returns the first max_points points of a batch, a result table may be cut """
+
+    truncated = []
+    for item in batch:
+        points = item_points(item)
+        if points > max_points:
+            if max_points and isinstance(item, ResultTable):
+                truncated.append(ResultTable(item.command, item.header, item.rows[:max_points], item.tags,
+                                             item.timestamp, tag_column=item.tag_column, index_tag=item.index_tag))
+            break
+        truncated.append(item)
+        max_points -= points
+    return truncated
+
+
+def item_rows(item):
+    """ Returns the rows of a batch item as dictionaries """
+    return item.dicts() if isinstance(item, ResultTable) else [item]
+
+
+class ParseCache:
+    """ Per-process LRU cache of the last parsed output of each (host, command)
+
+        Outputs are identified by a hash of the raw text, along with the
+        template mtimes for TextFSM, so an output identical to the previous
+        one of the command skips parsing and field conversion. Holds at most
+        max_entries commands, max_entries = 0 disables the cache.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def digest(self, result):
+        """ Returns the hash of a raw output """
+
+        if not isinstance(result, bytes):
+            result = ''.join(result).encode('utf-8')
+        return hashlib.md5(result).digest()
+
+    def get(self, key, digest):
+        """ Returns the tables of the command if its last output had the same digest """
+
+        if not self.max_entries or digest is None:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != digest:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, digest, tables):
+        """ Stores the tables parsed from the last output of the command """
+
+        if not self.max_entries:
+            return
+        with self.lock:
+            self.entries[key] = (digest, tables)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        """ Returns the cache counters """
+
+        return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+# Last parsed outputs of this process
+parse_cache = ParseCache()
+
+
+class RateStore:
+    """ Previous counter samples of each row, to compute rates and deltas
+
+        A sample is the timestamp and the tuple of counter values, keyed by
+        (host, command), then by row tag. The row tag is the value of the tag
+        column, or the row index for untagged tables. A counter lower than its
+        previous value wrapped if the previous value was in the upper half of
+        its 32-bit (or 64-bit) range, otherwise it was reset (device reboot or
+        cleared counters) and the sample only becomes the new baseline.
+        Rows missing from the last stale_cycles tables of their command (i.e.
+        removed interfaces) are forgotten, and so are the commands of devices
+        not polled for expire seconds.
+    """
+
+    stale_cycles = 3        # Rows missing from this many tables in a row are forgotten
+    expire = 3600.0         # Commands not sampled for this long (sec) are forgotten
+    sweep_interval = 60.0   # Min time (sec) between two checks for expired commands
+
+    def __init__(self):
+        self.samples = {}
+        self.times = {}
+        self.last_sweep = 0.0
+        self.lock = threading.Lock()
+        self.wraps = 0
+        self.resets = 0
+
+    def delta(self, value, previous):
+        """ Returns the increase of a counter, None if it was reset """
+
+        delta = value - previous
+        if delta >= 0:
+            return delta
+        modulus = 2 ** 32 if previous < 2 ** 32 else 2 ** 64
+        if previous >= modulus / 2:
+            self.wraps += 1
+            return delta + modulus
+        self.resets += 1
+        return None
+
+    def apply(self, table, host, counters, keep_counters=True):
+        """ Returns the table with <counter>_delta and <counter>_rate columns
+            Rates are per second, both are None (not written) on the first
+            sample of a row, after a reset or for non numeric values
+        """
+
+        columns = [table.header.index(name) for name in counters if name in table.header]
+        if not columns:
+            return table
+        names = [table.header[i] for i in columns]
+        if table.tag_column is not None:
+            tag = table.header.index(table.tag_column)
+
+        kept = range(len(table.header))
+        if not keep_counters:
+            kept = [i for i in kept if i not in columns]
+        header = [table.header[i] for i in kept]
+        header += ['%s_delta' % name for name in names] + ['%s_rate' % name for name in names]
+
+        rows = []
+        with self.lock:
+            samples = self.samples.setdefault((host, table.command), {})
+            times = self.times.setdefault((host, table.command), [])
+            if not times or table.timestamp > times[-1]:
+                times.append(table.timestamp)
+                del times[:-self.stale_cycles]
+
+            for idx, row in enumerate(table.rows):
+                key = row[tag] if table.tag_column is not None else idx
+                sample = tuple(row[i] for i in columns)
+                previous = samples.get(key)
+                samples[key] = (table.timestamp, sample)
+
+                deltas = [None] * len(columns)
+                if previous is not None and table.timestamp > previous[0]:
+                    for n, (value, last) in enumerate(zip(sample, previous[1])):
+                        if isinstance(value, float) and isinstance(last, float):
+                            deltas[n] = self.delta(value, last)
+                elapsed = float(table.timestamp - previous[0]) if previous is not None else None
+                rates = [delta / elapsed if delta is not None else None for delta in deltas]
+                rows.append(tuple(row[i] for i in kept) + tuple(deltas) + tuple(rates))
+
+            if len(times) == self.stale_cycles and len(samples) > len(table.rows):
+                for key in [key for (key, sample) in samples.items() if sample[0] < times[0]]:
+                    del samples[key]
+            self.sweep(table.timestamp)
+
+        return ResultTable(table.command, header, rows, table.tags, table.timestamp,
+                           tag_column=table.tag_column, index_tag=table.index_tag)
+
+    def sweep(self, now):
+        """ Forgets the commands not sampled for expire seconds, called with the lock held """
+
+        if now - self.last_sweep < self.sweep_interval:
+            return
+        self.last_sweep = now
+        for key in [key for (key, times) in self.times.items() if now - times[-1] > self.expire]:
+            del self.samples[key]
+            del self.times[key]
+
+    def forget(self, host):
+        """ Forgets the samples of a device """
+
+        with self.lock:
+            for key in [key for key in self.samples if key[0] == host]:
+                del self.samples[key]
+                del self.times[key]
+
+
+# Previous counter samples of the devices polled by this process
+rate_store = RateStore()
+
+
+def apply_rates(batch, host, command):
+    """ Adds the rates of the counters listed by the command to its result tables """
+
+    if not command.get('rates'):
+        return batch
+    return [rate_store.apply(item, host, command['rates'], command.get('keep_counters', True))
+            if isinstance(item, ResultTable) else item for item in batch]
+
+
+class StageMetrics:
+    """ Timing histograms and counters of the poll stages, per device and command
+
+        Stages are connect, find_prompt, send_command, parse_<parser mode>
+        and output_<mode>. Counters are the bytes received, rows parsed,
+        points written and errors. Call sites check enabled before timing
+        anything, so a disabled instance costs an attribute lookup per stage.
+    """
+
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0)  # Upper bounds (sec)
+    report_interval = 60.0  # Min time (sec) between two summaries in the log
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.timings = {}
+        self.counters = {}
+        self.last_report = None
+        # Extra sessions (max_channels) record from their threads
+        self.lock = threading.Lock()
+
+    def observe(self, host, command, stage, seconds):
+        """ Adds a stage duration to its histogram """
+
+        with self.lock:
+            timings = self.timings.setdefault(host, {})
+            timing = timings.get((command, stage))
+            if timing is None:
+                # count, total, max, then the count of each bucket (the last one is +Inf)
+                timing = timings[(command, stage)] = [0, 0.0, 0.0] + [0] * (len(self.buckets) + 1)
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+            timing[3 + bisect_left(self.buckets, seconds)] += 1
+
+    def count(self, host, command, name, n=1):
+        """ Adds n to a counter of the command (empty for the device stages) """
+
+        with self.lock:
+            counters = self.counters.setdefault(host, {}).setdefault(command, {})
+            counters[name] = counters.get(name, 0) + n
+
+    def quantile(self, timing, q):
+        """ Returns the upper bound of the bucket holding the q quantile, capped by the max """
+
+        rank = q * timing[0]
+        seen = 0
+        for i, n in enumerate(timing[3:]):
+            seen += n
+            if seen >= rank and n:
+                return min(self.buckets[i], timing[2]) if i < len(self.buckets) else timing[2]
+        return timing[2]
+
+    def points(self, host):
+        """ Returns the timings (sshpoller_stage) and counters (sshpoller_command) of a device as rows """
+
+        if not self.enabled:
+            return []
+
+        # Poll threads keep recording, work on a copy
+        with self.lock:
+            timings = [(key, list(timing)) for key, timing in self.timings.get(host, {}).items()]
+            commands = [(command, dict(counters)) for command, counters in self.counters.get(host, {}).items()]
+
+        timestamp = int(time())
+        rows = []
+        for (command, stage), timing in timings:
+            rows.append({
+                'command': 'sshpoller_stage',
+                'tag': {'host': host, 'cmd': command, 'stage': stage},
+                'fields': {
+                    'count': timing[0],
+                    'total': timing[1],
+                    'max': timing[2],
+                    'p50': self.quantile(timing, 0.5),
+                    'p99': self.quantile(timing, 0.99),
+                },
+                'timestamp': timestamp
+            })
+        for command, counters in commands:
+            rows.append({'command': 'sshpoller_command', 'tag': {'host': host, 'cmd': command},
+                         'fields': counters, 'timestamp': timestamp})
+        return rows
+
+    def summary(self):
+        """ Returns the timings and counters of every device, summed per stage and per counter """
+
+        stages = {}
+        counters = {}
+        # Poll threads keep recording, sum under the lock
+        with self.lock:
+            for timings in self.timings.values():
+                for (command, stage), timing in timings.items():
+                    total = stages.setdefault(stage, [0, 0.0, 0.0] + [0] * (len(self.buckets) + 1))
+                    total[0] += timing[0]
+                    total[1] += timing[1]
+                    total[2] = max(total[2], timing[2])
+                    for i, n in enumerate(timing[3:]):
+                        total[3 + i] += n
+
+            for commands in self.counters.values():
+                for values in commands.values():
+                    for name, value in values.items():
+                        counters[name] = counters.get(name, 0) + value
+
+        return dict((stage, {
+            'count': timing[0],
+            'avg': timing[1] / timing[0],
+            'p99': self.quantile(timing, 0.99),
+            'max': timing[2],
+        }) for stage, timing in stages.items()), counters
+
+    def report(self, now=None):
+        """ Logs the summary, at most every report_interval seconds """
+
+        if not self.enabled:
+            return
+        now = monotonic() if now is None else now
+        if self.last_report is None:
+            self.last_report = now
+        if now - self.last_report < self.report_interval:
+            return
+
+        self.last_report = now
+        stages, counters = self.summary()
+        logging.info('Stages: %s' % ', '.join('%s %s x %.3fs (p99 %.3fs, max %.3fs)' % (
+            stage, timing['count'], timing['avg'], timing['p99'], timing['max']) for stage, timing in sorted(stages.items())))
+        logging.info('Counters: %s' % ', '.join('%s %s' % item for item in sorted(counters.items())))
+
+
+# Stage timings of the devices polled by this process
+metrics = StageMetrics()
+
+
+class Profiler:
+    """ cProfile of a process, toggled by SIGUSR2
+
+        The first signal starts profiling, the next one writes the profile to
+        directory as sshpoller-<pid>-<n>.prof (see pstats or snakeviz).
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.profile = None
+        self.dumps = 0
+
+    def install(self):
+        signal.signal(signal.SIGUSR2, self.toggle)
+
+    def toggle(self, *args):
+        if self.profile is None:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+            logging.info('Profiling process %s' % os.getpid())
+            return
+
+        self.profile.disable()
+        self.dumps += 1
+        path = os.path.join(self.directory, 'sshpoller-%s-%s.prof' % (os.getpid(), self.dumps))
+        self.profile.dump_stats(path)
+        self.profile = None
+        logging.info('Profile written to %s' % path)
+
+
+def install_profiler(directory):
+    """ Lets SIGUSR2 toggle the profiling of this process, if a profile directory is set """
+
+    if directory and hasattr(signal, 'SIGUSR2'):
+        Profiler(directory).install()
+
+
+class ResultBuffer:
+    """ Bounded buffer of per-cycle result batches
+
+        Each poll cycle hands its rows over as one batch, and batches are
+        released once written. At most max_points rows are held: the
+        'drop_oldest' policy discards the oldest batches to make room, while
+        'block' makes the poller wait for the writer (backpressure), up to
+        timeout seconds before the oldest batches are discarded anyway.
+        Blocking only helps when another thread drains the buffer.
+    """
+
+    def __init__(self, max_points=100000, policy='drop_oldest', timeout=None):
+        self.max_points = max_points
+        self.policy = policy
+        self.timeout = timeout
+        self.batches = deque()
+        self.points = 0
+        self.dropped = 0
+        self.cond = threading.Condition()
+
+    def put(self, batch):
+        """ Adds a batch, making room according to the policy """
+
+        points = batch_points(batch)
+        if points > self.max_points:
+            batch = truncate_batch(batch, self.max_points)
+            logging.error('Batch of %s points over the buffer limit, dropped its last %s points' % (
+                points, points - self.max_points))
+            self.dropped += points - self.max_points
+            points = self.max_points
+
+        with self.cond:
+            if self.policy == 'block':
+                deadline = None if self.timeout is None else time() + self.timeout
+                while self.points + points > self.max_points:
+                    remaining = None if deadline is None else deadline - time()
+                    if remaining is not None and remaining <= 0:
+                        logging.error('Result buffer still full after %ss' % self.timeout)
+                        break
+                    self.cond.wait(remaining)
+
+            while self.points + points > self.max_points:
+                oldest, oldest_points = self.batches.popleft()
+                self.points -= oldest_points
+                self.dropped += oldest_points
+                logging.error('Result buffer full, dropped %s points' % oldest_points)
+
+            self.batches.append((batch, points))
+            self.points += points
+
+    def get_all(self):
+        """ Removes and returns all buffered batches """
+
+        with self.cond:
+            batches = [batch for (batch, points) in self.batches]
+            self.batches.clear()
+            self.points = 0
+            self.cond.notify_all()
+
+        return batches
+
+
+class InfluxWriter:
+    """ Buffered InfluxDB writer
+
+        Points are serialized to line protocol and sent in batches of up to
+        batch_size points. A background thread writes partial batches once
+        their oldest point has waited max_latency seconds. With a spool
+        directory, batches are appended to the spool, which writes them.
+    """
+
+    def __init__(self, host, port, user, password, database, batch_size=5000, max_latency=1.0, gzip=False,
+                 spool_dir=None, spool_max_bytes=1024 ** 3, spool_segment_size=16 * 1024 ** 2,
+                 spool_drain_timeout=30.0):
+        self.client = InfluxDBClient(host, port, user, password, database, gzip=gzip)
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.lines = []
+        self.oldest = None
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.points = 0
+        self.flusher = None
+        self.spool = None
+        self.spool_drain_timeout = spool_drain_timeout
+        if spool_dir:
+            self.spool = Spool(claim_spool_dir(spool_dir), self.write_lines, batch_size=batch_size,
+                               segment_size=spool_segment_size, max_bytes=spool_max_bytes)
+
+    def write(self, data_list):
+        """ Queues points and sends every full batch """
+
+        lines = []
+        for item in data_list:
+            if isinstance(item, ResultTable):
+                lines.extend(item.to_line_protocol())
+            else:
+                lines.append(to_line_protocol(item))
+        with self.lock:
+            if not self.lines:
+                self.oldest = time()
+            self.lines.extend(lines)
+            batches = []
+            while len(self.lines) >= self.batch_size:
+                batches.append(self.lines[:self.batch_size])
+                del self.lines[:self.batch_size]
+
+        for batch in batches:
+            self.send(batch)
+
+        if self.flusher is None and self.max_latency > 0:
+            self.flusher = threading.Thread(target=self.run)
+            self.flusher.daemon = True
+            self.flusher.start()
+
+    def flush(self):
+        """ Sends all queued points
+            With a spool, waits up to spool_drain_timeout for it to be written
+        """
+
+        with self.lock:
+            lines = self.lines
+            self.lines = []
+
+        for i in range(0, len(lines), self.batch_size):
+            self.send(lines[i:i + self.batch_size])
+
+        if self.spool is not None and not self.spool.drain(self.spool_drain_timeout):
+            logging.error('InfluxDB spool not drained, points are kept in %s' % self.spool.directory)
+
+    def send(self, lines):
+        """ Sends one batch of lines, through the spool if there's one """
+
+        if self.spool is not None:
+            self.spool.append(lines)
+        else:
+            self.write_lines(lines)
+
+    def write_lines(self, lines):
+        """ Writes one batch of lines in a single request """
+
+        self.client.write_points(lines, time_precision='s', protocol='line')
+        self.requests += 1
+        self.points += len(lines)
+        logging.debug('Wrote %s points to InfluxDB' % len(lines))
+
+    def run(self):
+        """ Flushes partial batches older than max_latency """
+
+        while True:
+            sleep(self.max_latency / 2.0)
+            if self.lines and time() - self.oldest >= self.max_latency:
+                try:
+                    self.flush()
+                except Exception as e:
+                    logging.error('InfluxDB write error: %s' % str(e))
+
+
+class Spool:
+    """ Write-ahead log of line protocol points, drained to InfluxDB
+
+        The writer only appends batches to segment files of about
+        segment_size bytes. A background thread sends them at its own pace,
+        retrying with backoff while InfluxDB is down, and records the
+        position of the last point written in a checkpoint file, so a
+        restarted poller resumes from there. A crash between a write and its
+        checkpoint sends that batch again, which is harmless as InfluxDB
+        stores a point (same series and timestamp) only once. Beyond
+        max_bytes on disk, the oldest segment is dropped. A batch InfluxDB
+        rejects (4xx, i.e. a field type conflict) is moved to the rejected
+        file instead, as sending it again would fail the same way.
+    """
+
+    retry_min_delay = 1.0       # First retry delay (sec) after a failed write
+    retry_max_delay = 60.0      # Max retry delay (sec)
+
+    def __init__(self, directory, send, batch_size=5000, segment_size=16 * 1024 ** 2, max_bytes=1024 ** 3):
+        self.directory = directory
+        self.send = send
+        self.batch_size = batch_size
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.cond = threading.Condition()
+        self.running = True
+        self.appended = 0
+        self.sent = 0
+        self.dropped = 0
+        self.errors = 0
+        self.rejected = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.segments = sorted(int(name[:-3]) for name in os.listdir(directory) if name.endswith('.lp'))
+        if not self.segments:
+            self.segments = [0]
+        self.checkpoint = self.read_checkpoint()
+        self.file = open(self.segment_path(self.segments[-1]), 'ab')
+        self.truncate_partial()
+        self.size = sum(os.path.getsize(self.segment_path(segment)) for segment in self.segments)
+
+        self.flusher = threading.Thread(target=self.run)
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, '%010d.lp' % segment)
+
+    def read_checkpoint(self):
+        """ Returns the (segment, offset) of the next point to send """
+
+        try:
+            with open(os.path.join(self.directory, 'checkpoint')) as f:
+                segment, offset = [int(value) for value in f.read().split()]
+        except (IOError, OSError, ValueError):
+            return (self.segments[0], 0)
+        if segment < self.segments[0]:
+            return (self.segments[0], 0)
+        return (segment, offset)
+
+    def write_checkpoint(self):
+        path = os.path.join(self.directory, 'checkpoint')
+        with open(path + '.tmp', 'w') as f:
+            f.write('%s %s\n' % self.checkpoint)
+        os.rename(path + '.tmp', path)
+
+    def truncate_partial(self):
+        """ Drops the incomplete last line an interrupted append may have left """
+
+        end = self.file.seek(0, os.SEEK_END)
+        with open(self.segment_path(self.segments[-1]), 'rb') as f:
+            data = f.read()
+        if data and not data.endswith(b'\n'):
+            self.file.truncate(data.rfind(b'\n') + 1)
+            self.file.seek(0, os.SEEK_END)
+            logging.error('Spool segment %s truncated by %s bytes' % (self.segments[-1], end - data.rfind(b'\n') - 1))
+
+    def append(self, lines):
+        """ Appends a batch of lines to the spool """
+
+        data = ('\n'.join(lines) + '\n').encode('utf-8')
+        with self.cond:
+            if self.file.tell() >= self.segment_size:
+                self.rotate()
+            self.file.write(data)
+            self.file.flush()
+            self.size += len(data)
+            self.appended += len(lines)
+            while self.size > self.max_bytes and len(self.segments) > 1:
+                self.drop_oldest()
+            self.cond.notify()
+
+    def rotate(self):
+        """ Starts a new segment """
+
+        self.file.close()
+        self.segments.append(self.segments[-1] + 1)
+        self.file = open(self.segment_path(self.segments[-1]), 'ab')
+
+    def drop_oldest(self):
+        """ Deletes the oldest segment to stay within the disk budget """
+
+        segment = self.segments.pop(0)
+        path = self.segment_path(segment)
+        size = os.path.getsize(path)
+        os.remove(path)
+        self.size -= size
+        if self.checkpoint[0] <= segment:
+            self.dropped += 1
+            logging.error('Spool over %s bytes, dropped unsent segment %s' % (self.max_bytes, segment))
+            self.checkpoint = (self.segments[0], 0)
+            self.write_checkpoint()
+
+    def pending(self):
+        """ Returns True if some points haven't been sent yet """
+
+        return self.checkpoint != (self.segments[-1], self.file.tell())
+
+    def read_batch(self):
+        """ Returns up to batch_size lines from the checkpoint, with the position after them """
+
+        with self.cond:
+            segment, offset = self.checkpoint
+            last = segment == self.segments[-1]
+            if not last and offset >= os.path.getsize(self.segment_path(segment)):
+                # Segment fully sent, move on to the next one
+                self.segments.remove(segment)
+                self.size -= offset
+                os.remove(self.segment_path(segment))
+                self.checkpoint = (self.segments[0], 0)
+                self.write_checkpoint()
+                return self.read_batch()
+
+        lines = []
+        with open(self.segment_path(segment), 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                lines.append(line[:-1].decode('utf-8'))
+                offset += len(line)
+                if len(lines) >= self.batch_size:
+                    break
+
+        return lines, (segment, offset)
+
+    def retryable(self, error):
+        """ Returns True if sending the batch again may work: connection errors, 5xx and 429 """
+
+        if isinstance(error, InfluxDBClientError):
+            return error.code == 429
+        return isinstance(error, (InfluxDBServerError, IOError, OSError))
+
+    def reject(self, lines, error):
+        """ Moves a batch InfluxDB won't take to the rejected file """
+
+        self.rejected += len(lines)
+        logging.error('InfluxDB rejected %s points, moved to the rejected file: %s' % (len(lines), str(error)))
+        path = os.path.join(self.directory, 'rejected.lines')
+        if os.path.exists(path) and os.path.getsize(path) >= self.segment_size:
+            os.rename(path, path + '.1')
+        with open(path, 'ab') as f:
+            f.write(('\n'.join(lines) + '\n').encode('utf-8'))
+
+    def run(self):
+        """ Sends the spooled points until stop() """
+
+        delay = self.retry_min_delay
+        while self.running:
+            try:
+                lines, position = self.read_batch()
+            except (IOError, OSError) as e:
+                # The segment was dropped (drop_oldest) since the checkpoint was read
+                logging.debug('Spool segment gone, reading from the new checkpoint: %s' % str(e))
+                continue
+            if not lines:
+                with self.cond:
+                    if self.running and not self.pending():
+                        self.cond.wait(1.0)
+                continue
+
+            try:
+                self.send(lines)
+            except Exception as e:
+                self.errors += 1
+                if not self.retryable(e):
+                    self.reject(lines, e)
+                else:
+                    logging.error('InfluxDB write error, retrying in %s seconds: %s' % (delay, str(e)))
+                    with self.cond:
+                        self.cond.wait(delay)
+                    delay = min(delay * 2, self.retry_max_delay)
+                    continue
+
+            delay = self.retry_min_delay
+            with self.cond:
+                # Unless the segment was dropped meanwhile
+                if position[0] in self.segments:
+                    self.checkpoint = position
+                    self.write_checkpoint()
+                    self.sent += len(lines)
+                self.cond.notify_all()
+
+    def drain(self, timeout):
+        """ Waits until every point is sent, returns False on timeout """
+
+        end = time() + timeout
+        with self.cond:
+            while self.pending():
+                if time() >= end:
+                    return False
+                self.cond.wait(min(end - time(), 0.1))
+        return True
+
+    def stop(self):
+        """ Stops the flusher, unsent points stay on disk """
+
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.flusher.join()
+        self.file.close()
+
+
+def claim_spool_dir(base_dir):
+    """ Returns the first spool directory under base_dir not used by another process
+        The lock is held until the process exits
+    """
+
+    slot = 0
+    while True:
+        directory = os.path.join(base_dir, str(slot))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if fcntl is None:
+            return directory
+        lock = open(os.path.join(directory, 'lock'), 'w')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            lock.close()
+            slot += 1
+            continue
+        spool_locks.append(lock)
+        return directory
+
+
+# Lock files of the spool directories claimed by this process
+spool_locks = []
+
+# InfluxDB writers of this process, keyed by connection settings
+influx_writers = {}
+
+
+def get_influx_writer(host, port, user, password, database, **kwargs):
+    """ Returns the writer of this process for these connection settings """
+
+    key = (os.getpid(), host, port, user, database)
+    if key not in influx_writers:
+        influx_writers[key] = InfluxWriter(host, port, user, password, database, **kwargs)
+
+    return influx_writers[key]
+
+
+class NdjsonWriter:
+    """ Writes NDJSON records to a file, a pipe or stdout
+
+        Each write is a whole number of records, flushed at once. A regular
+        file is rotated (file.1, file.2...) once it exceeds max_bytes.
+    """
+
+    def __init__(self, path=None, max_bytes=0, backups=5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.lock = threading.Lock()
+        self.records = 0
+        self.open()
+
+    def open(self):
+        if self.path in (None, '-'):
+            self.file = sys.stdout
+            self.rotate_size = 0
+        else:
+            self.file = open(self.path, 'a')
+            # Pipes are never rotated
+            self.rotate_size = self.max_bytes if os.path.isfile(self.path) else 0
+        self.size = self.file.tell() if self.rotate_size else 0
+
+    def write(self, data):
+        """ Writes a chunk of records """
+
+        if not data:
+            return
+        with self.lock:
+            self.file.write(data)
+            self.file.flush()
+            self.records += data.count('\n')
+            if self.rotate_size:
+                self.size += len(data)
+                if self.size >= self.rotate_size:
+                    self.rotate()
+
+    def rotate(self):
+        """ Renames the file to file.1 (file.1 to file.2 and so on) and reopens it """
+
+        self.file.close()
+        for n in range(self.backups - 1, 0, -1):
+            if os.path.exists('%s.%s' % (self.path, n)):
+                os.rename('%s.%s' % (self.path, n), '%s.%s' % (self.path, n + 1))
+        if self.backups:
+            os.rename(self.path, '%s.1' % self.path)
+        else:
+            os.remove(self.path)
+        self.open()
+
+
+class NdjsonQueue:
+    """ Sends NDJSON records to the writer process of the workers """
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def write(self, data):
+        if data:
+            self.queue.put(data)
+
+
+def ndjson_records(batch):
+    """ Returns the rows of a batch as NDJSON records """
+
+    return ''.join(ndjson_dumps(row) + '\n' for item in batch for row in item_rows(item))
+
+
+# NDJSON output of this process, the writer process' queue in workers
+ndjson_output = None
+
+
+def get_ndjson_output():
+    """ Returns the NDJSON output of this process """
+
+    global ndjson_output
+    if ndjson_output is None:
+        ndjson_output = NdjsonWriter(SSH_Poller.ndjson_file, SSH_Poller.ndjson_max_bytes, SSH_Poller.ndjson_backups)
+    return ndjson_output
+
+
+class Sink:
+    """ Output of the parsed results
+
+        A sink gets the result batches of every poll cycle through write().
+        Each process has one sink per output mode, see get_sink().
+    """
+
+    def write(self, batch):
+        """ Outputs a batch of result tables and rows """
+        raise NotImplementedError
+
+    def flush(self):
+        """ Outputs anything still held """
+        pass
+
+
+class JsonSink(Sink):
+    """ Prints each batch as a JSON list """
+
+    def write(self, batch):
+        print(json.dumps([row for item in batch for row in item_rows(item)], indent=2))
+
+
+class NdjsonSink(Sink):
+    """ Writes one NDJSON record per row
+        Records already encoded by a worker process are written as is
+    """
+
+    def write(self, batch):
+        get_ndjson_output().write(batch if isinstance(batch, str) else ndjson_records(batch))
+
+
+class InfluxSink(Sink):
+    """ Writes the points to InfluxDB, with the settings of the SSH_Poller class """
+
+    def write(self, batch):
+        poller_influx_writer(SSH_Poller).write(batch)
+
+    def flush(self):
+        poller_influx_writer(SSH_Poller).flush()
+
+
+class QueueSink(Sink):
+    """ Sends the batches of a worker process to the process holding the sink """
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def write(self, batch):
+        if batch:
+            self.queue.put(batch)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class PrometheusSink(Sink):
+    """ Latest value of each series, exposed on /metrics for Prometheus
+
+        Each numeric field of a row is a series named <command>_<field>,
+        labelled with the tags of the row. The exposition line of a series
+        is rendered when its value changes, and the text of a metric only
+        when one of its series changed, so a scrape mostly joins cached
+        strings. Series not updated for expire seconds are removed.
+    """
 
-        # TODO: Refactor to batch to optimize writes to the DB
-        for data in self.data_list:
+    def __init__(self, port=9433, expire=300.0, address=''):
+        self.expire = expire
+        self.metrics = {}       # metric name -> {'series': {labels: [prefix, value, line, last_seen]}, 'text': str}
+        self.names = {}         # (measurement, field) -> metric name, tag -> label name
+        self.lock = threading.Lock()
+        self.last_sweep = None
+        self.server = None
+        if port is not None:
+            self.serve(address, port)
 
-            measurement = data['command']
+    def serve(self, address, port):
+        """ Starts the HTTP server of /metrics """
 
-            # Build JSON body for the REST API call
-            json_body = [
-                {
-                    'measurement': measurement,
-                    'tags': data['tag'],
-                    'fields': data['fields'],
-                    'time': data['timestamp']
-                }
-            ]
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = sink.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((address, port), Handler)
+        self.port = self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        logging.info('Prometheus metrics served on port %s' % self.port)
+
+    def metric_name(self, measurement, field):
+        """ Returns the metric name of a field, made of valid characters """
+
+        key = (measurement, field)
+        if key not in self.names:
+            name = PROMETHEUS_INVALID_RE.sub('_', '%s_%s' % (measurement, field))
+            self.names[key] = '_' + name if name[0].isdigit() else name
+        return self.names[key]
+
+    def label_name(self, key):
+        """ Returns a label name made of valid characters """
+
+        if key not in self.names:
+            self.names[key] = PROMETHEUS_INVALID_RE.sub('_', key)
+        return self.names[key]
+
+    def update(self, name, labels, value, now):
+        """ Sets the value of a series """
+
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = {'series': {}, 'text': None}
+        series = metric['series'].get(labels)
+        if series is None:
+            prefix = '%s{%s}' % (name, ','.join('%s="%s"' % (self.label_name(key), prometheus_escape(text))
+                                                for (key, text) in labels))
+            series = metric['series'][labels] = [prefix, None, None, now]
+        series[3] = now
+        if series[1] != value or series[2] is None:
+            series[1] = value
+            series[2] = '%s %s\n' % (series[0], prometheus_value(value))
+            metric['text'] = None
+
+    def write(self, batch, now=None):
+        if now is None:
+            now = monotonic()
+        with self.lock:
+            for item in batch:
+                if isinstance(item, ResultTable):
+                    self.write_table(item, now)
+                else:
+                    labels = tuple(sorted((key, str(value)) for (key, value) in item['tag'].items() if value != ''))
+                    for field, value in item['fields'].items():
+                        if isinstance(value, (int, float)):
+                            self.update(self.metric_name(item['command'], field), labels, value, now)
+            self.sweep_due(now)
+
+    def sweep_due(self, now):
+        """ Sweeps the series every tenth of expire (10 seconds at most), called with the lock held """
+
+        if self.last_sweep is None:
+            self.last_sweep = now
+        elif now - self.last_sweep >= min(self.expire / 10.0, 10.0):
+            self.sweep(now)
+
+    def write_table(self, table, now):
+        """ Updates the series of a result table """
+
+        base = [(key, str(value)) for (key, value) in table.tags.items() if value != '']
+        tag = table.header.index(table.tag_column) if table.tag_column is not None else None
+        names = [self.metric_name(table.command, field) for field in table.header]
+        for idx, row in enumerate(table.rows):
+            labels = list(base)
+            if table.index_tag is not None:
+                labels.append((table.index_tag, str(idx)))
+            if tag is not None and row[tag] != '':
+                labels.append((table.tag_column, str(row[tag])))
+            labels = tuple(sorted(labels))
+            for name, value in zip(names, row):
+                if isinstance(value, (int, float)):
+                    self.update(name, labels, value, now)
+
+    def sweep(self, now):
+        """ Removes the series not updated for expire seconds """
+
+        self.last_sweep = now
+        limit = now - self.expire
+        for name in list(self.metrics):
+            metric = self.metrics[name]
+            expired = [labels for (labels, series) in metric['series'].items() if series[3] < limit]
+            for labels in expired:
+                del metric['series'][labels]
+            if expired:
+                metric['text'] = None
+                if not metric['series']:
+                    del self.metrics[name]
+
+    def render(self, now=None):
+        """ Returns the exposition text of all the series
+            Expired series are removed first, even if no device writes anymore
+        """
+
+        if now is None:
+            now = monotonic()
+        with self.lock:
+            self.sweep_due(now)
+            texts = []
+            for name in sorted(self.metrics):
+                metric = self.metrics[name]
+                if metric['text'] is None:
+                    metric['text'] = '# TYPE %s gauge\n%s' % (
+                        name, ''.join(series[2] for series in metric['series'].values()))
+                texts.append(metric['text'])
+            return ''.join(texts)
+
+
+def prometheus_escape(value):
+    """ Escapes a label value for the exposition format """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_value(value):
+    """ Formats a sample value for the exposition format """
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if value != value:
+        return 'NaN'
+    if value in (float('inf'), float('-inf')):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+
+# Output sinks by mode
+sink_classes = {
+    'json': JsonSink,
+    'ndjson': NdjsonSink,
+    'influx': InfluxSink,
+    'prometheus': lambda: PrometheusSink(SSH_Poller.prometheus_port, SSH_Poller.prometheus_expire),
+}
+
+# Sinks of this process, a QueueSink in workers for the modes written by a single process
+sinks = {}
+
+
+def get_sink(mode):
+    """ Returns the sink of this process for an output mode """
+
+    if mode not in sinks:
+        sinks[mode] = sink_classes[mode]()
+    return sinks[mode]
+
+
+def sink_worker(queue, mode):
+    """ Output process of the workers for modes written by a single process (ndjson, prometheus)
+        Writes the batches of all the workers until STOP
+    """
+
+    sink = get_sink(mode)
+    while True:
+        batch = queue.get()
+        if batch == 'STOP':
+            sink.flush()
+            return
+        sink.write(batch)
+
+
+def poller_influx_writer(settings):
+    """ Returns the writer of this process for the InfluxDB settings of a poller (or SSH_Poller) """
+
+    return get_influx_writer(
+        settings.db_host, settings.db_port, settings.db_user, settings.db_password, settings.db_name,
+        batch_size=settings.db_batch_size, max_latency=settings.db_batch_latency, gzip=settings.db_gzip,
+        spool_dir=settings.spool_dir, spool_max_bytes=settings.spool_max_bytes,
+        spool_segment_size=settings.spool_segment_size, spool_drain_timeout=settings.spool_drain_timeout)
 
-            client.write_points(json_body, time_precision='s')
 
 def quotes_in_str(value):
     """ Add quotes around value if it's a string """
@@ -213,6 +2146,29 @@ def quotes_in_str(value):
         return (value)
 
 
+def escape_lp(value):
+    """ Escapes a measurement, tag or field key for line protocol """
+    return str(value).replace('\\', '\\\\').replace(' ', '\\ ').replace(',', '\\,').replace('=', '\\=').replace('\n', '\\n')
+
+
+def lp_value(value):
+    """ Formats a field value for line protocol """
+    if isinstance(value, bool):
+        return str(value)
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, int):
+        return '%si' % value
+    return '"%s"' % str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def to_line_protocol(data):
+    """ Converts a parsed row to an InfluxDB line protocol string """
+    tags = ''.join(',%s=%s' % (escape_lp(k), escape_lp(v)) for (k, v) in sorted(data['tag'].items()) if v != '')
+    fields = ','.join('%s=%s' % (escape_lp(k), lp_value(v)) for (k, v) in sorted(data['fields'].items()) if v is not None)
+    return '%s%s %s %s' % (escape_lp(data['command']), tags, fields, data['timestamp'])
+
+
 def int_if_possible(value):
     """ Convert to int if possible """
     try:
@@ -221,6 +2177,16 @@ def int_if_possible(value):
         return value
 
 
+def numeric_value(value):
+    """ Convert the value of a numeric column to float """
+    if value:
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            pass
+    return value
+
+
 def float_if_possible(value):
     """ Convert to float if possible """
     try:
@@ -229,49 +2195,1132 @@ def float_if_possible(value):
         return value
 
 
+def iter_lines(text):
+    """ Yields the lines of text without splitting it all at once """
+    start = 0
+    end = text.find('\n')
+    while end >= 0:
+        yield text[start:end]
+        start = end + 1
+        end = text.find('\n', start)
+    yield text[start:]
+
+
+# CSV column converters, keyed by command and header
+csv_schemas = {}
+
+
+def csv_schema(command, header):
+    """ Returns the field schema of a CSV output, learned from its rows """
+    key = (command, tuple(header))
+    if key not in csv_schemas:
+        csv_schemas[key] = FieldSchema(len(header), header)
+    return csv_schemas[key]
+
+
 def clitable_to_dict(cli_table):
     """Converts TextFSM cli_table object to list of dictionaries """
+    return records_to_dict(cli_table.header, cli_table)
+
+
+def records_to_dict(header, records):
+    """Converts TextFSM header and records to list of dictionaries """
     objs = []
-    for row in cli_table:
+    for row in records:
         temp_dict = {}
         for index, element in enumerate(row):
-            temp_dict[cli_table.header[index].lower()] = element
+            temp_dict[header[index].lower()] = element
         objs.append(temp_dict)
 
     return objs
 
 
-def worker(input_queue, output_queue):
-    """ Worker thread """
+class Deadline:
+    """ Absolute poll deadlines of one device
+
+        Deadlines are spaced exactly one interval apart on the monotonic
+        clock, so the period doesn't stretch by the command and write times.
+        Cycles whose deadline passed while the previous cycle was running
+        are skipped rather than queued. Counts lateness and skipped cycles,
+        and times the last complete cycle.
+    """
+
+    def __init__(self, interval, phase=0.0, start=None):
+        self.interval = float(interval)
+        self.next = (monotonic() if start is None else start) + phase
+        self.cycles = 0
+        self.skipped = 0
+        self.lateness = 0.0
+        self.max_lateness = 0.0
+        self.started = None
+        self.duration = 0.0
+
+    def start(self, now):
+        """ Records the lateness of the cycle starting now """
+
+        self.started = now
+        self.lateness = max(0.0, now - self.next)
+        self.max_lateness = max(self.max_lateness, self.lateness)
+        self.cycles += 1
+
+    def advance(self, now):
+        """ Moves to the next deadline after now, skipping the missed ones """
+
+        if self.started is not None:
+            self.duration = now - self.started
+        self.next += self.interval
+        if now >= self.next:
+            missed = int((now - self.next) // self.interval) + 1
+            self.next += missed * self.interval
+            self.skipped += missed
+            logging.debug('Skipped %s overrun cycles' % missed)
+
+    def point(self, hostname):
+        """ Returns the counters as a row for the output """
+
+        return {
+            'command': 'sshpoller_schedule',
+            'tag': {'host': hostname},
+            'fields': {
+                'cycles': self.cycles,
+                'skipped': self.skipped,
+                'lateness': self.lateness,
+                'max_lateness': self.max_lateness,
+                'duration': self.duration,
+            },
+            'timestamp': int(time())
+        }
 
-    # Fetch a task from the queue
-    task = input_queue.get()
 
-    # Exit if guardian is found
-    if task == 'STOP':
-        return
+def poll_phase(hostname, port, interval):
+    """ Returns a stable start offset within the interval for this device
+        Spreads devices started together over the whole interval
+    """
+    return (zlib.crc32(('%s:%s' % (hostname, port)).encode('utf-8')) & 0xffffffff) / 4294967296.0 * float(interval)
+
+
+class DeviceHealth:
+    """ Response time and error rate of a device, and the polling they call for
+
+        Both are exponentially weighted moving averages over the poll cycles.
+        The interval is stretched while the cycles take more than busy_ratio
+        of it, and doubled while most of them fail, up to max_stretch times.
+        It comes back as the device recovers. A device whose cycles take more
+        than slow_time seconds goes to the slow lane, until they take less
+        than half of that.
+    """
+
+    alpha = 0.3             # Weight of the last cycle in the averages
+    busy_ratio = 0.8        # Share of the interval a cycle may take before the interval is stretched
+    error_threshold = 0.5   # Error rate above which the interval is doubled
+    max_stretch = 8.0       # Max interval multiplier
+    slow_time = 2.0         # Response time (sec) above which the device goes to the slow lane
+
+    def __init__(self, interval):
+        self.base_interval = float(interval)
+        self.interval = self.base_interval
+        self.response_time = None
+        self.error_rate = 0.0
+        self.slow = False
+
+    def update(self, duration, ok):
+        """ Adds a cycle to the averages, returns the interval to the next one """
+
+        error = 0.0 if ok else 1.0
+        if self.response_time is None:
+            self.response_time = duration
+            self.error_rate = error
+        else:
+            self.response_time += self.alpha * (duration - self.response_time)
+            self.error_rate += self.alpha * (error - self.error_rate)
+
+        stretch = max(1.0, self.response_time / (self.base_interval * self.busy_ratio))
+        if self.error_rate > self.error_threshold:
+            stretch *= 2
+        self.interval = self.base_interval * min(stretch, self.max_stretch)
+
+        if self.response_time > self.slow_time:
+            self.slow = True
+        elif self.response_time < self.slow_time / 2:
+            self.slow = False
+        return self.interval
+
+    def point(self, hostname):
+        """ Returns the state of the device as a row for the output """
+
+        return {
+            'command': 'sshpoller_health',
+            'tag': {'host': hostname},
+            'fields': {
+                'response_time': self.response_time,
+                'error_rate': self.error_rate,
+                'interval': self.interval,
+                'slow_lane': self.slow,
+            },
+            'timestamp': int(time())
+        }
 
-    poller = SSH_Poller(task)
-    if poller.connect():
-        if task['mode'] == 'json':
+
+class PollScheduler:
+    """ Polls many device tasks from a single worker
+
+        Pollers are kept in a heap ordered by their next deadline, so each
+        task keeps its own interval. Tasks with no interval are polled once.
+        With a raw queue, outputs are handed to the parsing pipeline instead
+        of being parsed by the worker. With a control queue, tasks are added,
+        removed and updated while it runs (see TaskReloader).
+
+        The interval of each device adapts to its response time and error
+        rate (see DeviceHealth). The commands of slow devices run in a pool
+        of threads (the slow lane), while this thread keeps polling the
+        others, then parses and writes their outputs. A device never has more
+        than one cycle in flight, and a slow one uses a single session.
+    """
+
+    phase_spread = True     # Spread the first polls of the devices over their interval
+    adaptive = True         # Stretch the interval of the devices that can't keep up
+    slow_lane_workers = 4   # Threads running the commands of the slow devices
+
+    def __init__(self, tasks, raw_queue=None, stats=None, control=None):
+        self.queue = []
+        self.pollers = []
+        self.running = True
+        self.seq = 0
+        self.raw_queue = raw_queue
+        self.pipeline_stats = stats
+        self.control = control
+        self.lane = None
+        self.in_lane = 0
+        self.lane_done = deque()
+        self.wakeup = threading.Event()
+
+        for task in tasks:
+            self.add(task)
+
+    def add(self, task):
+        """ Schedules a new task """
+
+        poller = SSH_Poller(task)
+        poller.task = task
+        poller.mode = task['mode']
+        phase = 0.0
+        if self.phase_spread and float(poller.interval):
+            phase = poll_phase(poller.hostname, poller.port, poller.interval)
+        poller.deadline = Deadline(poller.interval, phase)
+        poller.health = DeviceHealth(poller.interval) if self.adaptive and float(poller.interval) else None
+        poller.in_lane = False
+        self.pollers.append(poller)
+        self.schedule(poller)
+
+    def remove(self, task):
+        """ Stops polling the device of a task and closes its session """
+
+        key = task_key(task)
+        for poller in [poller for poller in self.pollers if task_key(poller.task) == key]:
+            self.pollers.remove(poller)
+            # A poller in the slow lane is disconnected once its cycle is over
+            if poller.session_up and not poller.in_lane:
+                poller.disconnect()
+        self.queue = [item for item in self.queue if task_key(item[2].task) != key]
+        heapq.heapify(self.queue)
+
+    def update(self, task):
+        """ Replaces the task of a device, only its session is reopened """
+
+        self.remove(task)
+        self.add(task)
+
+    def apply_changes(self):
+        """ Applies the task changes waiting on the control queue """
+
+        while True:
+            try:
+                action, task = self.control.get_nowait()
+            except Empty:
+                return
+            logging.debug('Task change: %s %s' % (action, task_key(task)))
+            if action == 'add':
+                self.add(task)
+            elif action == 'remove':
+                self.remove(task)
+                if not any(poller.hostname == task['hostname'] for poller in self.pollers):
+                    rate_store.forget(task['hostname'])
+                    if self.raw_queue is not None:
+                        # Rates of the pipeline are computed by the output stage
+                        self.raw_queue.put(('forget', task))
+            elif action == 'update':
+                self.update(task)
+
+    def schedule(self, poller):
+        """ Puts the poller back in the queue """
+
+        self.seq += 1
+        heapq.heappush(self.queue, (poller.deadline.next, self.seq, poller))
+
+    def stop(self):
+        """ Stops the scheduler loop """
+
+        self.running = False
+        self.wakeup.set()
+
+    def wait(self, timeout):
+        """ Sleeps until timeout or until the slow lane is done with a device """
+
+        self.wakeup.wait(timeout)
+        self.wakeup.clear()
+
+    def stats(self):
+        """ Returns the schedule counters of every device """
+
+        stats = {}
+        for poller in self.pollers:
+            stats[poller.hostname] = poller.deadline.point(poller.hostname)['fields']
+            stats[poller.hostname].update(poller.session_stats)
+            if poller.health is not None:
+                stats[poller.hostname].update(poller.health.point(poller.hostname)['fields'])
+        return stats
+
+    def status_rows(self, poller):
+        """ Returns the schedule, session, health and stage counters of a device """
+
+        rows = [poller.deadline.point(poller.hostname), poller.session_point()]
+        if poller.health is not None:
+            rows.append(poller.health.point(poller.hostname))
+        return rows + metrics.points(poller.hostname)
+
+    def poll(self, poller, outputs=None, timestamp=None):
+        """ Runs one poll cycle of the task, or parses and writes the outputs of a cycle run by the slow lane
+            Returns False if the task should not be polled again
+        """
+
+        periodic = bool(float(poller.interval)) and poller.mode != 'json'
+        if outputs is None and not poller.ensure_session():
+            return periodic
+
+        if self.raw_queue is not None:
+            return self.poll_raw(poller, periodic, outputs, timestamp)
+
+        # The schedule, session and health rows go in the same batch as the cycle
+        status = None
+        if periodic and poller.mode not in ('json', 'ndjson'):
+            status = lambda: self.status_rows(poller)
+        try:
+            poller.send_commands(outputs, timestamp, status)
+        except SESSION_ERRORS as e:
+            logging.error('Polling %s failed: %s' % (poller.hostname, str(e)))
+            poller.session_lost()
+            return periodic
+        except Exception:
+            # Not a session failure, the next cycle reuses the session
+            logging.exception('Polling %s failed' % poller.hostname)
+            return periodic
+
+        if poller.mode == 'json':
             logging.info('JSON mode selected')
-            poller.send_commands()
             poller.output_json()
-        elif task['mode'] == 'influx':
-            logging.info('InfluxDB mode selected, polling every %s seconds' % task['interval'])
-            if task['interval'] == 0:
-                # Interval not set, we'll just poll once
-                poller.send_commands()
+        elif poller.mode == 'ndjson':
+            # Already written by send_commands()
+            poller.data_list = []
+        elif poller.mode == 'influx':
+            logging.info('InfluxDB mode selected, polling every %s seconds' % poller.interval)
+            try:
                 poller.output_influxdb()
+            except Exception as e:
+                # Keep polling, the spool (spool_dir) keeps the points of such cycles
+                logging.error('InfluxDB write error: %s' % str(e))
+                if metrics.enabled:
+                    metrics.count(poller.hostname, '', 'errors')
+        else:
+            poller.output_sink()
+
+        return periodic
+
+    def poll_raw(self, poller, periodic, outputs=None, timestamp=None):
+        """ Runs one poll cycle of the task, queueing the raw outputs for the parsers """
+
+        # Timestamp precision is set to 'seconds'
+        if timestamp is None:
+            timestamp = int(time())
+        try:
+            for command, result in (poller.iter_outputs() if outputs is None else outputs):
+                self.raw_queue.put(('raw', poller.task, command, timestamp, result))
+                if self.pipeline_stats is not None:
+                    self.pipeline_stats.count(self.pipeline_stats.polled)
+        except SESSION_ERRORS as e:
+            logging.error('Polling %s failed: %s' % (poller.hostname, str(e)))
+            poller.session_lost()
+            return periodic
+        except Exception:
+            logging.exception('Polling %s failed' % poller.hostname)
+            return periodic
+
+        if poller.mode in ('influx', 'prometheus') and periodic:
+            self.raw_queue.put(('rows', poller.task, self.status_rows(poller)))
+
+        return periodic
+
+    def run(self):
+        """ Polls tasks as they come due until none is left
+            With a control queue, runs until stopped as tasks may still be added
+        """
+
+        while self.running and (self.queue or self.in_lane or self.control is not None):
+            self.complete_lane()
+            if self.control is not None:
+                self.apply_changes()
+            if not self.queue:
+                self.wait(1.0)
+                continue
+
+            deadline, seq, poller = self.queue[0]
+            delay = deadline - monotonic()
+            if delay > 0:
+                # Wake up regularly to honor stop()
+                self.wait(min(delay, 1.0))
+                continue
+
+            heapq.heappop(self.queue)
+            poller.deadline.start(monotonic())
+            if poller.health is not None and poller.health.slow:
+                if self.lane is None:
+                    self.lane = ThreadPoolExecutor(self.slow_lane_workers)
+                poller.in_lane = True
+                self.in_lane += 1
+                self.lane.submit(self.fetch, poller)
+                continue
+
+            try:
+                again = self.poll(poller)
+            except Exception as e:
+                # Don't let one device take down the other tasks of this worker
+                logging.error('Polling %s failed: %s' % (poller.hostname, str(e)))
+                again = False
+            self.finish(poller, again)
+
+        if self.lane is not None:
+            self.lane.shutdown(wait=False)
+
+    def finish(self, poller, again):
+        """ Adapts the interval of a device to its last cycle and schedules the next one """
+
+        if again:
+            if poller.health is not None:
+                self.adapt(poller)
+            poller.deadline.advance(monotonic())
+            self.schedule(poller)
+        elif poller.session_up:
+            poller.disconnect()
+        metrics.report()
+
+    def adapt(self, poller):
+        """ Updates the health of a device with its last cycle """
+
+        health = poller.health
+        slow = health.slow
+        poller.deadline.interval = health.update(monotonic() - poller.deadline.started, poller.session_up)
+        if health.slow == slow:
+            return
+
+        if health.slow:
+            logging.info('%s moved to the slow lane, response time %.1fs, polled every %.1fs' % (
+                poller.hostname, health.response_time, health.interval))
+            # Don't load it with concurrent sessions
+            poller.max_channels = 1
+            poller.close_channels()
+        else:
+            logging.info('%s is back from the slow lane, response time %.1fs' % (poller.hostname, health.response_time))
+            poller.max_channels = int(poller.task.get('max_channels') or SSH_Poller.max_channels)
+
+    def fetch(self, poller):
+        """ Runs the commands of a slow device in a slow lane thread
+            The outputs are parsed and written by the scheduler thread (see complete_lane)
+        """
+
+        try:
+            if poller.ensure_session():
+                result = (int(time()), list(poller.iter_outputs()))
             else:
-                # Interval is set, start polling loop
-                while True:
-                    poller.send_commands()
-                    poller.output_influxdb()
-                    sleep(float(task['interval']))
-    else:
+                result = None
+        except Exception as e:
+            result = e
+        self.lane_done.append((poller, result))
+        self.wakeup.set()
+
+    def complete_lane(self):
+        """ Parses and writes the outputs of the devices done in the slow lane, and schedules them again """
+
+        while self.lane_done:
+            poller, result = self.lane_done.popleft()
+            poller.in_lane = False
+            self.in_lane -= 1
+            if not any(p is poller for p in self.pollers):
+                # Removed while in the slow lane
+                if poller.session_up:
+                    poller.disconnect()
+                continue
+
+            if isinstance(result, Exception):
+                logging.error('Polling %s failed: %s' % (poller.hostname, str(result)))
+                if isinstance(result, SESSION_ERRORS):
+                    poller.session_lost()
+                again = True
+            elif result is None:
+                # No session for this cycle
+                again = True
+            else:
+                try:
+                    again = self.poll(poller, result[1], result[0])
+                except Exception as e:
+                    logging.error('Polling %s failed: %s' % (poller.hostname, str(e)))
+                    again = False
+            self.finish(poller, again)
+
+
+def parse_output(task, command, output, timestamp=None):
+    """ Parses one command output, returns the result tables
+        Module level so it can run in a parser process
+    """
+
+    poller = SSH_Poller(task)
+    poller.parse(output, command, timestamp)
+    return poller.batch
+
+
+class PipelineStats:
+    """ Counters of the parsing pipeline, shared by all its processes
+
+        I/O workers count the outputs they queue, parsers the outputs they
+        parse and the output stage the points it writes. report() logs the
+        queue depths and the throughput of each stage since the last call.
+    """
+
+    def __init__(self, raw_queue, parsed_queue):
+        self.raw_queue = raw_queue
+        self.parsed_queue = parsed_queue
+        self.polled = Value('l', 0)
+        self.parsed = Value('l', 0)
+        self.written = Value('l', 0)
+        self.errors = Value('l', 0)
+        self.last = None
+
+    def count(self, counter, n=1):
+        with counter.get_lock():
+            counter.value += n
+
+    def snapshot(self):
+        """ Returns the queue depths and the stage counters """
+
+        stats = {'polled': self.polled.value, 'parsed': self.parsed.value, 'written': self.written.value,
+                 'errors': self.errors.value}
+        for name, queue in (('raw_queue', self.raw_queue), ('parsed_queue', self.parsed_queue)):
+            try:
+                stats[name] = queue.qsize()
+            except NotImplementedError:
+                # Not available on every platform (i.e. macOS)
+                stats[name] = -1
+        return stats
+
+    def report(self):
+        """ Logs the queue depths and the throughput of each stage """
+
+        now = time()
+        stats = self.snapshot()
+        if self.last is not None:
+            elapsed = now - self.last[0]
+            logging.info('Pipeline: raw queue %s, parsed queue %s, polled %.1f/s, parsed %.1f/s, written %.1f points/s, '
+                         '%s parse errors' % (
+                stats['raw_queue'], stats['parsed_queue'],
+                (stats['polled'] - self.last[1]['polled']) / elapsed,
+                (stats['parsed'] - self.last[1]['parsed']) / elapsed,
+                (stats['written'] - self.last[1]['written']) / elapsed,
+                stats['errors'] - self.last[1]['errors']))
+        self.last = (now, stats)
+        return stats
+
+
+def parser_worker(raw_queue, parsed_queue, stats):
+    """ Parser process of the pipeline
+        Parses raw outputs from the I/O workers for the output stage
+    """
+
+    install_profiler(SSH_Poller.profile_dir)
+    try:
+        while True:
+            item = raw_queue.get()
+            if item == 'STOP':
+                return
+
+            kind, task = item[0], item[1]
+            if kind == 'forget':
+                # Removed device, its counter samples are kept by the output stage
+                parsed_queue.put(('forget', task['hostname']))
+                continue
+            if kind == 'raw':
+                command, timestamp, output = item[2:]
+                try:
+                    batch = parse_output(task, command, output, timestamp)
+                except Exception as e:
+                    # A bad template or tag only loses this output
+                    logging.error('Parsing %s from %s failed: %s' % (command['command'], task['hostname'], repr(e)))
+                    stats.count(stats.errors)
+                    continue
+                stats.count(stats.parsed)
+            else:
+                # Rows built by the I/O workers (i.e. schedule counters)
+                command, batch = None, item[2]
+            parsed_queue.put((task, command, batch))
+    finally:
+        # The output stage waits for a STOP from every parser
+        parsed_queue.put('STOP')
+
+
+def output_worker(parsed_queue, stats, parsers=1, report_interval=10.0):
+    """ Output stage of the pipeline
+        Writes the parsed batches until every parser has stopped
+    """
+
+    last_report = time()
+    while parsers:
+        item = parsed_queue.get()
+        if item == 'STOP':
+            parsers -= 1
+            continue
+        if item[0] == 'forget':
+            rate_store.forget(item[1])
+            continue
+
+        task, command, batch = item
+        mode = task['mode']
+        # Counter samples of a device can be parsed by any parser, rates are computed here
+        if command and command.get('rates'):
+            batch = apply_rates(batch, task['hostname'], command)
+        get_sink(mode).write(batch)
+        stats.count(stats.written, batch_points(batch))
+
+        if time() - last_report >= report_interval:
+            stats.report()
+            last_report = time()
+
+    for sink in sinks.values():
+        sink.flush()
+
+
+class AsyncSession:
+    """ Interactive SSH shell session driven by asyncio
+
+        Plays the part of netmiko for the asyncio engine: finds the prompt,
+        sends the precommands and returns each command output without the
+        echoed command and the trailing prompt. Paging has to be disabled
+        through the precommands.
+    """
+
+    read_timeout = 30   # Max time (sec) to wait for a command output
+    quiet_time = 0.5    # Time (sec) without data after which a banner is complete
+
+    def __init__(self, task):
+        self.task = task
+        self.conn = None
+        self.process = None
+        self.prompt = ''
+
+    async def connect(self):
+        """ Connects the session and sends the precommands """
+
+        self.conn = await asyncssh.connect(
+            self.task['hostname'],
+            port=int(self.task['port']),
+            username=self.task['username'],
+            password=self.task['password'],
+            known_hosts=None)
+        self.process = await self.conn.create_process(term_type='vt100', term_size=(511, 24))
+        logging.debug('Connection to %s successful!' % self.task['hostname'])
+
+        # Precommands may change the prompt (i.e. bash on F5), look for it afterwards
+        await self.read_until_quiet()
+        for precommand in self.task['precommands'] or []:
+            self.process.stdin.write(precommand + '\n')
+            await self.read_until_quiet()
+
+        self.prompt = await self.find_prompt()
+        logging.debug('Prompt found: %s' % self.prompt)
+
+    def close(self):
+        """ Closes the session """
+
+        if self.conn is not None:
+            self.conn.close()
+        self.conn = None
+        self.process = None
+
+    async def read_until_quiet(self):
+        """ Reads until no data is received for quiet_time """
+
+        buf = ''
+        while True:
+            try:
+                chunk = await asyncio.wait_for(self.process.stdout.read(65536), self.quiet_time)
+            except asyncio.TimeoutError:
+                return buf
+            if not chunk:
+                return buf
+            buf += chunk
+
+    async def find_prompt(self):
+        """ Returns the last line printed after an empty command """
+
+        self.process.stdin.write('\n')
+        lines = [line.strip() for line in (await self.read_until_quiet()).splitlines() if line.strip()]
+        return lines[-1] if lines else ''
+
+    async def send_command(self, command):
+        """ Sends a command and returns its output """
+
+        self.process.stdin.write(command + '\n')
+        buf = ''
+        while not buf.rstrip().endswith(self.prompt):
+            chunk = await asyncio.wait_for(self.process.stdout.read(65536), self.read_timeout)
+            if not chunk:
+                raise EOFError('Connection closed by %s' % self.task['hostname'])
+            buf += chunk
+
+        lines = buf.rstrip()[:-len(self.prompt)].replace('\r\n', '\n').split('\n')
+        if lines and command in lines[0]:
+            lines = lines[1:]
+        return '\n'.join(lines).rstrip('\n')
+
+
+class AsyncEngine:
+    """ Polls every device from a single asyncio event loop
+
+        SSH sessions are plain coroutines, so thousands of them can be in
+        flight at once. Parsing is CPU bound and runs in a pool of parser
+        processes, while the InfluxDB writes run in the default thread pool.
+        A slow device only holds up its own coroutine, so the intervals adapt
+        to the health of the devices without a slow lane.
+    """
+
+    max_connects = 100  # Max # of SSH handshakes in progress
+
+    def __init__(self, tasks, parse_workers=None):
+        self.tasks = tasks
+        self.parse_workers = parse_workers
+        self.executor = None
+        self.connects = None
+        self.running = True
+
+    def run(self):
+        """ Polls all tasks until none is left """
+
+        if asyncssh is None:
+            raise ImportError('The asyncio engine requires the asyncssh module')
+
+        loop = asyncio.new_event_loop()
+        self.executor = ProcessPoolExecutor(self.parse_workers)
+        try:
+            loop.run_until_complete(self.poll_all())
+        finally:
+            self.executor.shutdown()
+            loop.close()
+
+    async def poll_all(self):
+        self.connects = asyncio.Semaphore(self.max_connects)
+        await asyncio.gather(*[self.poll_device(task) for task in self.tasks])
+
+    async def poll_device(self, task):
+        """ Polling loop of one device """
+
+        poller = SSH_Poller(task)
+        session = AsyncSession(task)
+        interval = float(poller.interval)
+        phase = poll_phase(poller.hostname, poller.port, interval) if PollScheduler.phase_spread else 0.0
+        poller.deadline = Deadline(interval, phase if interval else 0.0)
+        poller.health = DeviceHealth(interval) if PollScheduler.adaptive and interval else None
+        while True:
+            await asyncio.sleep(max(0.0, poller.deadline.next - monotonic()))
+            poller.deadline.start(monotonic())
+            ok = False
+            try:
+                if session.process is None:
+                    async with self.connects:
+                        start = monotonic()
+                        await session.connect()
+                        if metrics.enabled:
+                            metrics.observe(poller.hostname, '', 'connect', monotonic() - start)
+                await self.poll(task, poller, session)
+                ok = True
+            except (OSError, EOFError, asyncio.TimeoutError, asyncssh.Error) as e:
+                logging.error('Polling %s failed: %s' % (poller.hostname, str(e)))
+                session.close()
+                if metrics.enabled:
+                    metrics.count(poller.hostname, '', 'errors')
+            except Exception as e:
+                # Don't let one device take down the others, its session is kept
+                logging.exception('Polling %s failed: %s' % (poller.hostname, str(e)))
+                if metrics.enabled:
+                    metrics.count(poller.hostname, '', 'errors')
+
+            if task['mode'] == 'json' or not interval or not self.running:
+                break
+            if poller.health is not None:
+                poller.deadline.interval = poller.health.update(monotonic() - poller.deadline.started, ok)
+            poller.deadline.advance(monotonic())
+            metrics.report()
+
+        session.close()
+
+    def stop(self):
+        """ Stops every device after its current cycle, may be called from another thread """
+
+        self.running = False
+
+    def status_rows(self, poller):
+        """ Returns the schedule, health and stage counters of a device """
+
+        rows = [poller.deadline.point(poller.hostname)]
+        if poller.health is not None:
+            rows.append(poller.health.point(poller.hostname))
+        return rows + metrics.points(poller.hostname)
+
+    async def poll(self, task, poller, session):
+        """ Runs one poll cycle of the device """
+
+        loop = asyncio.get_event_loop()
+        batch = []
+        for command in poller.command_list:
+            logging.debug('Sending command: %s' % command['command'])
+            start = monotonic()
+            output = await session.send_command(command['command'])
+            if metrics.enabled:
+                metrics.observe(poller.hostname, command['command'], 'send_command', monotonic() - start)
+                metrics.count(poller.hostname, command['command'], 'bytes', len(output))
+                start = monotonic()
+            try:
+                tables = apply_rates(await loop.run_in_executor(self.executor, parse_output, task, command, output),
+                                     poller.hostname, command)
+            except Exception as e:
+                # A bad template or tag only loses this command, the session is fine
+                logging.error('Parsing %s from %s failed: %s' % (command['command'], poller.hostname, repr(e)))
+                if metrics.enabled:
+                    metrics.count(poller.hostname, command['command'], 'errors')
+                continue
+            if metrics.enabled:
+                # Includes the round trip to the parser process
+                metrics.observe(poller.hostname, command['command'], 'parse_%s' % poller.parser_mode, monotonic() - start)
+                metrics.count(poller.hostname, command['command'], 'rows', batch_points(tables))
+            if task['mode'] == 'ndjson':
+                get_sink('ndjson').write(tables)
+            else:
+                batch.extend(tables)
+        poller.data_list = batch
+        if task['mode'] in ('influx', 'prometheus') and float(poller.interval):
+            # The schedule, health and stage rows go in the same batch as the cycle
+            poller.results.put(poller.batch + self.status_rows(poller))
+        else:
+            poller.results.put(poller.batch)
+
+        if task['mode'] == 'json':
+            poller.output_json()
+        elif task['mode'] == 'influx':
+            try:
+                await loop.run_in_executor(None, poller.output_influxdb)
+            except Exception as e:
+                # Not a device failure, the session is kept (the spool keeps the points of such cycles)
+                logging.error('InfluxDB write error: %s' % str(e))
+                if metrics.enabled:
+                    metrics.count(poller.hostname, '', 'errors')
+        elif task['mode'] == 'prometheus':
+            poller.output_sink()
+
+
+def split_tasks(tasks, count):
+    """ Splits tasks round-robin into count lists """
+    return [tasks[i::count] for i in range(count) if tasks[i::count]]
+
+
+class Task(Mapping):
+    """ Task of one device, read like the task dictionaries
+
+        Only the hostname and port are held per device. The other settings
+        are a dictionary shared by the devices of a group, which is also
+        pickled once per task list sent to a worker.
+    """
+
+    __slots__ = ('hostname', 'port', 'settings')
+
+    def __init__(self, hostname, port, settings):
+        self.hostname = hostname
+        self.port = port
+        self.settings = settings
+
+    def __getitem__(self, key):
+        if key == 'hostname':
+            return self.hostname
+        if key == 'port':
+            return self.port
+        return self.settings[key]
+
+    def __iter__(self):
+        yield 'hostname'
+        yield 'port'
+        for key in self.settings:
+            yield key
+
+    def __len__(self):
+        return 2 + len(self.settings)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+def task_settings(entry, username, password, mode, interval):
+    """ Returns the settings of a task from an inventory entry (merged with its group and defaults)
+        The interval of the command line applies to the entries without one
+    """
+
+    return {
+        'username': username,
+        'password': password,
+        'mode': mode if mode in ('ndjson', 'prometheus') else 'influx',
+        'device_type': entry['device_type'],
+        'parser_mode': entry['parse_mode'],
+        'commands': entry['commands'],
+        'precommands': entry.get('post_login_commands'),
+        'interval': entry.get('interval', interval),
+        'max_channels': entry.get('max_channels', 1)
+    }
+
+
+def csv_devices(filename):
+    """ Yields the devices of a CSV inventory, one row at a time
+        Empty cells are left to the group and the defaults
+    """
+
+    f = open(filename, newline='')
+    try:
+        for row in csv.DictReader(f):
+            device = dict((key, value) for (key, value) in row.items() if key and value != '')
+            for key in ('port', 'max_channels'):
+                if key in device:
+                    device[key] = int(device[key])
+            yield device
+    finally:
+        f.close()
+
+
+def load_tasks(yaml_filename, username, password, mode, interval):
+    """ Returns the task list of a YAML inventory
+
+        The inventory is either a list of devices, or a mapping of defaults,
+        groups and devices. Each device entry is merged over its group (group
+        key), then over the defaults. devices may also be the path of a CSV
+        file, relative to the YAML file, with a device_name column and any of
+        the port, group, device_type, parse_mode and max_channels columns.
+        Devices with the same group and settings share one settings dictionary.
+    """
+
+    f = open(yaml_filename)
+    inventory = yaml.load(f, Loader=YamlLoader) or []
+    f.close()
+
+    if isinstance(inventory, list):
+        inventory = {'devices': inventory}
+    defaults = inventory.get('defaults') or {}
+    groups = inventory.get('groups') or {}
+    devices = inventory.get('devices') or []
+    if isinstance(devices, str):
+        devices = csv_devices(os.path.join(os.path.dirname(yaml_filename), devices))
+
+    settings = {}
+    task_list = []
+    for device in devices:
+        group = device.get('group')
+        if group is not None and group not in groups:
+            raise ValueError('Unknown group %s of device %s' % (group, device['device_name']))
+        group = groups.get(group) or {}
+
+        overrides = [(key, value) for (key, value) in device.items() if key not in ('device_name', 'port', 'group')]
+        key = (device.get('group'), repr(sorted(overrides)))
+        if key not in settings:
+            entry = dict(defaults)
+            entry.update(group)
+            entry.update(overrides)
+            settings[key] = task_settings(entry, username, password, mode, interval)
+
+        port = device.get('port') or group.get('port') or defaults.get('port') or 22
+        task_list.append(Task(device['device_name'], port, settings[key]))
+
+    logging.debug('Loaded %s tasks with %s distinct settings' % (len(task_list), len(settings)))
+    return task_list
+
+
+def task_key(task):
+    """ Returns the device a task polls """
+    return (task['hostname'], str(task['port']))
+
+
+def device_hash(task):
+    """ Returns a 64-bit hash of the device a task polls, the same in every process and on every node """
+    return int(hashlib.md5(('%s:%s' % task_key(task)).encode('utf-8')).hexdigest()[:16], 16)
+
+
+def jump_hash(key, buckets):
+    """ Jump consistent hash (Lamping & Veach), bucket of a 64-bit key
+        Going from n to n + 1 buckets only moves 1/(n + 1) of the keys, all to the new bucket
+    """
+
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+def rendezvous_node(task, nodes):
+    """ Highest random weight (rendezvous) hashing, node polling the device of a task
+        Adding a node only moves the devices it wins, removing one only moves its own devices
+    """
+
+    key = '%s:%s' % task_key(task)
+    return max(nodes, key=lambda node: (hashlib.md5(('%s|%s' % (node, key)).encode('utf-8')).digest(), node))
+
+
+def shard_tasks(tasks, index=None, count=None, node=None, nodes=None):
+    """ Returns the tasks of this node: shard index of count (jump hash), or node among nodes (rendezvous) """
+
+    if count:
+        return [task for task in tasks if jump_hash(device_hash(task), count) == index]
+    if nodes:
+        return [task for task in tasks if rendezvous_node(task, nodes) == node]
+    return tasks
+
+
+def diff_tasks(old, new):
+    """ Returns the added, removed and modified tasks of the new task list, by device """
+
+    old = dict((task_key(task), task) for task in old)
+    new = dict((task_key(task), task) for task in new)
+    added = [task for (key, task) in new.items() if key not in old]
+    removed = [task for (key, task) in old.items() if key not in new]
+    modified = [task for (key, task) in new.items() if key in old and old[key] != task]
+    return added, removed, modified
+
+
+class TaskReloader:
+    """ Hands the tasks to the workers, then the changes of the task file
+
+        Each worker gets its task list, then the changes of its devices,
+        through its own control queue. Only the added, removed and modified
+        devices are touched, the sessions and caches of the others stay up.
+        New devices go to the worker with the fewest devices.
+    """
+
+    def __init__(self, load, queues):
+        self.load = load
+        self.queues = queues
+        self.tasks = {}
+        self.owners = {}
+
+    def start(self, tasks):
+        """ Splits the tasks among the workers """
+
+        for i, task_chunk in enumerate(split_tasks(tasks, len(self.queues))):
+            for task in task_chunk:
+                self.owners[task_key(task)] = i
+            self.queues[i].put(task_chunk)
+        self.tasks = dict((task_key(task), task) for task in tasks)
+
+    def reload(self):
+        """ Loads the task file again and sends the changes to the workers
+            Returns the added, removed and modified tasks, None if the file can't be loaded
+        """
+
+        try:
+            tasks = self.load()
+        except Exception as e:
+            logging.error('Task file reload failed, keeping the running tasks: %s' % str(e))
+            return None
+
+        added, removed, modified = diff_tasks(list(self.tasks.values()), tasks)
+        for task in removed:
+            self.queues[self.owners.pop(task_key(task))].put(('remove', task))
+        for task in modified:
+            self.queues[self.owners[task_key(task)]].put(('update', task))
+
+        loads = [0] * len(self.queues)
+        for owner in self.owners.values():
+            loads[owner] += 1
+        for task in added:
+            owner = loads.index(min(loads))
+            loads[owner] += 1
+            self.owners[task_key(task)] = owner
+            self.queues[owner].put(('add', task))
+
+        self.tasks = dict((task_key(task), task) for task in tasks)
+        logging.info('Task file reloaded: %s added, %s removed, %s modified' % (len(added), len(removed), len(modified)))
+        return added, removed, modified
+
+
+def watch_task_file(yaml_filename, reloader, workers, watch=False):
+    """ Reloads the task file on SIGHUP, or once it changed if watch is set, while the workers run
+        A change is applied when the file's mtime is the same on two checks in a row, so a file
+        still being written isn't loaded
+    """
+
+    hangups = []
+    signal.signal(signal.SIGHUP, lambda signum, frame: hangups.append(signum))
+
+    def mtime():
+        try:
+            return os.stat(yaml_filename).st_mtime
+        except OSError:
+            return None
+
+    loaded = previous = mtime()
+    while any(p.is_alive() for p in workers):
+        sleep(task_file_check_interval)
+        current = mtime() if watch else loaded
+        if hangups or (current == previous and current != loaded):
+            del hangups[:]
+            loaded = current
+            reloader.reload()
+        previous = current
+
+
+def worker(input_queue, output_queue, stats=None, control_queue=None):
+    """ Worker process
+        Polls every task of the list it fetches from the queue
+        With pipeline stats, raw outputs are pushed to output_queue for the parsers,
+        otherwise NDJSON records or Prometheus results are pushed to output_queue
+        for the output process
+        With a control queue, task changes are applied until the process is stopped
+    """
+
+    # Fetch a task list from the queue
+    tasks = input_queue.get()
+
+    # Exit if guardian is found
+    if tasks == 'STOP':
         return
 
+    if isinstance(tasks, Mapping):
+        tasks = [tasks]
+
+    install_profiler(SSH_Poller.profile_dir)
+
+    global ndjson_output
+    if stats is None and tasks[0]['mode'] == 'ndjson':
+        # Records are encoded here and go through the single NDJSON writer process
+        ndjson_output = NdjsonQueue(output_queue)
+    elif stats is None and tasks[0]['mode'] == 'prometheus':
+        # Series are held by the single exporter process
+        sinks['prometheus'] = QueueSink(output_queue)
+
+    if stats is None:
+        PollScheduler(tasks, control=control_queue).run()
+    else:
+        PollScheduler(tasks, output_queue, stats, control_queue).run()
+
 
 def main(args, loglevel):
     # Logging format
@@ -282,7 +3331,7 @@ def main(args, loglevel):
     port = args.port
     username = args.username
     password = args.password
-    mode = args.mode                # Valid choices: json, influx
+    mode = args.mode                # Valid choices: json, influx, ndjson, prometheus
     device_type = args.device_type  # See netmiko's doc for valid types
     parser_mode = args.parse        # Valid choices : fsm, csv
     commands = args.commands
@@ -290,48 +3339,35 @@ def main(args, loglevel):
     num_threads = args.threads
     interval = args.interval
     yaml_filename = args.yaml
-    yaml_task_list = []
+    engine = args.engine            # Valid choices: process, asyncio
+    shard = {
+        'index': args.shard_index,
+        'count': args.shard_count,
+        'node': args.shard_node,
+        'nodes': args.shard_nodes.split(',') if args.shard_nodes else None,
+    }
+    pipeline = args.pipeline
+    SSH_Poller.ndjson_file = args.output
+    SSH_Poller.profile_dir = args.profile
+    metrics.enabled = args.instrument
+    task_list = []
 
     # Ask for credentials if not passed from CLI args
     if not username:
-        username = raw_input('Enter username:')
+        username = input('Enter username:')
     if not password:
         password = getpass('Enter password:')
 
-    # YAML file parsing
-    if yaml_filename:
-        f = open(yaml_filename)
-        buf = f.read()
-        f.close()
-        yaml_task_list = yaml.load(buf)
-        num_threads = len(yaml_task_list)
-
     input_queue = Queue()
-    output_queue = Queue()
+    # Bounded, so that I/O workers wait for the parsers when they fall behind
+    output_queue = Queue(pipeline_queue_size)
 
     if yaml_filename:
-        # Add our task to the queue
-        for yaml_task in yaml_task_list:
-            task = {
-                'hostname': yaml_task['device_name'],
-                'username': username,
-                'password': password,
-                'mode': 'influx',
-                'device_type': yaml_task['device_type'],
-                'parser_mode': yaml_task['parse_mode'],
-                'commands': yaml_task['commands'],
-                'precommands': yaml_task['post_login_commands'],
-                'interval': interval
-            }
-            if yaml_task['port']:
-                task['port'] = yaml_task['port']
-            else:
-                task['port'] = 22
-            input_queue.put(task)
-            logging.debug('Added task to the queue: %s' % task)
+        # Build the task list
+        task_list = load_tasks(yaml_filename, username, password, mode, interval)
 
     else:
-        # Add our task to the queue
+        # Build our task
         task = {
             'hostname': hostname,
             'port': port,
@@ -344,19 +3380,93 @@ def main(args, loglevel):
             'precommands': precommands,
             'interval': interval
         }
-        input_queue.put(task)
-        logging.debug('Added task to the queue: %s' % task)
+        task_list.append(task)
+        logging.debug('Added task to the list: %s' % task)
 
-    # Add guardian to the queue
-    for i in range(1, num_threads + 1):
-        input_queue.put('STOP')
+    # This node only polls its share of the devices
+    task_list = shard_tasks(task_list, **shard)
+    if not task_list:
+        logging.error('No device to poll in this shard')
+        return
+
+    if engine == 'asyncio':
+        install_profiler(SSH_Poller.profile_dir)
+        AsyncEngine(task_list).run()
+        return
 
-    # Start processes
+    # Each worker polls its share of the tasks
+    num_threads = max(1, min(num_threads, len(task_list)))
+    reloader = None
+    if yaml_filename and float(interval) and hasattr(signal, 'SIGHUP'):
+        # Each worker gets its tasks, then their changes, on its own queue
+        control_queues = [Queue() for i in range(num_threads)]
+        reloader = TaskReloader(lambda: shard_tasks(load_tasks(yaml_filename, username, password, mode, interval), **shard),
+                                control_queues)
+        reloader.start(task_list)
+        # Only the main process reloads, the others inherit this
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    else:
+        control_queues = [None] * num_threads
+        for task_chunk in split_tasks(task_list, num_threads):
+            input_queue.put(task_chunk)
+
+        # Add guardian to the queue
+        for i in range(1, num_threads + 1):
+            input_queue.put('STOP')
+
+    if not pipeline:
+        # Start processes
+        workers = []
+        for i in range(1, num_threads + 1):
+            control_queue = control_queues[i - 1]
+            p = Process(target=worker, args=(control_queue or input_queue, output_queue, None, control_queue))
+            p.start()
+            workers.append(p)
+            logging.debug('Process %s PID %s started' % (i, p.pid))
+
+        if task_list[0]['mode'] in ('ndjson', 'prometheus'):
+            p = Process(target=sink_worker, args=(output_queue, task_list[0]['mode']))
+            p.start()
+            logging.debug('Output process PID %s started' % p.pid)
+        if reloader is not None:
+            watch_task_file(yaml_filename, reloader, workers, args.watch)
+        if task_list[0]['mode'] in ('ndjson', 'prometheus'):
+            for p in workers:
+                p.join()
+            output_queue.put('STOP')
+        return
+
+    # Pipeline: I/O workers -> output_queue -> parsers -> parsed_queue -> output stage
+    parsed_queue = Queue(pipeline_queue_size)
+    stats = PipelineStats(output_queue, parsed_queue)
+    num_parsers = cpu_count()
+
+    workers = []
     for i in range(1, num_threads + 1):
-        p = Process(target=worker, args=(input_queue, output_queue))
+        control_queue = control_queues[i - 1]
+        p = Process(target=worker, args=(control_queue or input_queue, output_queue, stats, control_queue))
         p.start()
+        workers.append(p)
         logging.debug('Process %s PID %s started' % (i, p.pid))
 
+    for i in range(1, num_parsers + 1):
+        p = Process(target=parser_worker, args=(output_queue, parsed_queue, stats))
+        p.start()
+        logging.debug('Parser %s PID %s started' % (i, p.pid))
+
+    p = Process(target=output_worker, args=(parsed_queue, stats, num_parsers))
+    p.start()
+    logging.debug('Output stage PID %s started' % p.pid)
+
+    if reloader is not None:
+        watch_task_file(yaml_filename, reloader, workers, args.watch)
+
+    # Stop the parsers once every I/O worker is done
+    for p in workers:
+        p.join()
+    for i in range(num_parsers):
+        output_queue.put('STOP')
+
 
 if __name__ == '__main__':
 
@@ -400,9 +3510,14 @@ if __name__ == '__main__':
         "-m",
         "--mode",
         help="Output mode (default = json)",
-        choices=['json', 'influx'],
+        choices=['json', 'influx', 'ndjson', 'prometheus'],
         default='json'
     )
+    parser.add_argument(
+        "-O",
+        "--output",
+        help="NDJSON output file or pipe (default = stdout)",
+    )
     parser.add_argument(
         "-i",
         "--interval",
@@ -435,9 +3550,57 @@ if __name__ == '__main__':
     parser.add_argument(
         "-t",
         "--threads",
-        help="# of threads",
+        help="# of worker processes, each polling its share of the devices",
+        type=int,
         default=1
     )
+    parser.add_argument(
+        "-e",
+        "--engine",
+        help="Polling engine (default = process)",
+        choices=['process', 'asyncio'],
+        default='process'
+    )
+    parser.add_argument(
+        "-x",
+        "--pipeline",
+        help="Parse outputs in a separate pool of processes (process engine only)",
+        action="store_true"
+    )
+    parser.add_argument(
+        "-W",
+        "--watch",
+        help="Reload the YAML file when it changes (it's always reloaded on SIGHUP when polling at an interval)",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--shard-index",
+        help="Poll only shard SHARD_INDEX (0 based) of the devices, out of --shard-count",
+        type=int,
+    )
+    parser.add_argument(
+        "--shard-count",
+        help="# of shards the devices are split into",
+        type=int,
+    )
+    parser.add_argument(
+        "--shard-node",
+        help="Poll only the devices of this node, out of --shard-nodes",
+    )
+    parser.add_argument(
+        "--shard-nodes",
+        help="Comma separated IDs of all the poller nodes the devices are split between",
+    )
+    parser.add_argument(
+        "-I",
+        "--instrument",
+        help="Time each poll stage per device and command, written to the sshpoller_stage and sshpoller_command measurements",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--profile",
+        help="Directory of the cProfile dumps, each process toggles profiling on SIGUSR2",
+    )
     parser.add_argument(
         "-v",
         "--verbose",
@@ -446,6 +3609,17 @@ if __name__ == '__main__':
     )
     args = parser.parse_args()
 
+    if (args.shard_index is None) != (args.shard_count is None):
+        parser.error('--shard-index and --shard-count go together')
+    if args.shard_count is not None and not 0 <= args.shard_index < args.shard_count:
+        parser.error('--shard-index must be between 0 and --shard-count - 1')
+    if (args.shard_node is None) != (args.shard_nodes is None):
+        parser.error('--shard-node and --shard-nodes go together')
+    if args.shard_nodes is not None and args.shard_node not in args.shard_nodes.split(','):
+        parser.error('--shard-node must be one of --shard-nodes')
+    if args.shard_count is not None and args.shard_nodes is not None:
+        parser.error('Use either --shard-index/--shard-count or --shard-node/--shard-nodes')
+
     # Setup logging
     if args.verbose:
         loglevel = logging.DEBUG
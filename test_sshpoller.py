@@ -1,28 +1,39 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
 # Import standard python modules
 from multiprocessing import Process, Queue
+import io
 import json
 import os
+import pickle
+import queue
 import random
 import re
+import resource
+import shutil
+import signal
 import string
-from time import sleep
+import tempfile
+from time import sleep, time
+from urllib.request import urlopen
+import threading
 import unittest
+from unittest import mock
 
 # Dependencies
 import clitable
-import MockSSH
+import textfsm
 
 # Module we're testing
 import sshpoller
 
 # Mock libraries for SSH
-from test_sshpoller_mock import mock_cisco, mock_f5
+from test_sshpoller_mock import MockSSH, mock_cisco, mock_f5, asyncssh, AsyncMockFleet, FakeConnection, FakeInfluxDB
 
 # InfluxDB module : https://github.com/influxdata/influxdb-python
 from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError
 
 # TextFSM config settings
 index_file = 'index'
@@ -102,7 +113,7 @@ class SSH_PollerTest_MockData(unittest.TestCase):
         for item in expected_results:
             item.pop('timestamp', None)
 
-        self.assertEqual(json.dumps(poller.data_list), json.dumps(expected_results))
+        self.assertEqual(json.dumps(poller.data_list, sort_keys=True), json.dumps(expected_results, sort_keys=True))
 
     def test_parse_fsm_cisco_show_interface(self):
         """ Test parse_fsm() function
@@ -131,7 +142,7 @@ class SSH_PollerTest_MockData(unittest.TestCase):
         for item in expected_results:
             item.pop('timestamp', None)
 
-        self.assertEqual(json.dumps(poller.data_list), json.dumps(expected_results))
+        self.assertEqual(json.dumps(poller.data_list, sort_keys=True), json.dumps(expected_results, sort_keys=True))
 
     def test_parse_fsm_cisco_show_platform(self):
         """ Test parse_fsm() function
@@ -160,7 +171,7 @@ class SSH_PollerTest_MockData(unittest.TestCase):
         for item in expected_results:
             item.pop('timestamp', None)
 
-        self.assertEqual(json.dumps(poller.data_list), json.dumps(expected_results))
+        self.assertEqual(json.dumps(poller.data_list, sort_keys=True), json.dumps(expected_results, sort_keys=True))
 
     def test_parse_fsm_f5_show_sys(self):
         """ Test parse_fsm() function
@@ -193,7 +204,7 @@ class SSH_PollerTest_MockData(unittest.TestCase):
         for item in expected_results:
             item.pop('timestamp', None)
 
-        self.assertEqual(json.dumps(poller.data_list), json.dumps(expected_results))
+        self.assertEqual(json.dumps(poller.data_list, sort_keys=True), json.dumps(expected_results, sort_keys=True))
 
     def test_parse_csv(self):
         """ Test parse_csv() function
@@ -226,7 +237,7 @@ class SSH_PollerTest_MockData(unittest.TestCase):
         for item in expected_results:
             item.pop('timestamp', None)
 
-        self.assertEqual(json.dumps(poller.data_list), json.dumps(expected_results))
+        self.assertEqual(json.dumps(poller.data_list, sort_keys=True), json.dumps(expected_results, sort_keys=True))
 
     def test_output_influxdb(self):
         """ Test output_influxdb()
@@ -269,7 +280,2120 @@ class SSH_PollerTest_MockData(unittest.TestCase):
 
         self.assertEqual(query_results.raw, expected_results)
 
-unittest.skip
+class SSH_PollerTest_CSV(unittest.TestCase):
+    def setUp(self):
+        self.task = {
+            'hostname': 'localhost',
+            'username': 'test',
+            'password': 'test',
+            'port': 9999,
+            'device_type': 'f5_ltm',
+            'parser_mode': 'csv',
+            'precommands': '',
+            'interval': 0,
+            'commands': ['tmctl -c test'],
+        }
+
+    def tearDown(self):
+        sshpoller.csv_schemas.clear()
+
+    def test_iter_lines(self):
+        """ Test iter_lines()
+        """
+        self.assertEqual(list(sshpoller.iter_lines('a\nb\n\nc')), 'a\nb\n\nc'.split('\n'))
+        self.assertEqual(list(sshpoller.iter_lines('')), [''])
+
+    def test_parse_csv_first_empty_line(self):
+        """ Test that parse_csv() stops at the first empty line and converts numeric columns
+        """
+        poller = sshpoller.SSH_Poller(self.task)
+        poller.parse_csv('name,count\nfoo,1\nbar,2\n\nignored,3\n', poller.command_list[0])
+
+        self.assertEqual([data['fields'] for data in poller.data_list],
+                         [{'name': 'foo', 'count': 1.0}, {'name': 'bar', 'count': 2.0}])
+        self.assertEqual([data['tag'] for data in poller.data_list],
+                         [{'host': 'localhost', 'instance': 0}, {'host': 'localhost', 'instance': 1}])
+
+    def test_csv_schema_cached(self):
+        """ Test that the column schema is learned once per command and header
+        """
+        poller = sshpoller.SSH_Poller(self.task)
+        poller.parse_csv('name,count\nfoo,1\n', poller.command_list[0])
+        schema = sshpoller.csv_schemas[('tmctl -c test', ('name', 'count'))]
+        poller.parse_csv('name,count\nbar,2\n', poller.command_list[0])
+
+        self.assertEqual(schema.kinds, [None, 'numeric'])
+        self.assertIs(sshpoller.csv_schemas[('tmctl -c test', ('name', 'count'))], schema)
+
+class SSH_PollerTest_FieldSchema(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_value_types(self):
+        """ Test that numeric columns are typed from the Value regexes
+        """
+        schema = sshpoller.FieldSchema([
+            (r'(\d+)', []), (r'([\d.]+)', []), (r'(\S+)', []), (r'(\d+)', ['List'])])
+
+        self.assertEqual(schema.kinds, ['numeric', 'numeric', None, 'text'])
+        self.assertEqual(schema.convert(['1', '', 'Ethernet1/1', ['1', '2']]), [1.0, '', 'Ethernet1/1', ['1', '2']])
+        self.assertEqual(schema.kinds, ['numeric', 'numeric', None, 'text'])
+
+    def test_learned_types(self):
+        """ Test that unknown columns are numeric from their first number
+        """
+        schema = sshpoller.FieldSchema(3)
+        self.assertEqual(schema.convert(['1.5', 'up', '']), [1.5, 'up', ''])
+        self.assertEqual(schema.kinds, ['numeric', None, None])
+        self.assertEqual(schema.convert(['2', 'down', '4']), [2.0, 'down', 4.0])
+        self.assertEqual(schema.kinds, ['numeric', None, 'numeric'])
+        self.assertTrue(schema.learning)
+
+        for i in range(schema.text_samples - 2):
+            schema.convert(['3', 'up', '5'])
+        self.assertEqual(schema.kinds, ['numeric', 'text', 'numeric'])
+        self.assertFalse(schema.learning)
+
+    def test_placeholder_first(self):
+        """ Test that a column starting with placeholders still converts its numbers, and that it's logged
+        """
+        schema = sshpoller.FieldSchema(2, ['speed', 'name'])
+        self.assertEqual(schema.convert(['N/A', 'eth0']), ['N/A', 'eth0'])
+        self.assertEqual(schema.convert(['-', 'eth1']), ['-', 'eth1'])
+        with self.assertLogs(level='WARNING') as logs:
+            self.assertEqual(schema.convert(['1000', 'eth2']), [1000.0, 'eth2'])
+        self.assertIn('Column speed got a number after 2 values', logs.output[0])
+        self.assertEqual(schema.kinds, ['numeric', None])
+        self.assertEqual(schema.convert(['N/A', '3']), ['N/A', 3.0])
+
+    def test_type_flip(self):
+        """ Test that a numeric column getting text keeps the value
+        """
+        schema = sshpoller.FieldSchema([(r'(\d+)', [])])
+        self.assertEqual(schema.convert(['n/a']), ['n/a'])
+        self.assertEqual(schema.convert(['10']), [10.0])
+
+    def test_parse_typed(self):
+        """ Test that typed parsing gives the same values as float_if_possible()
+        """
+        mock_output = open(os.path.join('mockssh', 'cisco_show_interface.txt'), 'r').read()
+        attrs = {'Command': 'show interface', 'Platform': 'cisco_nxos'}
+        header, records = sshpoller.template_registry.parse(mock_output, attrs)
+        header, typed = sshpoller.template_registry.parse(mock_output, attrs, typed=True)
+
+        self.assertEqual(typed, [[sshpoller.float_if_possible(value) for value in record] for record in records])
+
+class SSH_PollerTest_ResultTable(unittest.TestCase):
+    def setUp(self):
+        self.table = sshpoller.ResultTable(
+            'show interface',
+            ['intf_name', 'input_packets'],
+            [('Ethernet1/1', 10.0), ('Ethernet1/2', 20.0), ('', 30.0)],
+            {'host': 'localhost', 'command': 'intf_name'},
+            1469203919,
+            tag_column='intf_name')
+
+    def tearDown(self):
+        pass
+
+    def test_dicts(self):
+        """ Test the dictionary view of the rows
+        """
+        rows = list(self.table.dicts())
+
+        self.assertEqual(len(self.table), 3)
+        self.assertEqual(rows[0], {
+            'tag': {'host': 'localhost', 'command': 'intf_name', 'intf_name': 'Ethernet1/1'},
+            'command': 'show interface',
+            'fields': {'intf_name': 'Ethernet1/1', 'input_packets': 10.0},
+            'timestamp': 1469203919})
+
+    def test_line_protocol(self):
+        """ Test that rows serialize like their dictionary view
+        """
+        self.assertEqual(self.table.to_line_protocol(), [sshpoller.to_line_protocol(data) for data in self.table.dicts()])
+
+    def test_index_tag(self):
+        """ Test tagging the rows with their position
+        """
+        table = sshpoller.ResultTable('tmctl', ['a'], [(1.0,), (2.0,)], {'host': 'localhost'}, 0, index_tag='instance')
+
+        self.assertEqual([data['tag'] for data in table.dicts()],
+                         [{'host': 'localhost', 'instance': 0}, {'host': 'localhost', 'instance': 1}])
+        self.assertEqual(table.to_line_protocol(), ['tmctl,host=localhost,instance=0 a=1.0 0', 'tmctl,host=localhost,instance=1 a=2.0 0'])
+
+    def test_data_list_view(self):
+        """ Test that data_list lists the rows of the parsed tables
+        """
+        task = {
+            'hostname': 'localhost',
+            'username': 'test',
+            'password': 'test',
+            'port': 9999,
+            'device_type': 'cisco_nxos',
+            'parser_mode': 'fsm',
+            'precommands': '',
+            'interval': 0,
+            'commands': ['show interface:intf_name'],
+        }
+        poller = sshpoller.SSH_Poller(task)
+        poller.add_result(self.table)
+        poller.add_result({'command': 'extra', 'tag': {}, 'fields': {'a': 1.0}, 'timestamp': 0})
+
+        self.assertEqual(len(poller.data_list), 4)
+        self.assertIs(poller.data_list, poller.data_list)
+        self.assertEqual(sshpoller.batch_points(poller.batch), 4)
+
+class SSH_PollerTest_TemplateRegistry(unittest.TestCase):
+    def setUp(self):
+        self.template_dir = tempfile.mkdtemp()
+        for name in os.listdir(template_dir):
+            shutil.copy(os.path.join(template_dir, name), self.template_dir)
+        self.registry = sshpoller.TemplateRegistry(index_file, self.template_dir)
+        self.attrs = {'Command': 'show interface', 'Platform': 'cisco_nxos'}
+        self.mock_output = open(os.path.join('mockssh', 'cisco_show_interface.txt'), 'r').read()
+
+    def tearDown(self):
+        shutil.rmtree(self.template_dir)
+
+    def test_parse_matches_clitable(self):
+        """ Test TemplateRegistry.parse() against CliTable
+        """
+        cli_table = clitable.CliTable(index_file, template_dir)
+        cli_table.ParseCmd(self.mock_output, self.attrs)
+        header, records = self.registry.parse(self.mock_output, self.attrs)
+
+        self.assertEqual(header, list(cli_table.header))
+        self.assertEqual(records, [list(row) for row in cli_table])
+
+    def test_template_compiled_once(self):
+        """ Test that templates are only compiled once
+        """
+        self.registry.parse(self.mock_output, self.attrs)
+        fsm = self.registry.templates['cisco_show_interface.template']['fsm']
+        self.registry.parse(self.mock_output, self.attrs)
+        self.registry.parse(self.mock_output, {'Command': 'sh int', 'Platform': 'cisco_nxos'})
+
+        self.assertIs(self.registry.templates['cisco_show_interface.template']['fsm'], fsm)
+        self.assertEqual(len(self.registry.templates), 1)
+
+    def test_template_reloaded_on_change(self):
+        """ Test that a modified template is recompiled
+        """
+        self.registry.parse(self.mock_output, self.attrs)
+        path = os.path.join(self.template_dir, 'cisco_show_interface.template')
+        with open(path, 'w') as f:
+            f.write('Value INTF_NAME (\\S+)\n\nStart\n  ^${INTF_NAME} is up -> Record\n')
+        mtime = os.stat(path).st_mtime
+        os.utime(path, (mtime + 10, mtime + 10))
+
+        header, records = self.registry.parse(self.mock_output, self.attrs)
+
+        self.assertEqual(header, ['INTF_NAME'])
+
+    def test_template_not_found(self):
+        """ Test that an unknown command raises CliTableError
+        """
+        with self.assertRaises(clitable.CliTableError):
+            self.registry.parse('', {'Command': 'show clock', 'Platform': 'cisco_nxos'})
+
+class SSH_PollerTest_InfluxWriter(unittest.TestCase):
+    def setUp(self):
+        self.influx = FakeInfluxDB()
+        self.data_list = json.loads(open(os.path.join('mockssh', 'cisco_show_interface_tag.json'), 'r').read())
+
+    def tearDown(self):
+        self.influx.stop()
+
+    def test_to_line_protocol(self):
+        """ Test to_line_protocol()
+        """
+        data = {
+            'command': 'show interface',
+            'tag': {'host': 'localhost', 'command': '', 'intf_name': 'Ethernet1/1'},
+            'fields': {'input_packets': 10.0, 'intf_name': 'Ethernet1/1', 'descr': 'to "core", 1'},
+            'timestamp': 1469203919
+        }
+        self.assertEqual(
+            sshpoller.to_line_protocol(data),
+            'show\\ interface,host=localhost,intf_name=Ethernet1/1 '
+            'descr="to \\"core\\", 1",input_packets=10.0,intf_name="Ethernet1/1" 1469203919')
+
+    def test_batches(self):
+        """ Test that points are grouped by batch size
+        """
+        writer = sshpoller.InfluxWriter('127.0.0.1', self.influx.port, 'root', 'root', 'db_name', batch_size=5, max_latency=0)
+        writer.write(self.data_list)
+        self.assertEqual(self.influx.requests, len(self.data_list) // 5)
+        writer.flush()
+
+        self.assertEqual(self.influx.requests, (len(self.data_list) + 4) // 5)
+        self.assertEqual(self.influx.lines, [sshpoller.to_line_protocol(data) for data in self.data_list])
+
+    def test_max_latency(self):
+        """ Test that a partial batch is written after max_latency
+        """
+        writer = sshpoller.InfluxWriter('127.0.0.1', self.influx.port, 'root', 'root', 'db_name', batch_size=5000, max_latency=0.2)
+        writer.write(self.data_list)
+        self.assertEqual(self.influx.requests, 0)
+        sleep(0.5)
+
+        self.assertEqual(self.influx.requests, 1)
+        self.assertEqual(len(self.influx.lines), len(self.data_list))
+
+    def test_gzip(self):
+        """ Test compressed writes
+        """
+        writer = sshpoller.InfluxWriter('127.0.0.1', self.influx.port, 'root', 'root', 'db_name', gzip=True)
+        writer.write(self.data_list)
+        writer.flush()
+
+        self.assertEqual(len(self.influx.lines), len(self.data_list))
+        self.assertLess(self.influx.bytes, len('\n'.join(self.influx.lines)))
+
+    def test_one_shot_flush(self):
+        """ Test that a one-shot poll is written right away, with the interval from the command line ('0')
+        """
+        task = {
+            'hostname': 'localhost',
+            'username': 'test',
+            'password': 'test',
+            'port': 9999,
+            'mode': 'influx',
+            'device_type': 'cisco_nxos',
+            'parser_mode': 'fsm',
+            'precommands': '',
+            'interval': '0',
+            'commands': ['show version'],
+        }
+        with mock.patch.object(sshpoller.SSH_Poller, 'db_port', self.influx.port):
+            poller = sshpoller.SSH_Poller(task)
+            poller.sock = FakeConnection()
+            poller.send_commands()
+            poller.output_influxdb()
+
+        self.assertEqual(self.influx.points, 1)
+
+class SSH_PollerTest_ResultBuffer(unittest.TestCase):
+    def setUp(self):
+        self.task = {
+            'hostname': 'localhost',
+            'username': 'test',
+            'password': 'test',
+            'port': 9999,
+            'device_type': 'cisco_nxos',
+            'parser_mode': 'fsm',
+            'precommands': '',
+            'interval': 60,
+            'commands': ['show interface:intf_name'],
+        }
+
+    def tearDown(self):
+        pass
+
+    def test_drop_oldest(self):
+        """ Test that the oldest batches are dropped when the buffer is full
+        """
+        buf = sshpoller.ResultBuffer(max_points=5)
+        buf.put([1, 2])
+        buf.put([3, 4])
+        buf.put([5, 6, 7])
+
+        self.assertEqual(buf.get_all(), [[3, 4], [5, 6, 7]])
+        self.assertEqual(buf.dropped, 2)
+        self.assertEqual(buf.points, 0)
+
+    def test_block(self):
+        """ Test that a full buffer blocks the producer until batches are written
+        """
+        buf = sshpoller.ResultBuffer(max_points=2, policy='block')
+        buf.put([1, 2])
+        consumer = threading.Timer(0.2, buf.get_all)
+        consumer.start()
+        buf.put([3])
+        consumer.join()
+
+        self.assertEqual(buf.get_all(), [[3]])
+        self.assertEqual(buf.dropped, 0)
+
+    def test_block_timeout(self):
+        """ Test that a full buffer nobody drains only blocks until the timeout
+        """
+        buf = sshpoller.ResultBuffer(max_points=2, policy='block', timeout=0.2)
+        buf.put([1, 2])
+        start = time()
+        buf.put([3])
+
+        self.assertLess(time() - start, 1.0)
+        self.assertEqual(buf.get_all(), [[3]])
+        self.assertEqual(buf.dropped, 2)
+
+    def test_oversized_table(self):
+        """ Test that a table over the buffer limit is cut to the limit
+        """
+        table = sshpoller.ResultTable('show interface', ['intf_name'], [('Ethernet1/%s' % i,) for i in range(10)],
+                                      {'host': 'localhost'}, 0, tag_column='intf_name')
+        buf = sshpoller.ResultBuffer(max_points=4)
+        buf.put([table])
+
+        batches = buf.get_all()
+        self.assertEqual(len(batches[0][0]), 4)
+        self.assertEqual(batches[0][0].rows, table.rows[:4])
+        self.assertEqual(buf.dropped, 6)
+
+    def test_status_rows_in_cycle_batch(self):
+        """ Test that the status rows of a cycle never push its data out of the buffer
+        """
+        influx = FakeInfluxDB(keep_lines='show\\ interface')
+        task = dict(self.task, mode='influx')
+        try:
+            with mock.patch.object(sshpoller.SSH_Poller, 'connect', fake_connect), \
+                    mock.patch.object(sshpoller.SSH_Poller, 'db_port', influx.port), \
+                    mock.patch.object(sshpoller.SSH_Poller, 'buffer_max_points', 8):
+                scheduler = sshpoller.PollScheduler([task])
+                poller = scheduler.pollers[0]
+                scheduler.poll(poller)
+                sshpoller.poller_influx_writer(poller).flush()
+        finally:
+            influx.stop()
+
+        # 7 interfaces, and the schedule, session and health rows over the limit
+        self.assertEqual(len(influx.lines), 7)
+        self.assertEqual(poller.results.dropped, 2)
+
+    def test_long_run(self):
+        """ Test that memory and points per cycle stay flat over thousands of cycles
+        """
+        influx = FakeInfluxDB(keep_lines=False)
+        poller = sshpoller.SSH_Poller(self.task)
+        poller.db_port = influx.port
+        poller.sock = FakeConnection()
+        writer = sshpoller.get_influx_writer(
+            poller.db_host, poller.db_port, poller.db_user, poller.db_password, poller.db_name,
+            batch_size=poller.db_batch_size, max_latency=0)
+
+        cycles = 3000
+        rss = []
+        for i in range(cycles):
+            poller.send_commands()
+            self.assertEqual(poller.results.points, 7)
+            poller.output_influxdb()
+            self.assertEqual(poller.results.points, 0)
+            if i in (cycles // 10, cycles - 1):
+                rss.append(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+        writer.flush()
+        influx.stop()
+
+        # Each point was written exactly once
+        self.assertEqual(influx.points, cycles * 7)
+        # Peak RSS (kB) grew by less than 5MB
+        self.assertLess(rss[1] - rss[0], 5 * 1024)
+
+def fake_connect(poller):
+    """ Replaces SSH_Poller.connect() with a fixture-serving connection """
+    poller.sock = FakeConnection()
+    return True
+
+
+class SSH_PollerTest_Scheduler(unittest.TestCase):
+    def setUp(self):
+        self.influx = FakeInfluxDB(keep_lines=False)
+
+    def tearDown(self):
+        self.influx.stop()
+
+    def make_task(self, hostname, interval):
+        return {
+            'hostname': hostname,
+            'username': 'test',
+            'password': 'test',
+            'port': 9999,
+            'mode': 'influx',
+            'device_type': 'cisco_nxos',
+            'parser_mode': 'fsm',
+            'precommands': '',
+            'interval': interval,
+            'commands': ['show version'],
+        }
+
+    def test_split_tasks(self):
+        """ Test split_tasks()
+        """
+        self.assertEqual(sshpoller.split_tasks(list(range(5)), 2), [[0, 2, 4], [1, 3]])
+        self.assertEqual(sshpoller.split_tasks(list(range(2)), 4), [[0], [1]])
+
+    def test_intervals(self):
+        """ Test that each task is polled at its own interval
+        """
+        with mock.patch.object(sshpoller.SSH_Poller, 'connect', fake_connect), \
+                mock.patch.object(sshpoller.SSH_Poller, 'db_port', self.influx.port), \
+                mock.patch.object(sshpoller.PollScheduler, 'phase_spread', False):
+            scheduler = sshpoller.PollScheduler([
+                self.make_task('fast', 0.1),
+                self.make_task('slow', 0.3),
+                self.make_task('once', 0)])
+            threading.Timer(0.65, scheduler.stop).start()
+            scheduler.run()
+
+        polls = dict((poller.hostname, len(poller.sock.commands)) for poller in scheduler.pollers)
+        self.assertIn(polls['fast'], (6, 7))
+        self.assertEqual(polls['slow'], 3)
+        self.assertEqual(polls['once'], 1)
+
+    def test_parse_error(self):
+        """ Test that a command which fails to parse neither resets the session nor loses the other commands
+        """
+        connects = []
+
+        def count_connect(poller):
+            connects.append(poller.hostname)
+            return fake_connect(poller)
+
+        task = dict(self.make_task('device', 0.1), commands=['show version:bogus', 'show interface:intf_name'])
+        reference = sshpoller.SSH_Poller(dict(task, commands=['show interface:intf_name']))
+        reference.sock = FakeConnection()
+        reference.send_commands()
+        lines = [line for table in reference.batch for line in table.to_line_protocol()]
+        self.influx.keep_lines = lines[0].split(',', 1)[0]
+
+        with mock.patch.object(sshpoller.SSH_Poller, 'connect', count_connect), \
+                mock.patch.object(sshpoller.SSH_Poller, 'db_port', self.influx.port), \
+                mock.patch.object(sshpoller.PollScheduler, 'phase_spread', False):
+            scheduler = sshpoller.PollScheduler([task])
+            threading.Timer(0.35, scheduler.stop).start()
+            scheduler.run()
+            sshpoller.poller_influx_writer(scheduler.pollers[0]).flush()
+
+        polls = len(scheduler.pollers[0].sock.commands) // 2
+        self.assertEqual(connects, ['device'])
+        self.assertTrue(scheduler.pollers[0].session_up)
+        self.assertEqual(len(self.influx.lines), polls * len(lines))
+
+    def test_no_drift(self):
+        """ Test that the command time doesn't stretch the polling period
+        """
+        def slow_connect(poller):
+            poller.sock = FakeConnection(delay=0.05)
+            return True
+
+        with mock.patch.object(sshpoller.SSH_Poller, 'connect', slow_connect), \
+                mock.patch.object(sshpoller.SSH_Poller, 'db_port', self.influx.port), \
+                mock.patch.object(sshpoller.PollScheduler, 'phase_spread', False):
+            scheduler = sshpoller.PollScheduler([self.make_task('device', 0.1)])
+            threading.Timer(0.95, scheduler.stop).start()
+            scheduler.run()
+
+        self.assertIn(len(scheduler.pollers[0].sock.commands), (9, 10))
+        self.assertEqual(scheduler.stats()['device']['skipped'], 0)
+
+    def test_deadline_skips_overrun(self):
+        """ Test that overrun cycles are skipped and counted
+        """
+        deadline = sshpoller.Deadline(10, start=0.0)
+        deadline.start(0.5)
+        deadline.advance(35.0)
+
+        self.assertEqual(deadline.next, 40.0)
+        self.assertEqual(deadline.skipped, 3)
+        self.assertEqual(deadline.lateness, 0.5)
+
+        deadline.start(41.0)
+        deadline.advance(42.0)
+
+        self.assertEqual(deadline.next, 50.0)
+        self.assertEqual(deadline.skipped, 3)
+        self.assertEqual(deadline.max_lateness, 1.0)
+
+    def test_deadline_duration(self):
+        """ Test that the duration of the last complete cycle is reported
+        """
+        deadline = sshpoller.Deadline(10, start=0.0)
+        deadline.advance(5.0)
+        self.assertEqual(deadline.point('localhost')['fields']['duration'], 0.0)
+
+        deadline.start(10.5)
+        deadline.advance(12.0)
+        self.assertEqual(deadline.point('localhost')['fields']['duration'], 1.5)
+
+    def test_poll_phase(self):
+        """ Test that start phases are stable and spread over the interval
+        """
+        phases = [sshpoller.poll_phase('10.0.0.%s' % i, 22, 60) for i in range(100)]
+
+        self.assertEqual(phases, [sshpoller.poll_phase('10.0.0.%s' % i, 22, 60) for i in range(100)])
+        self.assertTrue(all(0 <= phase < 60 for phase in phases))
+        self.assertLess(min(phases), 10)
+        self.assertGreater(max(phases), 50)
+
+    def test_worker_task_list(self):
+        """ Test that worker() polls every task of its list
+        """
+        input_queue = Queue()
+        input_queue.put([self.make_task('first', 0), self.make_task('second', 0)])
+        with mock.patch.object(sshpoller.SSH_Poller, 'connect', fake_connect), \
+                mock.patch.object(sshpoller.SSH_Poller, 'db_port', self.influx.port):
+            sshpoller.worker(input_queue, Queue())
+
+        self.assertEqual(self.influx.points, 2)
+
+class SSH_PollerTest_Session(unittest.TestCase):
+    def setUp(self):
+        self.influx = FakeInfluxDB(keep_lines=False)
+        self.task = {
+            'hostname': 'localhost',
+            'username': 'test',
+            'password': 'test',
+            'port': 9999,
+            'mode': 'influx',
+            'device_type': 'cisco_nxos',
+            'parser_mode': 'fsm',
+            'precommands': ['terminal length 0'],
+            'interval': 60,
+            'commands': ['show version'],
+        }
+        self.patches = [
+            mock.patch.object(sshpoller, 'ConnectHandler', FakeConnection),
+            mock.patch.object(sshpoller.SSH_Poller, 'db_port', self.influx.port)]
+        for patch in self.patches:
+            patch.start()
+        self.scheduler = sshpoller.PollScheduler([self.task])
+        self.poller = self.scheduler.pollers[0]
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.influx.stop()
+
+    def test_session_kept(self):
+        """ Test that the session is reused between cycles
+        """
+        for i in range(3):
+            self.assertTrue(self.scheduler.poll(self.poller))
+
+        self.assertEqual(self.poller.session_stats['handshakes'], 1)
+        self.assertEqual(self.poller.session_stats['handshakes_avoided'], 2)
+        self.assertEqual(self.poller.sock.commands, ['terminal length 0'] + ['show version'] * 3)
+
+    def test_dead_session(self):
+        """ Test that a dead session is detected and reopened with the precommands
+        """
+        self.scheduler.poll(self.poller)
+        old_sock = self.poller.sock
+        old_sock.alive = False
+        self.assertTrue(self.scheduler.poll(self.poller))
+
+        self.assertIsNot(self.poller.sock, old_sock)
+        self.assertEqual(self.poller.sock.commands, ['terminal length 0', 'show version'])
+        self.assertEqual(self.poller.session_stats['handshakes'], 2)
+        self.assertEqual(self.poller.session_stats['reconnects'], 1)
+
+    def test_session_lost_during_poll(self):
+        """ Test that a session dying mid-cycle doesn't stop the polling
+        """
+        self.scheduler.poll(self.poller)
+        self.poller.sock.send_command = mock.Mock(side_effect=OSError('Socket is closed'))
+        self.assertTrue(self.scheduler.poll(self.poller))
+        self.assertFalse(self.poller.session_up)
+
+        self.assertTrue(self.scheduler.poll(self.poller))
+        self.assertTrue(self.poller.session_up)
+        self.assertEqual(self.poller.session_stats['reconnects'], 1)
+
+    def test_reconnect_backoff(self):
+        """ Test the exponential backoff between reconnects
+        """
+        with mock.patch.object(sshpoller, 'ConnectHandler', mock.Mock(side_effect=OSError('Connection refused'))):
+            self.assertFalse(self.poller.ensure_session())
+            self.assertFalse(self.poller.ensure_session())
+            self.assertEqual(self.poller.session_stats['handshakes'], 1)
+
+            self.poller.next_reconnect = 0
+            self.assertFalse(self.poller.ensure_session())
+            self.assertEqual(self.poller.session_stats['handshakes'], 2)
+            self.assertEqual(self.poller.reconnect_delay, 4 * self.poller.reconnect_min_delay)
+
+        self.poller.next_reconnect = 0
+        self.assertTrue(self.poller.ensure_session())
+        self.assertEqual(self.poller.reconnect_delay, self.poller.reconnect_min_delay)
+        self.assertEqual(self.poller.session_stats['reconnects'], 1)
+
+    def test_connect_error_not_on_stdout(self):
+        """ Test that failed connects are logged, not printed where NDJSON records may go
+        """
+        stdout = io.StringIO()
+        with mock.patch.object(sshpoller, 'ConnectHandler', mock.Mock(side_effect=OSError('Connection refused'))), \
+                mock.patch('sys.stdout', stdout), self.assertLogs(level='ERROR') as logs:
+            self.assertFalse(self.poller.ensure_session())
+
+        self.assertEqual(stdout.getvalue(), '')
+        self.assertIn('Unexpected error connecting to localhost', logs.output[0])
+
+@unittest.skipIf(asyncssh is None, 'asyncssh is not installed')
+class SSH_PollerTest_AsyncEngine(unittest.TestCase):
+    def setUp(self):
+        self.fleet = AsyncMockFleet(3)
+        self.influx = FakeInfluxDB()
+
+    def tearDown(self):
+        self.fleet.stop()
+        self.influx.stop()
+
+    def make_task(self, port):
+        return {
+            'hostname': '127.0.0.1',
+            'username': 'test',
+            'password': 'test',
+            'port': port,
+            'mode': 'influx',
+            'device_type': 'cisco_nxos',
+            'parser_mode': 'fsm',
+            'precommands': '',
+            'interval': 0,
+            'commands': ['show version', 'show interface:intf_name'],
+        }
+
+    def test_async_engine(self):
+        """ Test that the asyncio engine polls every device once
+        """
+        tasks = [self.make_task(port) for port in self.fleet.ports]
+        with mock.patch.object(sshpoller.SSH_Poller, 'db_port', self.influx.port):
+            sshpoller.AsyncEngine(tasks, parse_workers=2).run()
+
+        # Same rows as the parser gives for the fixtures
+        expected = []
+        for command in sshpoller.SSH_Poller(tasks[0]).command_list:
+            output = open(os.path.join('mockssh', 'cisco_%s.txt' % command['command'].replace(' ', '_')), 'r').read()
+            expected.extend(sshpoller.parse_output(tasks[0], command, output))
+        expected = sorted(line.rsplit(' ', 1)[0] for table in expected for line in table.to_line_protocol())
+
+        self.assertEqual(self.influx.points, len(expected) * len(tasks))
+        self.assertEqual(sorted(line.rsplit(' ', 1)[0] for line in self.influx.lines), sorted(expected * len(tasks)))
+
+    def test_output_errors(self):
+        """ Test that InfluxDB errors neither stop the engine nor reopen the SSH sessions
+        """
+        connects = []
+        connect = sshpoller.AsyncSession.connect
+
+        async def count_connect(session):
+            connects.append(session)
+            await connect(session)
+
+        def write_error(poller):
+            raise InfluxDBClientError('field type conflict', 400)
+
+        tasks = [dict(self.make_task(port), interval=0.2) for port in self.fleet.ports]
+        engine = sshpoller.AsyncEngine(tasks, parse_workers=1)
+        with mock.patch.object(sshpoller.AsyncSession, 'connect', count_connect), \
+                mock.patch.object(sshpoller.SSH_Poller, 'output_influxdb', write_error), \
+                mock.patch.object(sshpoller.PollScheduler, 'phase_spread', False):
+            threading.Timer(1.0, engine.stop).start()
+            engine.run()
+
+        self.assertEqual(len(connects), len(tasks))
+
+class SSH_PollerTest_Pipeline(unittest.TestCase):
+    def setUp(self):
+        self.influx = FakeInfluxDB()
+        self.task = {
+            'hostname': 'localhost',
+            'username': 'test',
+            'password': 'test',
+            'port': 9999,
+            'mode': 'influx',
+            'device_type': 'cisco_nxos',
+            'parser_mode': 'fsm',
+            'precommands': '',
+            'interval': 0,
+            'commands': ['show version', 'show interface:intf_name'],
+        }
+
+    def tearDown(self):
+        self.influx.stop()
+
+    def test_pipeline(self):
+        """ Test that I/O workers, parsers and output stage write the same points as a worker alone
+        """
+        input_queue, raw_queue, parsed_queue = Queue(), Queue(), Queue()
+        stats = sshpoller.PipelineStats(raw_queue, parsed_queue)
+        input_queue.put([self.task, dict(self.task, hostname='otherhost')])
+        with mock.patch.object(sshpoller.SSH_Poller, 'connect', fake_connect):
+            sshpoller.worker(input_queue, raw_queue, stats)
+
+        self.assertEqual(stats.snapshot()['polled'], 4)
+        for i in range(2):
+            raw_queue.put('STOP')
+        parsers = [threading.Thread(target=sshpoller.parser_worker, args=(raw_queue, parsed_queue, stats))
+                   for i in range(2)]
+        for parser in parsers:
+            parser.start()
+        with mock.patch.object(sshpoller.SSH_Poller, 'db_port', self.influx.port):
+            sshpoller.output_worker(parsed_queue, stats, parsers=2)
+        for parser in parsers:
+            parser.join()
+
+        expected = []
+        for hostname in ('localhost', 'otherhost'):
+            poller = sshpoller.SSH_Poller(dict(self.task, hostname=hostname))
+            poller.sock = FakeConnection()
+            poller.send_commands()
+            expected.extend(line for table in poller.batch for line in table.to_line_protocol())
+
+        # Timestamps were taken by the I/O worker, before parsing
+        strip = lambda lines: sorted(line.rsplit(' ', 1)[0] for line in lines)
+        self.assertEqual(strip(self.influx.lines), strip(expected))
+        self.assertEqual(stats.snapshot()['parsed'], 4)
+        self.assertEqual(stats.snapshot()['written'], len(expected))
+        self.assertEqual(stats.snapshot()['raw_queue'], 0)
+
+    def test_parse_error(self):
+        """ Test that an output which fails to parse doesn't stop the pipeline
+        """
+        input_queue, raw_queue, parsed_queue = Queue(), Queue(), Queue()
+        stats = sshpoller.PipelineStats(raw_queue, parsed_queue)
+        input_queue.put([dict(self.task, hostname='badhost', commands=['show version:bogus']), self.task])
+        with mock.patch.object(sshpoller.SSH_Poller, 'connect', fake_connect):
+            sshpoller.worker(input_queue, raw_queue, stats)
+
+        raw_queue.put('STOP')
+        parser = threading.Thread(target=sshpoller.parser_worker, args=(raw_queue, parsed_queue, stats))
+        parser.start()
+        with mock.patch.object(sshpoller.SSH_Poller, 'db_port', self.influx.port):
+            sshpoller.output_worker(parsed_queue, stats, parsers=1)
+        parser.join()
+
+        poller = sshpoller.SSH_Poller(self.task)
+        poller.sock = FakeConnection()
+        poller.send_commands()
+        expected = [line for table in poller.batch for line in table.to_line_protocol()]
+        self.assertEqual(stats.snapshot()['errors'], 1)
+        self.assertEqual(stats.snapshot()['parsed'], 2)
+        self.assertEqual(len(self.influx.lines), len(expected))
+
+class SSH_PollerTest_Channels(unittest.TestCase):
+    def setUp(self):
+        self.task = {
+            'hostname': 'localhost',
+            'username': 'test',
+            'password': 'test',
+            'port': 9999,
+            'mode': 'json',
+            'device_type': 'cisco_nxos',
+            'parser_mode': 'fsm',
+            'precommands': '',
+            'interval': 0,
+            'commands': ['show version', 'show interface:intf_name', 'show platform software qd info counters',
+                         'show version'],
+        }
+
+    def poll(self, max_channels, connect_handler):
+        poller = sshpoller.SSH_Poller(dict(self.task, max_channels=max_channels))
+        with mock.patch.object(sshpoller, 'ConnectHandler', connect_handler):
+            poller.connect()
+            start = time()
+            poller.send_commands()
+            wall = time() - start
+        return poller, wall
+
+    def test_concurrent_commands(self):
+        """ Test that commands run concurrently over several sessions, with the results in order
+        """
+        slow = lambda **kwargs: FakeConnection(delay=0.2)
+        serial, serial_wall = self.poll(1, slow)
+        concurrent, concurrent_wall = self.poll(4, slow)
+
+        self.assertEqual(len(concurrent.channels), 3)
+        self.assertEqual(sum(len(sock.commands) for sock in [concurrent.sock] + concurrent.channels), 4)
+        strip = lambda rows: [dict(row, timestamp=0) for row in rows]
+        self.assertEqual(strip(concurrent.data_list), strip(serial.data_list))
+        self.assertEqual([table.command for table in concurrent.batch], [table.command for table in serial.batch])
+        self.assertGreater(serial_wall, 0.8)
+        self.assertLess(concurrent_wall, 0.4)
+
+        concurrent.disconnect()
+        self.assertEqual(concurrent.channels, [])
+
+    def test_refused_channel(self):
+        """ Test that a device refusing extra sessions caps max_channels
+        """
+        sessions = []
+
+        def limited(**kwargs):
+            if len(sessions) == 2:
+                raise OSError('Too many sessions')
+            sessions.append(FakeConnection())
+            return sessions[-1]
+
+        poller, wall = self.poll(4, limited)
+
+        self.assertEqual(poller.max_channels, 2)
+        self.assertEqual(len(poller.batch), 4)
+
+class SSH_PollerTest_ParseCache(unittest.TestCase):
+    def setUp(self):
+        self.task = {
+            'hostname': 'localhost',
+            'username': 'test',
+            'password': 'test',
+            'port': 9999,
+            'mode': 'influx',
+            'device_type': 'cisco_nxos',
+            'parser_mode': 'fsm',
+            'precommands': '',
+            'interval': 0,
+            'commands': ['show interface:intf_name'],
+        }
+        self.output = open(os.path.join('mockssh', 'cisco_show_interface.txt'), 'r').read()
+        self.command = {'command': 'show interface', 'tag': 'intf_name'}
+        self.patcher = mock.patch.object(sshpoller, 'parse_cache', sshpoller.ParseCache())
+        self.cache = self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def test_unchanged_output(self):
+        """ Test that an unchanged output reuses the parsed rows with the new timestamp
+        """
+        poller = sshpoller.SSH_Poller(self.task)
+        poller.parse(self.output, self.command, 100)
+        with mock.patch.object(sshpoller.template_registry, 'parse') as parse:
+            poller.parse(self.output, self.command, 200)
+            self.assertFalse(parse.called)
+
+        first, second = poller.batch
+        self.assertIs(second.rows, first.rows)
+        self.assertEqual((first.timestamp, second.timestamp), (100, 200))
+        self.assertEqual(self.cache.stats(), {'entries': 1, 'hits': 1, 'misses': 1, 'evictions': 0})
+
+        # Same output, other device
+        sshpoller.SSH_Poller(dict(self.task, hostname='otherhost')).parse(self.output, self.command, 200)
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_changed_output(self):
+        """ Test that a changed output is parsed again
+        """
+        poller = sshpoller.SSH_Poller(self.task)
+        poller.parse(self.output, self.command, 100)
+        poller.parse(self.output.replace('Ethernet1/1 ', 'Ethernet1/9 ', 1), self.command, 200)
+
+        self.assertEqual(self.cache.hits, 0)
+        self.assertEqual(poller.batch[1].rows[0][poller.batch[1].header.index('intf_name')], 'Ethernet1/9')
+
+    def test_suppress_unchanged(self):
+        """ Test that the points of an unchanged output are not written in suppress mode
+        """
+        poller = sshpoller.SSH_Poller(self.task)
+        with mock.patch.object(sshpoller.SSH_Poller, 'suppress_unchanged', True):
+            poller.parse(self.output, self.command, 100)
+            poller.parse(self.output, self.command, 200)
+
+        self.assertEqual(len(poller.batch), 1)
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_lru(self):
+        """ Test that the cache holds at most max_entries commands, least recently used first out
+        """
+        cache = sshpoller.ParseCache(2)
+        for key in ('a', 'b', 'a', 'c'):
+            if cache.get(key, 'digest') is None:
+                cache.put(key, 'digest', [])
+
+        self.assertEqual(list(cache.entries), ['a', 'c'])
+        self.assertEqual(cache.stats(), {'entries': 2, 'hits': 1, 'misses': 3, 'evictions': 1})
+
+class SSH_PollerTest_Rates(unittest.TestCase):
+    def setUp(self):
+        self.store = sshpoller.RateStore()
+
+    def table(self, timestamp, rows):
+        return sshpoller.ResultTable('show interface', ['intf_name', 'input_packets', 'mtu'], rows,
+                                     {'host': 'localhost', 'command': 'intf_name'}, timestamp, tag_column='intf_name')
+
+    def test_rates(self):
+        """ Test that rates and deltas are computed per row from the previous sample
+        """
+        first = self.store.apply(self.table(100, [('Eth1', 1000.0, 1500.0)]), 'localhost', ['input_packets'])
+        self.assertEqual(first.header, ['intf_name', 'input_packets', 'mtu', 'input_packets_delta', 'input_packets_rate'])
+        self.assertEqual(first.rows, [('Eth1', 1000.0, 1500.0, None, None)])
+        # No rate on the first sample
+        self.assertNotIn('input_packets_rate', first.to_line_protocol()[0])
+
+        second = self.store.apply(self.table(110, [('Eth1', 1500.0, 1500.0), ('Eth2', 10.0, 1500.0)]),
+                                  'localhost', ['input_packets'])
+        self.assertEqual(second.rows, [('Eth1', 1500.0, 1500.0, 500.0, 50.0), ('Eth2', 10.0, 1500.0, None, None)])
+        self.assertIn('input_packets_rate=50.0', second.to_line_protocol()[0])
+
+        # Other device, same interface
+        other = self.store.apply(self.table(110, [('Eth1', 1500.0, 1500.0)]), 'otherhost', ['input_packets'])
+        self.assertEqual(other.rows, [('Eth1', 1500.0, 1500.0, None, None)])
+
+    def test_wrap_and_reset(self):
+        """ Test that 32-bit wraps are counted up and resets restart from a new baseline
+        """
+        self.store.apply(self.table(100, [('Eth1', 2.0 ** 32 - 100, 0.0)]), 'localhost', ['input_packets'])
+        wrapped = self.store.apply(self.table(110, [('Eth1', 900.0, 0.0)]), 'localhost', ['input_packets'])
+        self.assertEqual(wrapped.rows[0][3:], (1000.0, 100.0))
+        self.assertEqual(self.store.wraps, 1)
+
+        self.store.apply(self.table(120, [('Eth1', 5000.0, 0.0)]), 'localhost', ['input_packets'])
+        reset = self.store.apply(self.table(130, [('Eth1', 10.0, 0.0)]), 'localhost', ['input_packets'])
+        self.assertEqual(reset.rows[0][3:], (None, None))
+        self.assertEqual(self.store.resets, 1)
+
+        after = self.store.apply(self.table(140, [('Eth1', 20.0, 0.0)]), 'localhost', ['input_packets'])
+        self.assertEqual(after.rows[0][3:], (10.0, 1.0))
+
+    def test_stale_rows(self):
+        """ Test that rows gone for stale_cycles tables and idle devices are forgotten
+        """
+        self.store.apply(self.table(100, [('Eth1', 1.0, 0.0), ('Eth2', 1.0, 0.0)]), 'localhost', ['input_packets'])
+        self.store.apply(self.table(100, [('Eth1', 1.0, 0.0)]), 'otherhost', ['input_packets'])
+        for timestamp in (110, 120):
+            self.store.apply(self.table(timestamp, [('Eth1', 1.0, 0.0)]), 'localhost', ['input_packets'])
+        self.assertEqual(len(self.store.samples[('localhost', 'show interface')]), 2)
+
+        self.store.apply(self.table(130, [('Eth1', 1.0, 0.0)]), 'localhost', ['input_packets'])
+        self.assertEqual(list(self.store.samples[('localhost', 'show interface')]), ['Eth1'])
+
+        self.store.apply(self.table(100 + self.store.expire + 1, [('Eth1', 1.0, 0.0)]), 'localhost', ['input_packets'])
+        self.assertEqual(list(self.store.samples), [('localhost', 'show interface')])
+
+        self.store.forget('localhost')
+        self.assertEqual(self.store.samples, {})
+        self.assertEqual(self.store.times, {})
+
+    def test_drop_counters(self):
+        """ Test that raw counters can be dropped from the output
+        """
+        self.store.apply(self.table(100, [('Eth1', 1000.0, 1500.0)]), 'localhost', ['input_packets'], False)
+        table = self.store.apply(self.table(110, [('Eth1', 1500.0, 1500.0)]), 'localhost', ['input_packets'], False)
+
+        self.assertEqual(table.header, ['intf_name', 'mtu', 'input_packets_delta', 'input_packets_rate'])
+        self.assertEqual(table.rows, [('Eth1', 1500.0, 500.0, 50.0)])
+
+    def test_yaml_command(self):
+        """ Test that rates are set per command with a YAML mapping
+        """
+        task = {
+            'hostname': 'localhost',
+            'username': 'test',
+            'password': 'test',
+            'port': 9999,
+            'device_type': 'cisco_nxos',
+            'parser_mode': 'fsm',
+            'precommands': '',
+            'interval': 0,
+            'commands': ['show version', {'command': 'show interface', 'tag': 'intf_name',
+                                          'rates': ['INPUT_PACKETS'], 'keep_counters': False}],
+        }
+        poller = sshpoller.SSH_Poller(task)
+        poller.sock = FakeConnection()
+        with mock.patch.object(sshpoller, 'rate_store', self.store):
+            poller.send_commands()
+
+        self.assertEqual(poller.command_list[1]['rates'], ['input_packets'])
+        self.assertNotIn('input_packets', poller.batch[1].header)
+        self.assertIn('input_packets_rate', poller.batch[1].header)
+        self.assertNotIn('input_packets_rate', poller.batch[0].header)
+
+class SSH_PollerTest_Spool(unittest.TestCase):
+    def setUp(self):
+        self.influx = FakeInfluxDB()
+        self.client = sshpoller.InfluxDBClient('127.0.0.1', self.influx.port, 'root', 'root', 'db_name')
+        self.directory = tempfile.mkdtemp()
+        self.lines = ['cpu,host=host%s value=%si 1469203919' % (i, i) for i in range(100)]
+        self.patcher = mock.patch.object(sshpoller.Spool, 'retry_min_delay', 0.05)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.influx.stop()
+        shutil.rmtree(self.directory)
+
+    def spool(self, **kwargs):
+        send = lambda lines: self.client.write_points(lines, time_precision='s', protocol='line')
+        return sshpoller.Spool(self.directory, send, batch_size=30, **kwargs)
+
+    def test_outage(self):
+        """ Test that points are kept while InfluxDB is down, and written once it's back
+        """
+        self.influx.paused = True
+        spool = self.spool()
+        start = time()
+        spool.append(self.lines)
+        # Appending doesn't wait for InfluxDB
+        self.assertLess(time() - start, 0.1)
+        self.assertFalse(spool.drain(0.3))
+        self.assertGreater(self.influx.rejected, 1)
+        self.assertEqual(self.influx.points, 0)
+
+        self.influx.paused = False
+        self.assertTrue(spool.drain(5))
+        spool.stop()
+
+        self.assertEqual(self.influx.lines, self.lines)
+        self.assertEqual(self.influx.requests, 4)
+
+    def test_replay(self):
+        """ Test that unsent points are written after a restart, and only once
+        """
+        self.influx.paused = True
+        spool = self.spool()
+        spool.append(self.lines[:50])
+        spool.stop()
+
+        # Restart with InfluxDB back
+        self.influx.paused = False
+        spool = self.spool()
+        spool.append(self.lines[50:])
+        self.assertTrue(spool.drain(5))
+        spool.stop()
+
+        spool = self.spool()
+        self.assertTrue(spool.drain(1))
+        spool.stop()
+
+        self.assertEqual(self.influx.lines, self.lines)
+
+    def test_rejected_batch(self):
+        """ Test that a batch InfluxDB rejects is set aside, and the next ones are still sent
+        """
+        sent = []
+
+        def send(lines):
+            if any('host=host1 ' in line for line in lines):
+                raise InfluxDBClientError('field type conflict', 400)
+            sent.extend(lines)
+
+        spool = sshpoller.Spool(self.directory, send, batch_size=30)
+        spool.append(self.lines)
+        self.assertTrue(spool.drain(5))
+        spool.stop()
+
+        self.assertEqual(sent, self.lines[30:])
+        self.assertEqual(spool.rejected, 30)
+        with open(os.path.join(self.directory, 'rejected.lines')) as f:
+            self.assertEqual(f.read().splitlines(), self.lines[:30])
+
+    def test_segment_dropped_while_reading(self):
+        """ Test that the flusher survives a segment dropped before it's read
+        """
+        read_batch = sshpoller.Spool.read_batch
+        calls = []
+
+        def dropped_once(spool):
+            calls.append(spool)
+            if len(calls) == 1:
+                raise FileNotFoundError('0000000000.lp')
+            return read_batch(spool)
+
+        with mock.patch.object(sshpoller.Spool, 'read_batch', dropped_once):
+            spool = self.spool()
+            spool.append(self.lines)
+            self.assertTrue(spool.drain(5))
+            spool.stop()
+
+        self.assertEqual(self.influx.lines, self.lines)
+
+    def test_partial_line(self):
+        """ Test that a line cut by a crash is dropped on restart
+        """
+        self.influx.paused = True
+        spool = self.spool()
+        spool.append(self.lines[:10])
+        spool.stop()
+        with open(os.path.join(self.directory, '%010d.lp' % 0), 'ab') as f:
+            f.write(b'cpu,host=cut val')
+
+        self.influx.paused = False
+        spool = self.spool()
+        spool.append(self.lines[10:20])
+        self.assertTrue(spool.drain(5))
+        spool.stop()
+
+        self.assertEqual(self.influx.lines, self.lines[:20])
+
+    def test_disk_budget(self):
+        """ Test that the oldest segments are dropped beyond the disk budget
+        """
+        self.influx.paused = True
+        spool = self.spool(segment_size=1000, max_bytes=3000)
+        for line in self.lines:
+            spool.append([line])
+        spool.stop()
+
+        segments = [name for name in os.listdir(self.directory) if name.endswith('.lp')]
+        self.assertLessEqual(sum(os.path.getsize(os.path.join(self.directory, name)) for name in segments), 3000)
+        self.assertGreater(spool.dropped, 0)
+
+        # What's left is the most recent points
+        self.influx.paused = False
+        spool = self.spool(segment_size=1000, max_bytes=3000)
+        self.assertTrue(spool.drain(5))
+        spool.stop()
+        self.assertEqual(self.influx.lines, self.lines[-len(self.influx.lines):])
+
+    def test_writer(self):
+        """ Test that the writer goes through the spool, one directory per writer
+        """
+        writer = sshpoller.InfluxWriter('127.0.0.1', self.influx.port, 'root', 'root', 'db_name',
+                                        max_latency=0, spool_dir=self.directory, spool_drain_timeout=5)
+        other = sshpoller.InfluxWriter('127.0.0.1', self.influx.port, 'root', 'root', 'db_name',
+                                       max_latency=0, spool_dir=self.directory)
+        self.assertNotEqual(writer.spool.directory, other.spool.directory)
+
+        writer.write([])
+        writer.lines = list(self.lines)
+        writer.flush()
+        writer.spool.stop()
+        other.spool.stop()
+
+        self.assertEqual(self.influx.lines, self.lines)
+
+class SSH_PollerTest_NDJSON(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.task = {
+            'hostname': 'localhost',
+            'username': 'test',
+            'password': 'test',
+            'port': 9999,
+            'mode': 'ndjson',
+            'device_type': 'cisco_nxos',
+            'parser_mode': 'fsm',
+            'precommands': '',
+            'interval': 0,
+            'commands': ['show version', 'show interface:intf_name'],
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def expected(self):
+        poller = sshpoller.SSH_Poller(dict(self.task, mode='json'))
+        poller.sock = FakeConnection()
+        poller.send_commands()
+        return [dict(row, timestamp=0) for row in poller.data_list]
+
+    def test_streaming(self):
+        """ Test that the records of each command are written as soon as it's parsed
+        """
+        writes = []
+
+        class Output:
+            def write(self, data):
+                writes.append(data)
+
+        poller = sshpoller.SSH_Poller(self.task)
+        poller.sock = FakeConnection()
+        send_command = poller.sock.send_command
+        written = []
+
+        def counting_send_command(command):
+            written.append(len(writes))
+            return send_command(command)
+
+        poller.sock.send_command = counting_send_command
+        with mock.patch.object(sshpoller, 'ndjson_output', Output()):
+            poller.send_commands()
+
+        # The first command was written before the second one was sent
+        self.assertEqual(written, [0, 1])
+        self.assertEqual(len(writes), 2)
+        records = [json.loads(line) for data in writes for line in data.splitlines()]
+        self.assertEqual([dict(row, timestamp=0) for row in records], self.expected())
+        self.assertEqual(poller.results.points, 0)
+
+    def test_writer_process(self):
+        """ Test that workers send their records through the writer process queue
+        """
+        path = os.path.join(self.directory, 'out.ndjson')
+        input_queue, output_queue = Queue(), Queue()
+        input_queue.put([self.task, dict(self.task, hostname='otherhost')])
+        with mock.patch.object(sshpoller.SSH_Poller, 'connect', fake_connect), \
+                mock.patch.object(sshpoller, 'ndjson_output', None), \
+                mock.patch.object(sshpoller, 'sinks', {}), \
+                mock.patch.object(sshpoller.SSH_Poller, 'ndjson_file', path):
+            sshpoller.worker(input_queue, output_queue)
+            self.assertIsInstance(sshpoller.ndjson_output, sshpoller.NdjsonQueue)
+            sshpoller.ndjson_output = None
+            output_queue.put('STOP')
+            sshpoller.sink_worker(output_queue, 'ndjson')
+            sshpoller.ndjson_output.file.close()
+
+        records = [json.loads(line) for line in open(path)]
+        self.assertEqual(len(records), 2 * len(self.expected()))
+        self.assertEqual(set(record['tag']['host'] for record in records), set(['localhost', 'otherhost']))
+
+    def test_rotation(self):
+        """ Test that the output file is rotated beyond max_bytes
+        """
+        path = os.path.join(self.directory, 'out.ndjson')
+        writer = sshpoller.NdjsonWriter(path, max_bytes=1000, backups=2)
+        for i in range(100):
+            writer.write(sshpoller.ndjson_dumps({'command': 'cpu', 'fields': {'value': i}}) + '\n')
+        writer.file.close()
+
+        self.assertEqual(sorted(os.listdir(self.directory)), ['out.ndjson', 'out.ndjson.1', 'out.ndjson.2'])
+        self.assertLess(os.path.getsize(path), 1000)
+        values = [json.loads(line)['fields']['value'] for name in ('out.ndjson.2', 'out.ndjson.1', 'out.ndjson')
+                  for line in open(os.path.join(self.directory, name))]
+        # Latest records, in order
+        self.assertEqual(values, list(range(100 - len(values), 100)))
+
+class SSH_PollerTest_Prometheus(unittest.TestCase):
+    def setUp(self):
+        # Clock of the scrapes, the writes pass their own
+        self.clock = 0.0
+        self.patcher = mock.patch.object(sshpoller, 'monotonic', lambda: self.clock)
+        self.patcher.start()
+        self.sink = sshpoller.PrometheusSink(port=0, expire=60)
+        self.table = sshpoller.ResultTable(
+            'show interface', ['intf_name', 'input_packets', 'descr'],
+            [('Ethernet1/1', 10.0, 'to "core"'), ('Ethernet1/2', 20.0, '')],
+            {'host': 'localhost', 'command': 'intf_name'}, 1469203919, tag_column='intf_name')
+
+    def tearDown(self):
+        self.sink.server.shutdown()
+        self.sink.server.server_close()
+        self.patcher.stop()
+
+    def scrape(self):
+        return urlopen('http://127.0.0.1:%s/metrics' % self.sink.port).read().decode('utf-8')
+
+    def test_metrics(self):
+        """ Test the exposition of the latest value of each series
+        """
+        self.sink.write([self.table], now=0)
+        self.sink.write([{'command': 'sshpoller_schedule', 'tag': {'host': 'localhost'},
+                          'fields': {'cycles': 3, 'lateness': 0.5}, 'timestamp': 1469203919}], now=0)
+
+        self.assertEqual(self.scrape(), (
+            '# TYPE show_interface_input_packets gauge\n'
+            'show_interface_input_packets{command="intf_name",host="localhost",intf_name="Ethernet1/1"} 10.0\n'
+            'show_interface_input_packets{command="intf_name",host="localhost",intf_name="Ethernet1/2"} 20.0\n'
+            '# TYPE sshpoller_schedule_cycles gauge\n'
+            'sshpoller_schedule_cycles{host="localhost"} 3\n'
+            '# TYPE sshpoller_schedule_lateness gauge\n'
+            'sshpoller_schedule_lateness{host="localhost"} 0.5\n'))
+
+        update = sshpoller.ResultTable('show interface', ['intf_name', 'input_packets', 'descr'], [('Ethernet1/1', 15.0, '')],
+                                       {'host': 'localhost', 'command': 'intf_name'}, 1469203979, tag_column='intf_name')
+        self.sink.write([update], now=10)
+        self.assertIn('intf_name="Ethernet1/1"} 15.0\n', self.scrape())
+        self.assertIn('intf_name="Ethernet1/2"} 20.0\n', self.scrape())
+
+    def test_incremental(self):
+        """ Test that only the metrics with a new value are rendered again
+        """
+        self.sink.write([self.table], now=0)
+        self.sink.write([{'command': 'cpu', 'tag': {'host': 'localhost'}, 'fields': {'load': 1.0}, 'timestamp': 0}], now=0)
+        self.sink.render()
+        cpu = self.sink.metrics['cpu_load']['text']
+
+        self.sink.write([self.table], now=1)
+        self.assertIsNotNone(self.sink.metrics['show_interface_input_packets']['text'])
+        self.sink.write([{'command': 'cpu', 'tag': {'host': 'localhost'}, 'fields': {'load': 2.0}, 'timestamp': 1}], now=1)
+        self.assertIsNone(self.sink.metrics['cpu_load']['text'])
+        self.assertNotEqual(self.sink.render(), cpu)
+
+    def test_expire(self):
+        """ Test that the series of a device that stopped reporting are removed
+        """
+        self.sink.write([self.table], now=0)
+        other = sshpoller.ResultTable('show interface', ['intf_name', 'input_packets'], [('Ethernet1/1', 1.0)],
+                                      {'host': 'otherhost', 'command': 'intf_name'}, 0, tag_column='intf_name')
+        for now in range(10, 100, 10):
+            self.sink.write([other], now=now)
+
+        metrics = self.scrape()
+        self.assertNotIn('host="localhost"', metrics)
+        self.assertIn('host="otherhost"', metrics)
+
+    def test_expire_on_scrape(self):
+        """ Test that series expire when no device writes anymore
+        """
+        self.sink.write([self.table], now=0)
+        self.assertIn('host="localhost"', self.scrape())
+
+        self.clock = 61.0
+        self.assertEqual(self.scrape(), '')
+
+class SSH_PollerTest_Prefilter(unittest.TestCase):
+    fixtures = [
+        ('cisco_nxos', 'show version', 'cisco_show_version.txt'),
+        ('cisco_nxos', 'show interface', 'cisco_show_interface.txt'),
+        ('cisco_nxos', 'show platform software qd info counters', 'cisco_show_platform_software_qd_info_counters.txt'),
+        ('f5_ltm', 'show sys tmm-info', 'f5_show_tmm_info.txt'),
+        ('juniper', 'show version', 'juniper_show_version.txt'),
+        ('juniper', 'show interfaces extensive', 'juniper_show_interfaces_extensive.txt'),
+    ]
+
+    def setUp(self):
+        self.registry = sshpoller.TemplateRegistry(index_file, template_dir)
+
+    def test_required_literal(self):
+        """ Test the literals found in rule regexes
+        """
+        self.assertEqual(sshpoller.required_literal(r'^Physical interface: (?P<INTF_NAME>\S+),'), 'Physical interface: ')
+        self.assertEqual(sshpoller.required_literal(r'^\s+Input\s+packets\s*:\s*(?P<INPUT_PACKETS>\d+)'), 'packets')
+        self.assertEqual(sshpoller.required_literal(r'^\s+(?:Total)\s+'), 'Total')
+        self.assertEqual(sshpoller.required_literal(r'^(?P<INTF_NAME>\S+)'), None)
+        self.assertEqual(sshpoller.required_literal(r'^(up|down)'), None)
+        self.assertEqual(sshpoller.required_literal(r'^(?:foo)?bar'), 'bar')
+        self.assertEqual(sshpoller.required_literal(r'(?i)^Total'), None)
+        self.assertEqual(sshpoller.required_literal(r'^\s+(?i:total)\s+(?P<X>\d+)'), None)
+        self.assertEqual(sshpoller.required_literal(r'^(?i:total)\s+packets'), 'packets')
+
+    def test_scoped_ignorecase(self):
+        """ Test that the pre-filter keeps the lines a (?i:...) group matches in another case
+        """
+        template = 'Value TOTAL (\\d+)\n\nStart\n  ^\\s+(?i:total)\\s+${TOTAL} -> Record\n'
+        fsm = textfsm.TextFSM(io.StringIO(template))
+        prefilter = sshpoller.template_prefilter(fsm)
+
+        self.assertTrue(prefilter('  TOTAL 5'))
+        self.assertEqual(fsm.ParseText('  TOTAL 5\n'), [['5']])
+
+    def test_fixtures(self):
+        """ Test that the pre-filter doesn't change the parsed records of the fixtures
+        """
+        for platform, command, fixture in self.fixtures:
+            output = open(os.path.join('mockssh', fixture), 'r').read()
+            attrs = {'Command': command, 'Platform': platform}
+            filtered = self.registry.parse(output, attrs)
+            with mock.patch.object(self.registry, 'prefilter', False):
+                unfiltered = self.registry.parse(output, attrs)
+
+            self.assertTrue(unfiltered[1], fixture)
+            self.assertEqual(filtered, unfiltered, fixture)
+
+    def test_lines_dropped(self):
+        """ Test that lines no rule can match are dropped, with literals or the combined rules
+        """
+        for platform, command, fixture in self.fixtures[1::4]:
+            output = open(os.path.join('mockssh', fixture), 'r').read()
+            self.registry.parse(output, {'Command': command, 'Platform': platform})
+            name = self.registry.resolve({'Command': command, 'Platform': platform})
+            matches = self.registry.templates[name]['prefilter']
+            kept = [line for line in output.splitlines() if matches(line)]
+
+            self.assertLess(len(kept), len(output.splitlines()) / 2, fixture)
+
+class SSH_PollerTest_Projection(unittest.TestCase):
+    def setUp(self):
+        self.registry = sshpoller.TemplateRegistry(index_file, template_dir)
+        self.task = {
+            'hostname': 'localhost',
+            'username': 'test',
+            'password': 'test',
+            'port': 9999,
+            'mode': 'influx',
+            'device_type': 'f5_ltm',
+            'parser_mode': 'fsm',
+            'precommands': '',
+            'interval': 0,
+            'commands': [{'command': 'show sys tmm-info', 'tag': 'tmm_instance', 'fields': ['CPU_5_MIN']}],
+        }
+
+    def test_project_template(self):
+        """ Test that unrequested values are removed from the template, their regex kept in the rules
+        """
+        template = ('Value Required NAME (\\S+)\nValue SPEED (\\d+)\nValue MTU (\\d+$)\nValue DESCR (.*)\n\n'
+                    'Start\n  ^${NAME} speed ${SPEED}, mtu $MTU\n  ^  descr ${DESCR} $$ -> Record\n')
+        projected = sshpoller.project_template(template, ['speed'])
+
+        self.assertEqual(projected, (
+            'Value Required NAME (\\S+)\nValue SPEED (\\d+)\n\n'
+            'Start\n  ^${NAME} speed ${SPEED}, mtu (?:\\d+$$)\n  ^  descr (?:.*) $$ -> Record\n'))
+        fsm = textfsm.TextFSM(io.StringIO(projected))
+        self.assertEqual(fsm.ParseText('eth0 speed 1000, mtu 1500\n  descr uplink $\n'), [['eth0', '1000']])
+
+    def test_fixtures(self):
+        """ Test that a projected template gives the requested columns of the full template
+        """
+        for platform, command, fixture in SSH_PollerTest_Prefilter.fixtures:
+            output = open(os.path.join('mockssh', fixture), 'r').read()
+            attrs = {'Command': command, 'Platform': platform}
+            header, records = self.registry.parse(output, attrs)
+            fields = [header[0].lower(), header[-1].lower()]
+            projected = self.registry.parse(output, attrs, fields=fields)
+
+            self.assertEqual(projected, ([header[0], header[-1]], [[record[0], record[-1]] for record in records]), fixture)
+
+    def test_yaml_fields(self):
+        """ Test that only the requested fields, plus the tag, are parsed and written
+        """
+        poller = sshpoller.SSH_Poller(self.task)
+        poller.sock = FakeConnection()
+        poller.send_commands()
+
+        self.assertEqual(poller.command_list[0]['fields'], ['cpu_5_min', 'tmm_instance'])
+        self.assertEqual(poller.batch[0].header, ['tmm_instance', 'cpu_5_min'])
+        self.assertEqual(poller.batch[0].rows[0], (1.0, 4.0))
+
+    def test_csv_fields(self):
+        """ Test that only the requested CSV columns are converted and written
+        """
+        poller = sshpoller.SSH_Poller(dict(self.task, parser_mode='csv', commands=[
+            {'command': 'tmctl -c pva_stat', 'fields': ['tmm', 'client_side_traffic.bytes_in']}]))
+        poller.sock = FakeConnection()
+        poller.send_commands()
+
+        header = open(os.path.join('mockssh', 'f5_tmctl_csv.txt'), 'r').readline().strip().split(',')
+        self.assertEqual(poller.batch[0].header, [name for name in header if name in ('tmm', 'client_side_traffic.bytes_in')])
+
+class SSH_PollerTest_Metrics(unittest.TestCase):
+    def setUp(self):
+        self.influx = FakeInfluxDB()
+        self.metrics = sshpoller.StageMetrics(True)
+        self.task = {
+            'hostname': 'localhost',
+            'username': 'test',
+            'password': 'test',
+            'port': 9999,
+            'mode': 'influx',
+            'device_type': 'cisco_nxos',
+            'parser_mode': 'fsm',
+            'precommands': '',
+            'interval': 60,
+            'commands': ['show version'],
+        }
+        self.patches = [
+            mock.patch.object(sshpoller, 'ConnectHandler', FakeConnection),
+            mock.patch.object(sshpoller, 'metrics', self.metrics),
+            mock.patch.object(sshpoller.SSH_Poller, 'db_port', self.influx.port)]
+        for patch in self.patches:
+            patch.start()
+        self.scheduler = sshpoller.PollScheduler([self.task])
+        self.poller = self.scheduler.pollers[0]
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.influx.stop()
+
+    def test_stage_timings(self):
+        """ Test that each stage is timed per device and command, with its counters
+        """
+        self.scheduler.poll(self.poller)
+        self.scheduler.poll(self.poller)
+
+        timings = self.metrics.timings['localhost']
+        self.assertEqual(sorted(timings), [('', 'connect'), ('', 'find_prompt'), ('', 'output_influxdb'),
+                                           ('show version', 'parse_fsm'), ('show version', 'send_command')])
+        self.assertEqual(timings[('', 'connect')][0], 1)
+        self.assertEqual(timings[('show version', 'send_command')][0], 2)
+        counters = self.metrics.counters['localhost']
+        self.assertEqual(counters['show version'], {'bytes': 2 * len(FakeConnection().send_command('show version')), 'rows': 2})
+        self.assertNotIn('errors', counters.get('', {}))
+
+    def test_concurrent_record(self):
+        """ Test that summaries can be taken while other threads record new stages and counters
+        """
+        def record():
+            for i in range(2000):
+                self.metrics.observe('localhost', 'cmd%s' % i, 'stage%s' % i, 0.01)
+                self.metrics.count('localhost', 'cmd%s' % i, 'counter%s' % i)
+                self.metrics.observe('host%s' % i, '', 'connect', 0.01)
+
+        thread = threading.Thread(target=record)
+        thread.start()
+        while thread.is_alive():
+            self.metrics.summary()
+            self.metrics.points('localhost')
+        thread.join()
+
+        self.assertEqual(self.metrics.summary()[0]['connect']['count'], 2000)
+
+    def test_points_written(self):
+        """ Test that the timings and counters are written to InfluxDB with the schedule counters
+        """
+        self.scheduler.poll(self.poller)
+        self.scheduler.poll(self.poller)
+        sshpoller.poller_influx_writer(self.poller).flush()
+
+        series = [line.rsplit(' ', 2)[0] for line in self.influx.lines]
+        self.assertIn('sshpoller_stage,cmd=show\\ version,host=localhost,stage=send_command', series)
+        self.assertIn('sshpoller_stage,host=localhost,stage=connect', series)
+        self.assertIn('sshpoller_command,cmd=show\\ version,host=localhost', series)
+
+    def test_disabled(self):
+        """ Test that nothing is recorded or written when disabled
+        """
+        self.metrics.enabled = False
+        self.scheduler.poll(self.poller)
+
+        self.assertEqual(self.metrics.timings, {})
+        self.assertEqual(self.metrics.counters, {})
+        self.assertEqual(self.metrics.points('localhost'), [])
+
+    def test_errors(self):
+        """ Test that failed polls are counted
+        """
+        self.scheduler.poll(self.poller)
+        self.poller.sock.alive = False
+        self.poller.sock.is_alive = lambda: True
+        self.scheduler.poll(self.poller)
+
+        self.assertEqual(self.metrics.counters['localhost']['']['errors'], 1)
+
+    def test_histogram(self):
+        """ Test the quantiles and the summary of the histograms
+        """
+        metrics = sshpoller.StageMetrics(True)
+        for seconds in [0.002] * 98 + [0.3, 12.0]:
+            metrics.observe('a', 'show version', 'send_command', seconds)
+        metrics.observe('b', 'show version', 'send_command', 0.004)
+        timing = metrics.timings['a'][('show version', 'send_command')]
+
+        self.assertEqual(metrics.quantile(timing, 0.5), 0.005)
+        self.assertEqual(metrics.quantile(timing, 0.99), 0.5)
+        self.assertEqual(metrics.quantile(timing, 1.0), 12.0)
+        stages, counters = metrics.summary()
+        self.assertEqual(stages['send_command']['count'], 101)
+        self.assertEqual(stages['send_command']['max'], 12.0)
+
+        with self.assertLogs(level='INFO') as logs:
+            metrics.report(now=0.0)
+            metrics.report(now=metrics.report_interval)
+        self.assertEqual(len(logs.output), 2)
+        self.assertIn('send_command 101 x', logs.output[0])
+
+    def test_profiler(self):
+        """ Test that the profiler writes a profile every second toggle
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            profiler = sshpoller.Profiler(directory)
+            profiler.toggle()
+            sum(range(1000))
+            profiler.toggle()
+            self.assertEqual(os.listdir(directory), ['sshpoller-%s-1.prof' % os.getpid()])
+        finally:
+            shutil.rmtree(directory)
+
+
+class SSH_PollerTest_Reload(unittest.TestCase):
+    def setUp(self):
+        self.influx = FakeInfluxDB(keep_lines=False)
+        self.patches = [
+            mock.patch.object(sshpoller, 'ConnectHandler', FakeConnection),
+            mock.patch.object(sshpoller.SSH_Poller, 'db_port', self.influx.port)]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.influx.stop()
+
+    def task(self, hostname, commands=None, port=22):
+        return {
+            'hostname': hostname,
+            'username': 'test',
+            'password': 'test',
+            'port': port,
+            'mode': 'influx',
+            'device_type': 'cisco_nxos',
+            'parser_mode': 'fsm',
+            'precommands': '',
+            'interval': 60,
+            'commands': commands or ['show version'],
+        }
+
+    def test_diff_tasks(self):
+        """ Test that added, removed and modified devices are found
+        """
+        old = [self.task('a'), self.task('b'), self.task('c'), self.task('c', port=2222)]
+        new = [self.task('a'), self.task('b', ['show interface:intf_name']), self.task('c', port=2222),
+               self.task('d')]
+        added, removed, modified = sshpoller.diff_tasks(old, new)
+
+        self.assertEqual(added, [self.task('d')])
+        self.assertEqual(removed, [self.task('c')])
+        self.assertEqual(modified, [self.task('b', ['show interface:intf_name'])])
+        self.assertEqual(sshpoller.diff_tasks(old, old), ([], [], []))
+
+    def test_scheduler_changes(self):
+        """ Test that task changes only touch their own device, other sessions stay up
+        """
+        control = queue.Queue()
+        scheduler = sshpoller.PollScheduler([self.task('a'), self.task('b')], control=control)
+        for poller in scheduler.pollers:
+            scheduler.poll(poller)
+        a, b = scheduler.pollers
+
+        control.put(('add', self.task('c')))
+        control.put(('remove', self.task('b')))
+        control.put(('update', self.task('a', ['show version', 'show interface:intf_name'])))
+        control.put(('update', self.task('a', ['show version', 'show interface:intf_name'])))
+        control.put(('add', self.task('d')))
+        control.put(('remove', self.task('d')))
+        scheduler.apply_changes()
+
+        self.assertEqual(sorted(poller.hostname for poller in scheduler.pollers), ['a', 'c'])
+        self.assertEqual(sorted(item[2].hostname for item in scheduler.queue), ['a', 'c'])
+        self.assertFalse(b.session_up)
+        new_a = [poller for poller in scheduler.pollers if poller.hostname == 'a'][0]
+        self.assertEqual(len(new_a.command_list), 2)
+        self.assertFalse(a.session_up)
+
+        # Untouched devices keep their session
+        scheduler = sshpoller.PollScheduler([self.task('a'), self.task('b')], control=control)
+        for poller in scheduler.pollers:
+            scheduler.poll(poller)
+        a, b = scheduler.pollers
+        session_a = a.sock
+        control.put(('update', self.task('b', ['show interface:intf_name'])))
+        scheduler.apply_changes()
+        scheduler.poll(a)
+        self.assertIs(a.sock, session_a)
+        self.assertEqual(a.session_stats['handshakes'], 1)
+
+    def test_removed_rates(self):
+        """ Test that the counter samples of a removed device are forgotten
+        """
+        store = sshpoller.RateStore()
+        table = sshpoller.ResultTable('show interface', ['intf_name', 'input_packets'], [('Eth1', 1.0)],
+                                      {'host': 'b'}, 100, tag_column='intf_name')
+        store.apply(table, 'a', ['input_packets'])
+        store.apply(table, 'b', ['input_packets'])
+        control = queue.Queue()
+        scheduler = sshpoller.PollScheduler([self.task('a'), self.task('b')], control=control)
+        control.put(('remove', self.task('b')))
+        with mock.patch.object(sshpoller, 'rate_store', store):
+            scheduler.apply_changes()
+
+        self.assertEqual(list(store.samples), [('a', 'show interface')])
+
+    def test_removed_rates_pipeline(self):
+        """ Test that the output stage of the pipeline forgets the counter samples of a removed device
+        """
+        store = sshpoller.RateStore()
+        table = sshpoller.ResultTable('show interface', ['intf_name', 'input_packets'], [('Eth1', 1.0)],
+                                      {'host': 'b'}, 100, tag_column='intf_name')
+        store.apply(table, 'a', ['input_packets'])
+        store.apply(table, 'b', ['input_packets'])
+        raw_queue, parsed_queue, control = queue.Queue(), queue.Queue(), queue.Queue()
+        stats = sshpoller.PipelineStats(raw_queue, parsed_queue)
+        scheduler = sshpoller.PollScheduler([self.task('a'), self.task('b')], raw_queue, stats, control)
+        control.put(('remove', self.task('b')))
+        scheduler.apply_changes()
+        raw_queue.put('STOP')
+        sshpoller.parser_worker(raw_queue, parsed_queue, stats)
+        with mock.patch.object(sshpoller, 'rate_store', store):
+            sshpoller.output_worker(parsed_queue, stats)
+
+        self.assertEqual(list(store.samples), [('a', 'show interface')])
+
+    def test_scheduler_waits_for_tasks(self):
+        """ Test that a scheduler with a control queue keeps running without tasks
+        """
+        control = queue.Queue()
+        scheduler = sshpoller.PollScheduler([], control=control)
+        control.put(('add', self.task('a')))
+        threading.Timer(1.5, scheduler.stop).start()
+        with mock.patch.object(sshpoller.PollScheduler, 'phase_spread', False):
+            scheduler.run()
+
+        self.assertEqual([poller.hostname for poller in scheduler.pollers], ['a'])
+        self.assertEqual(scheduler.pollers[0].deadline.cycles, 1)
+
+    def test_reloader(self):
+        """ Test that the reloader sends each change to the worker of the device
+        """
+        tasks = [self.task('a'), self.task('b'), self.task('c')]
+        queues = [queue.Queue(), queue.Queue()]
+        reloader = sshpoller.TaskReloader(lambda: tasks, queues)
+        reloader.start(tasks)
+
+        self.assertEqual(queues[0].get_nowait(), [self.task('a'), self.task('c')])
+        self.assertEqual(queues[1].get_nowait(), [self.task('b')])
+
+        tasks = [self.task('a', ['show interface:intf_name']), self.task('b'), self.task('d'), self.task('e')]
+        added, removed, modified = reloader.reload()
+
+        self.assertEqual((len(added), len(removed), len(modified)), (2, 1, 1))
+        self.assertEqual(queues[0].get_nowait(), ('remove', self.task('c')))
+        self.assertEqual(queues[0].get_nowait(), ('update', self.task('a', ['show interface:intf_name'])))
+        # New devices go to the worker with the fewest
+        self.assertEqual(queues[0].get_nowait(), ('add', self.task('d')))
+        self.assertEqual(queues[1].get_nowait(), ('add', self.task('e')))
+        self.assertTrue(queues[0].empty() and queues[1].empty())
+        self.assertEqual(reloader.reload(), ([], [], []))
+
+    def test_reload_error(self):
+        """ Test that the running tasks are kept when the task file can't be loaded
+        """
+        def load():
+            raise ValueError('bad YAML')
+        queues = [queue.Queue()]
+        reloader = sshpoller.TaskReloader(load, queues)
+        reloader.start([self.task('a')])
+        queues[0].get_nowait()
+
+        self.assertIsNone(reloader.reload())
+        self.assertTrue(queues[0].empty())
+        self.assertEqual(list(reloader.tasks), [('a', '22')])
+
+    def test_load_tasks(self):
+        """ Test the task list of a YAML file
+        """
+        tasks = sshpoller.load_tasks('test_task.yml', 'test', 'test', 'influx', 60)
+
+        self.assertEqual(tasks, [{
+            'hostname': 'localhost',
+            'username': 'test',
+            'password': 'test',
+            'mode': 'influx',
+            'device_type': 'cisco_nxos',
+            'parser_mode': 'fsm',
+            'commands': ['show version', 'show interface:intf_name'],
+            'precommands': None,
+            'interval': 60,
+            'max_channels': 1,
+            'port': 9999}])
+
+    def test_watch_task_file(self):
+        """ Test that the task file is reloaded on SIGHUP and, once written, on changes
+        """
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        reloader = mock.Mock()
+        worker = mock.Mock()
+        worker.is_alive.side_effect = [True] * 8 + [False]
+        handler = signal.getsignal(signal.SIGHUP)
+
+        def sleep_and_act(seconds, calls=[]):
+            calls.append(seconds)
+            if len(calls) == 2:
+                os.kill(os.getpid(), signal.SIGHUP)
+            elif len(calls) == 4:
+                os.utime(path, (0, 0))
+
+        try:
+            with mock.patch.object(sshpoller, 'sleep', sleep_and_act):
+                sshpoller.watch_task_file(path, reloader, [worker], watch=True)
+        finally:
+            signal.signal(signal.SIGHUP, handler)
+            os.remove(path)
+
+        # Once on SIGHUP, once the file changed and is the same on the next check
+        self.assertEqual(reloader.reload.call_count, 2)
+
+
+class SSH_PollerTest_Inventory(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, text):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def load(self, path):
+        return sshpoller.load_tasks(path, 'test', 'test', 'influx', 60)
+
+    def test_groups(self):
+        """ Test that devices are merged over their group and the defaults, sharing their settings
+        """
+        path = self.write('inventory.yml', (
+            'defaults:\n'
+            '  parse_mode: fsm\n'
+            '  post_login_commands: [terminal length 0]\n'
+            'groups:\n'
+            '  nxos:\n'
+            '    device_type: cisco_nxos\n'
+            '    commands: [show version]\n'
+            '  f5:\n'
+            '    device_type: f5_ltm\n'
+            '    parse_mode: csv\n'
+            '    port: 2222\n'
+            '    commands: [tmctl -c pva_stat]\n'
+            'devices:\n'
+            '  - {device_name: sw1, group: nxos}\n'
+            '  - {device_name: sw2, group: nxos, port: 8022}\n'
+            '  - {device_name: sw3, group: nxos, max_channels: 2}\n'
+            '  - {device_name: lb1, group: f5}\n'))
+        sw1, sw2, sw3, lb1 = self.load(path)
+
+        self.assertEqual(sw1, {
+            'hostname': 'sw1',
+            'port': 22,
+            'username': 'test',
+            'password': 'test',
+            'mode': 'influx',
+            'device_type': 'cisco_nxos',
+            'parser_mode': 'fsm',
+            'commands': ['show version'],
+            'precommands': ['terminal length 0'],
+            'interval': 60,
+            'max_channels': 1})
+        self.assertEqual(sw2['port'], 8022)
+        self.assertIs(sw1.settings, sw2.settings)
+        self.assertEqual(sw3['max_channels'], 2)
+        self.assertEqual((lb1['port'], lb1['parser_mode'], lb1['device_type']), (2222, 'csv', 'f5_ltm'))
+        self.assertEqual(sshpoller.SSH_Poller(sw3).max_channels, 2)
+
+    def test_group_interval(self):
+        """ Test that an interval of the defaults, a group or a device overrides the command line's
+        """
+        path = self.write('inventory.yml', (
+            'defaults:\n'
+            '  device_type: cisco_nxos\n'
+            '  parse_mode: fsm\n'
+            '  commands: [show version]\n'
+            'groups:\n'
+            '  core:\n'
+            '    interval: 10\n'
+            '  edge: {}\n'
+            'devices:\n'
+            '  - {device_name: sw1, group: core}\n'
+            '  - {device_name: sw2, group: core, interval: 5}\n'
+            '  - {device_name: sw3, group: edge}\n'))
+        sw1, sw2, sw3 = self.load(path)
+
+        self.assertEqual((sw1['interval'], sw2['interval'], sw3['interval']), (10, 5, 60))
+
+    def test_csv_devices(self):
+        """ Test an inventory whose devices are in a CSV file
+        """
+        self.write('devices.csv', (
+            'device_name,port,group,max_channels\n'
+            'sw1,,nxos,\n'
+            'sw2,8022,nxos,4\n'))
+        path = self.write('inventory.yml', (
+            'groups:\n'
+            '  nxos:\n'
+            '    device_type: cisco_nxos\n'
+            '    parse_mode: fsm\n'
+            '    commands: [show version]\n'
+            'devices: devices.csv\n'))
+        sw1, sw2 = self.load(path)
+
+        self.assertEqual((sw1['hostname'], sw1['port'], sw1['max_channels']), ('sw1', 22, 1))
+        self.assertEqual((sw2['hostname'], sw2['port'], sw2['max_channels']), ('sw2', 8022, 4))
+        self.assertEqual(sw1['commands'], ['show version'])
+
+    def test_unknown_group(self):
+        """ Test that a device of an unknown group is an error
+        """
+        path = self.write('inventory.yml', 'groups: {}\ndevices:\n  - {device_name: sw1, group: nxos}\n')
+        self.assertRaises(ValueError, self.load, path)
+
+    def test_task_pickle(self):
+        """ Test that tasks keep sharing their settings once sent to a worker
+        """
+        settings = {'mode': 'influx', 'commands': ['show version']}
+        tasks = pickle.loads(pickle.dumps([sshpoller.Task('sw1', 22, settings), sshpoller.Task('sw2', 22, settings)]))
+
+        self.assertEqual(tasks[0], {'hostname': 'sw1', 'port': 22, 'mode': 'influx', 'commands': ['show version']})
+        self.assertIs(tasks[0].settings, tasks[1].settings)
+        self.assertEqual(tasks[1].get('max_channels', 1), 1)
+        self.assertEqual(sshpoller.task_key(tasks[1]), ('sw2', '22'))
+
+
+class SSH_PollerTest_Sharding(unittest.TestCase):
+    def setUp(self):
+        self.tasks = [{
+            'hostname': '10.0.%s.%s' % (i // 250, i % 250),
+            'username': 'test',
+            'password': 'test',
+            'port': 22,
+            'mode': 'influx',
+            'device_type': 'cisco_nxos',
+            'parser_mode': 'fsm',
+            'precommands': '',
+            'interval': 0,
+            'commands': ['show version'],
+        } for i in range(1000)]
+
+    def hosts(self, tasks):
+        return set(task['hostname'] for task in tasks)
+
+    def assertPartition(self, shards):
+        self.assertEqual(sum(len(shard) for shard in shards), len(self.tasks))
+        self.assertEqual(set.union(*[self.hosts(shard) for shard in shards]), self.hosts(self.tasks))
+
+    def test_jump_hash(self):
+        """ Test that shards cover every device once, and that a new shard only takes its share
+        """
+        shards = [sshpoller.shard_tasks(self.tasks, index=i, count=4) for i in range(4)]
+        self.assertPartition(shards)
+        self.assertTrue(all(200 < len(shard) < 300 for shard in shards))
+
+        grown = [sshpoller.shard_tasks(self.tasks, index=i, count=5) for i in range(5)]
+        self.assertPartition(grown)
+        for before, after in zip(shards, grown):
+            # Devices only leave for the new shard
+            self.assertTrue(self.hosts(after) <= self.hosts(before))
+        self.assertTrue(150 < len(grown[4]) < 250)
+
+    def test_rendezvous(self):
+        """ Test that nodes cover every device once, and that adding or removing a node moves only its devices
+        """
+        nodes = ['poller-a', 'poller-b', 'poller-c']
+        shards = dict((node, sshpoller.shard_tasks(self.tasks, node=node, nodes=nodes)) for node in nodes)
+        self.assertPartition(list(shards.values()))
+
+        grown = dict((node, sshpoller.shard_tasks(self.tasks, node=node, nodes=nodes + ['poller-d'])) for node in nodes)
+        for node in nodes:
+            self.assertTrue(self.hosts(grown[node]) <= self.hosts(shards[node]))
+        moved = len(self.tasks) - sum(len(shard) for shard in grown.values())
+        self.assertTrue(150 < moved < 350)
+
+        shrunk = dict((node, sshpoller.shard_tasks(self.tasks, node=node, nodes=['poller-a', 'poller-c']))
+                      for node in ('poller-a', 'poller-c'))
+        for node in ('poller-a', 'poller-c'):
+            self.assertTrue(self.hosts(shards[node]) <= self.hosts(shrunk[node]))
+        self.assertPartition(list(shrunk.values()))
+
+    def test_no_sharding(self):
+        """ Test that every task is polled without sharding
+        """
+        self.assertIs(sshpoller.shard_tasks(self.tasks), self.tasks)
+
+    def test_shard_instances(self):
+        """ Test that instances polling their shard of the same task list cover each device once
+        """
+        influx = FakeInfluxDB(keep_lines='show\\ version')
+        tasks = self.tasks[:60]
+        try:
+            with mock.patch.object(sshpoller, 'ConnectHandler', FakeConnection), \
+                    mock.patch.object(sshpoller.SSH_Poller, 'db_port', influx.port):
+                for i in range(3):
+                    sshpoller.PollScheduler(sshpoller.shard_tasks(tasks, index=i, count=3)).run()
+        finally:
+            influx.stop()
+
+        polled = [re.search(r',host=([^, ]+)', line).group(1) for line in influx.lines]
+        self.assertEqual(sorted(polled), sorted(self.hosts(tasks)))
+
+
+class SSH_PollerTest_Adaptive(unittest.TestCase):
+    def setUp(self):
+        self.influx = FakeInfluxDB(keep_lines='sshpoller_health')
+
+    def tearDown(self):
+        self.influx.stop()
+
+    def make_task(self, hostname, interval):
+        return {
+            'hostname': hostname,
+            'username': 'test',
+            'password': 'test',
+            'port': 9999,
+            'mode': 'influx',
+            'device_type': 'cisco_nxos',
+            'parser_mode': 'fsm',
+            'precommands': '',
+            'interval': interval,
+            'commands': ['show version'],
+        }
+
+    def test_stretch(self):
+        """ Test that the interval stretches with the response time and comes back with it
+        """
+        health = sshpoller.DeviceHealth(10)
+        self.assertEqual(health.update(2.0, True), 10.0)
+
+        for i in range(20):
+            interval = health.update(16.0, True)
+        self.assertAlmostEqual(interval, 20.0, places=1)
+
+        for i in range(20):
+            interval = health.update(200.0, True)
+        self.assertEqual(interval, 80.0)
+
+        for i in range(30):
+            interval = health.update(1.0, True)
+        self.assertEqual(interval, 10.0)
+
+    def test_errors(self):
+        """ Test that the interval doubles while most cycles fail
+        """
+        health = sshpoller.DeviceHealth(10)
+        health.update(1.0, True)
+        self.assertEqual(health.update(1.0, False), 10.0)
+        self.assertEqual(health.update(1.0, False), 20.0)
+        self.assertGreater(health.error_rate, health.error_threshold)
+
+        for i in range(5):
+            interval = health.update(1.0, True)
+        self.assertEqual(interval, 10.0)
+
+    def test_slow_lane_hysteresis(self):
+        """ Test that devices enter the slow lane above slow_time and leave it below half of it
+        """
+        health = sshpoller.DeviceHealth(60)
+        health.update(health.slow_time * 1.2, True)
+        self.assertTrue(health.slow)
+
+        health.update(health.slow_time * 0.8, True)
+        self.assertTrue(health.slow)
+
+        for i in range(10):
+            health.update(health.slow_time * 0.1, True)
+        self.assertFalse(health.slow)
+
+    def test_slow_lane(self):
+        """ Test that a slow device doesn't hold up the others, and never has two cycles in flight
+        """
+        busy = []
+
+        class SlowConnection(FakeConnection):
+            def send_command(self, command):
+                busy.append(command)
+                self.overlap = max(getattr(self, 'overlap', 0), len(busy))
+                try:
+                    return FakeConnection.send_command(self, command)
+                finally:
+                    busy.remove(command)
+
+        def connect(poller):
+            poller.sock = SlowConnection(delay=0.3) if poller.hostname == 'slow' else FakeConnection()
+            return True
+
+        with mock.patch.object(sshpoller.SSH_Poller, 'connect', connect), \
+                mock.patch.object(sshpoller.SSH_Poller, 'db_port', self.influx.port), \
+                mock.patch.object(sshpoller.PollScheduler, 'phase_spread', False), \
+                mock.patch.object(sshpoller.DeviceHealth, 'slow_time', 0.2):
+            scheduler = sshpoller.PollScheduler([self.make_task('fast', 0.1), self.make_task('slow', 0.1)])
+            threading.Timer(1.55, scheduler.stop).start()
+            scheduler.run()
+
+        pollers = dict((poller.hostname, poller) for poller in scheduler.pollers)
+        stats = scheduler.stats()
+        # Only the first cycle of the slow device, before it's found slow, holds up the fast one
+        self.assertGreaterEqual(len(pollers['fast'].sock.commands), 10)
+        self.assertLessEqual(stats['fast']['skipped'], 3)
+        self.assertFalse(stats['fast']['slow_lane'])
+        self.assertEqual(stats['fast']['interval'], 0.1)
+
+        self.assertTrue(stats['slow']['slow_lane'])
+        self.assertGreater(stats['slow']['interval'], 0.3)
+        self.assertEqual(pollers['slow'].sock.overlap, 1)
+        self.assertEqual(pollers['slow'].max_channels, 1)
+        self.assertTrue(any(line.startswith('sshpoller_health,host=slow') for line in self.influx.lines))
+
+    def test_not_adaptive(self):
+        """ Test that the intervals are fixed when adaptive polling is off
+        """
+        with mock.patch.object(sshpoller.PollScheduler, 'adaptive', False):
+            scheduler = sshpoller.PollScheduler([self.make_task('device', 10)])
+        self.assertIsNone(scheduler.pollers[0].health)
+        self.assertNotIn('slow_lane', scheduler.stats()['device'])
+
+
+@unittest.skipIf(MockSSH is None, 'MockSSH is Python 2 only')
 class SSH_PollerTest_MockSSH(unittest.TestCase):
     def setUp(self):
         pass
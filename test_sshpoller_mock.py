@@ -1,10 +1,28 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import asyncio
+import gzip
 import os
+import random
 import sys
+import threading
+from time import sleep
 
-import MockSSH
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+try:
+    import MockSSH
+except (ImportError, SyntaxError):
+    MockSSH = None
+
+try:
+    import asyncssh
+except ImportError:
+    asyncssh = None
 
 fixture = {}
 fixture['show version'] = open('mockssh/cisco_show_version.txt').read()
@@ -23,31 +41,36 @@ def cmd_parser(instance):
 def f5_prompt(instance):
     instance.protocol.prompt = '[user@F5-TEST:/S1-green-P:Active:In Sync] ~ # '
 
-cmd_cisco_show = MockSSH.ArgumentValidatingCommand(
-     'show',
-     [cmd_parser],
-     [cmd_parser],
-     *[])
-
-cmd_f5_show = MockSSH.ArgumentValidatingCommand(
-     'show',
-     [cmd_parser],
-     [cmd_parser],
-     *[])
-
-cmd_f5_bash = MockSSH.ArgumentValidatingCommand(
-     'bash',
-     [f5_prompt],
-     [f5_prompt],
-     *[])
-
-cmd_f5_tmctl = MockSSH.ArgumentValidatingCommand(
-     'tmctl',
-     [cmd_parser],
-     [cmd_parser],
-     *[])
-
-def mock_cisco():
+# MockSSH servers (MockSSH is Python 2 only, the asyncssh mock devices below replace them)
+if MockSSH is not None:
+    cmd_cisco_show = MockSSH.ArgumentValidatingCommand(
+         'show',
+         [cmd_parser],
+         [cmd_parser],
+         *[])
+
+    cmd_f5_show = MockSSH.ArgumentValidatingCommand(
+         'show',
+         [cmd_parser],
+         [cmd_parser],
+         *[])
+
+    cmd_f5_bash = MockSSH.ArgumentValidatingCommand(
+         'bash',
+         [f5_prompt],
+         [f5_prompt],
+         *[])
+
+    cmd_f5_tmctl = MockSSH.ArgumentValidatingCommand(
+         'tmctl',
+         [cmd_parser],
+         [cmd_parser],
+         *[])
+
+def mock_cisco(port=9999):
+    if MockSSH is None:
+        raise ImportError('The MockSSH servers require the MockSSH module (Python 2 only)')
+
     # Redirect stdout to null
     f = open(os.devnull, 'w')
     sys.stdout = f
@@ -57,10 +80,13 @@ def mock_cisco():
     MockSSH.runServer(commands,
                       prompt="hostname>",
                       interface='127.0.0.1',
-                      port=9999,
+                      port=port,
                       **users)
 
-def mock_f5():
+def mock_f5(port=9999):
+    if MockSSH is None:
+        raise ImportError('The MockSSH servers require the MockSSH module (Python 2 only)')
+
     # Redirect stdout to null
     f = open(os.devnull, 'w')
     sys.stdout = f
@@ -70,5 +96,154 @@ def mock_f5():
     MockSSH.runServer(commands,
                       prompt="user@(F5-TEST)(cfg-sync In Sync)(/S1-green-P:Active)(/Common)(tmos)# ",
                       interface='127.0.0.1',
-                      port=9999,
-                      **users)                                                   
\ No newline at end of file
+                      port=port,
+                      **users)
+
+
+class FakeConnection:
+    """ Stand-in for a netmiko connection that serves the fixtures """
+
+    def __init__(self, delay=0, **kwargs):
+        self.delay = delay
+        self.commands = []
+        self.alive = True
+
+    def find_prompt(self):
+        return 'hostname>'
+
+    def send_command(self, command):
+        if not self.alive:
+            raise OSError('Socket is closed')
+        sleep(self.delay)
+        self.commands.append(command)
+        return fixture.get(command, 'Invalid command')
+
+    def is_alive(self):
+        return self.alive
+
+    def disconnect(self):
+        pass
+
+
+class FakeInfluxDB:
+    """ Local stand-in for the InfluxDB HTTP write API
+        Records every write request and the lines it contained (or only the
+        lines of the measurement keep_lines names)
+        While paused, write requests are answered with 503 errors
+    """
+
+    def __init__(self, keep_lines=True):
+        self.paused = False
+        self.rejected = 0
+        self.requests = 0
+        self.bytes = 0
+        self.points = 0
+        self.lines = []
+        self.keep_lines = keep_lines
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                if fake.paused:
+                    fake.rejected += 1
+                    self.send_response(503)
+                    self.end_headers()
+                    return
+                fake.requests += 1
+                fake.bytes += len(body)
+                if self.headers.get('Content-Encoding') == 'gzip':
+                    body = gzip.decompress(body)
+                lines = body.decode('utf-8').splitlines()
+                fake.points += len(lines)
+                if fake.keep_lines is True:
+                    fake.lines.extend(lines)
+                elif fake.keep_lines:
+                    fake.lines.extend(line for line in lines if line.split(',', 1)[0] == fake.keep_lines)
+                self.send_response(204)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class AsyncMockFleet:
+    """ asyncssh mock devices serving the fixtures on an interactive shell
+        All devices run in one event loop on a background thread
+        Outputs are the fixtures repeated scale times. Each command takes delay
+        seconds and drops the connection with a probability of error_rate.
+    """
+
+    def __init__(self, count, prompt='hostname>', delay=0, scale=1, error_rate=0.0, seed=None):
+        self.prompt = prompt
+        self.delay = delay
+        self.outputs = dict((cmd, '\n'.join([output.rstrip('\n')] * scale) + '\n') for cmd, output in fixture.items())
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.errors = 0
+        self.ports = []
+        self.servers = []
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        host_key = asyncssh.generate_private_key('ssh-ed25519')
+        for i in range(count):
+            future = asyncio.run_coroutine_threadsafe(self.start_device(host_key), self.loop)
+            future.result()
+
+    async def start_device(self, host_key):
+        server = await asyncssh.create_server(
+            MockSSHServer, '127.0.0.1', 0,
+            server_host_keys=[host_key],
+            process_factory=self.shell)
+        self.servers.append(server)
+        self.ports.append(server.sockets[0].getsockname()[1])
+
+    async def shell(self, process):
+        process.stdout.write(self.prompt)
+        while True:
+            line = await process.stdin.readline()
+            if not line:
+                break
+            cmd = line.strip()
+            if cmd:
+                await asyncio.sleep(self.delay)
+                if self.error_rate and self.random.random() < self.error_rate:
+                    self.errors += 1
+                    process.channel.get_connection().close()
+                    return
+                process.stdout.write(self.outputs.get(cmd, 'Invalid command').replace('\n', '\r\n') + '\r\n')
+            process.stdout.write(self.prompt)
+        process.exit(0)
+
+    def stop(self):
+        for server in self.servers:
+            self.loop.call_soon_threadsafe(server.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+if asyncssh is not None:
+    class MockSSHServer(asyncssh.SSHServer):
+        """ Accepts the test/test credentials """
+
+        def begin_auth(self, username):
+            return True
+
+        def password_auth_supported(self):
+            return True
+
+        def validate_password(self, username, password):
+            return username == 'test' and password == 'test'
+